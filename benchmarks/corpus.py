@@ -0,0 +1,104 @@
+"""Generate a synthetic corpus of webhook deliveries.
+
+The corpus mimics the mix of deliveries marvin receives for opted-in pull
+requests. Real deliveries can be recorded with WEBHOOK_RECORD_PATH instead.
+Commands that request a triage run are left out, since triage is not part of
+the webhook path that is benchmarked here.
+"""
+
+import itertools
+import random
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+
+from benchmarks import github
+
+INSTALLATION_ID = 1
+AUTHORS = [(1000 + i, f"contributor{i}") for i in range(50)]
+REVIEWERS = [(2000 + i, f"reviewer{i}") for i in range(10)]
+STATUS_LABELS = ["needs_reviewer", "awaiting_reviewer", "awaiting_changes"]
+COMMENTS = [
+    "Thanks, looks good to me.",
+    "Could you rebase this?",
+    "Result of `nixpkgs-review` run: 3 packages built.",
+    "/status awaiting_changes",
+    "/status awaiting_reviewer",
+    "/status awaiting_merger",
+]
+
+
+def _user(user: Any) -> Dict[str, Any]:
+    user_id, login = user
+    return {"id": user_id, "login": login}
+
+
+def _pull_request(number: int, author: Any, labels: List[str]) -> Dict[str, Any]:
+    issue_url = f"{github.API_URL}/repos/{github.REPOSITORY}/issues/{number}"
+    return {
+        "url": f"{github.API_URL}/repos/{github.REPOSITORY}/pulls/{number}",
+        "issue_url": issue_url,
+        "comments_url": issue_url + "/comments",
+        "number": number,
+        "user": _user(author),
+        "labels": [{"name": name} for name in labels],
+        "body": "Motivation for this change: version bump. /marvin opt-in",
+    }
+
+
+def _issue(pull_request: Dict[str, Any]) -> Dict[str, Any]:
+    """The issue view of a pull request, as in issue_comment events."""
+    return {
+        "url": pull_request["issue_url"],
+        "comments_url": pull_request["comments_url"],
+        "number": pull_request["number"],
+        "user": pull_request["user"],
+        "labels": pull_request["labels"],
+        "pull_request": {"url": pull_request["url"]},
+    }
+
+
+def generate(count: int, seed: int = 0) -> Iterator[Dict[str, Any]]:
+    """Generate `count` deliveries in the format of recorded corpora."""
+    rng = random.Random(seed)
+    pull_count = max(1, count // 5)
+    delivery_ids = itertools.count()
+    for _ in range(count):
+        number = 100000 + rng.randrange(pull_count)
+        author = AUTHORS[number % len(AUTHORS)]
+        labels = ["marvin", rng.choice(STATUS_LABELS)]
+        pull_request = _pull_request(number, author, labels)
+        commenter = author if rng.random() < 0.3 else rng.choice(REVIEWERS)
+        kind = rng.choice(
+            ["opened", "synchronize", "review_requested", "comment", "review"]
+        )
+        payload: Dict[str, Any] = {"installation": {"id": INSTALLATION_ID}}
+        if kind == "comment":
+            event = "issue_comment"
+            payload.update(
+                action="created",
+                issue=_issue(pull_request),
+                comment={"body": rng.choice(COMMENTS), "user": _user(commenter)},
+            )
+        elif kind == "review":
+            event = "pull_request_review"
+            payload.update(
+                action="submitted",
+                pull_request=pull_request,
+                review={
+                    "body": rng.choice(COMMENTS) if rng.random() < 0.8 else None,
+                    "state": rng.choice(["commented", "changes_requested"]),
+                    "user": _user(rng.choice(REVIEWERS)),
+                },
+            )
+        else:
+            event = "pull_request"
+            if kind == "opened":
+                pull_request["labels"] = []
+            payload.update(action=kind, pull_request=pull_request)
+        yield {
+            "event": event,
+            "delivery_id": f"synthetic-{next(delivery_ids)}",
+            "payload": payload,
+        }
@@ -0,0 +1,183 @@
+"""Compare the event loop implementations under fake GitHub load.
+
+For each event loop, webhook deliveries are sent to marvin's web app over
+HTTP and triage is run once. Both talk to a fake GitHub served over HTTP with
+the configured latency, all on the event loop that is measured:
+
+    $ python3 -m benchmarks.event_loops --deliveries 2000 --pulls 2000 [--json]
+
+uvloop is skipped if it is not installed. Reports the webhook throughput and
+latency and the duration of the triage cycle per event loop.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+
+import aiohttp
+from aiohttp import web
+
+from benchmarks import corpus
+from benchmarks import github
+from benchmarks import replay
+from benchmarks import server
+from benchmarks import startup
+from benchmarks import triage
+from marvin import __main__ as main
+from marvin import constants
+from marvin import event_loop
+from marvin import status
+from marvin import team
+from marvin import triage_runner
+
+
+async def serve(app: web.Application) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner
+
+
+async def send_deliveries(
+    deliveries: List[Dict[str, Any]], latency_seconds: float, concurrency: int
+) -> Dict[str, Any]:
+    """Send deliveries to marvin's web app and report the throughput."""
+    fake = github.FakeGitHub(latency_seconds=latency_seconds)
+    github_runner = await serve(server.make_app(fake))
+    host, port = github_runner.addresses[0][:2]
+    fake.api_url = f"http://{host}:{port}"
+    deliveries = [startup.localize(delivery, fake.api_url) for delivery in deliveries]
+
+    app = web.Application()
+    app.add_routes(main.routes)
+    app["webhook_secret"] = startup.WEBHOOK_SECRET
+    app["gh_app_id"] = "1"
+    app["gh_private_key"] = startup.private_key()
+    app["draining"] = False
+    marvin_runner = await serve(app)
+    host, port = marvin_runner.addresses[0][:2]
+    url = f"http://{host}:{port}/webhook"
+
+    previous_api_url = constants.GITHUB_API_URL
+    constants.GITHUB_API_URL = fake.api_url
+    latencies: List[float] = []
+    statuses: Dict[int, int] = dict()
+    pending = iter(deliveries)
+
+    async def worker(session: aiohttp.ClientSession) -> None:
+        for delivery in pending:
+            start = time.perf_counter()
+            response_status = await startup.deliver(session, url, delivery)
+            latencies.append(time.perf_counter() - start)
+            statuses[response_status] = statuses.get(response_status, 0) + 1
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            # The handlers log every action, which would drown the report.
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                await asyncio.gather(*[worker(session) for _ in range(concurrency)])
+                seconds = time.perf_counter() - start
+    finally:
+        constants.GITHUB_API_URL = previous_api_url
+        await marvin_runner.cleanup()
+        await github_runner.cleanup()
+    latencies.sort()
+    return {
+        "deliveries": len(latencies),
+        "statuses": statuses,
+        "deliveries_per_second": len(latencies) / seconds,
+        "latency_p50_seconds": replay.percentile(latencies, 0.5),
+        "latency_p99_seconds": replay.percentile(latencies, 0.99),
+    }
+
+
+def measure(
+    loop: str,
+    deliveries: int,
+    concurrency: int,
+    pulls: int,
+    latency_seconds: float,
+) -> Dict[str, Any]:
+    """Measure webhook throughput and a triage cycle on an event loop."""
+    in_use = event_loop.install(loop)
+    # Apply status changes right away and start no triage runs in the
+    # background, only the webhook path is measured here.
+    window_seconds = status.coalescer.window_seconds
+    status.coalescer.window_seconds = 0
+    scheduler = triage_runner.scheduler
+    triage_runner.scheduler = triage_runner.TriageScheduler(1, 0)
+    triage_runner.scheduler.stop()
+    settle_seconds = constants.SEARCH_INDEX_SETTLE_SECONDS
+    pacing_seconds = constants.REVIEWER_SEARCH_PACING_SECONDS
+    constants.SEARCH_INDEX_SETTLE_SECONDS = 0
+    constants.REVIEWER_SEARCH_PACING_SECONDS = 0
+    try:
+        webhooks = asyncio.run(
+            send_deliveries(
+                list(corpus.generate(deliveries)), latency_seconds, concurrency
+            )
+        )
+        fake = github.FakeGitHub(latency_seconds=latency_seconds, search_limit=10000)
+        fake.seed(pulls, reviewers=list(team.roster.by_login))
+        cycle = asyncio.run(triage.run_cycle(fake))
+    finally:
+        status.coalescer.window_seconds = window_seconds
+        triage_runner.scheduler = scheduler
+        constants.SEARCH_INDEX_SETTLE_SECONDS = settle_seconds
+        constants.REVIEWER_SEARCH_PACING_SECONDS = pacing_seconds
+        event_loop.install("asyncio")
+    return {
+        "event_loop": in_use,
+        "webhooks": webhooks,
+        "triage_seconds": cycle["seconds"],
+        "triage_api_calls": cycle["api_calls"],
+        "triage_error": cycle["error"],
+    }
+
+
+def available_loops() -> List[str]:
+    loops = ["asyncio"]
+    try:
+        import uvloop  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        loops.append("uvloop")
+    return loops
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--deliveries", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--pulls", type=int, default=2000, help="PRs to seed")
+    parser.add_argument("--latency", type=float, default=0, help="in seconds")
+    parser.add_argument("--json", action="store_true", help="print JSON")
+    args = parser.parse_args()
+    reports = [
+        measure(loop, args.deliveries, args.concurrency, args.pulls, args.latency)
+        for loop in available_loops()
+    ]
+    if args.json:
+        print(json.dumps(reports, indent=2))
+        return
+    for report in reports:
+        webhooks = report["webhooks"]
+        print(
+            f"{report['event_loop']:<8} "
+            f"{webhooks['deliveries_per_second']:8.1f} deliveries/s  "
+            f"p50 {webhooks['latency_p50_seconds'] * 1000:6.1f} ms  "
+            f"p99 {webhooks['latency_p99_seconds'] * 1000:6.1f} ms  "
+            f"triage {report['triage_seconds']:6.2f} s"
+        )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,572 @@
+"""A stand-in for the parts of the GitHub API marvin uses.
+
+Tests and benchmarks use it to exercise marvin without network access, either
+in-process (InProcessGitHubAPI) or over HTTP (benchmarks/server.py). Requests
+are routed by method and path to handlers operating on a simple model of a
+repository with pull requests and their labels, comments and requested
+reviewers, as well as gists.
+
+Latency, the lag of the search index and rate limits are configurable.
+"""
+
+import asyncio
+import bisect
+from datetime import datetime
+from datetime import timezone
+import json
+import operator
+import random
+import re
+import time
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import FrozenSet
+from typing import Iterable
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Set
+from typing import Tuple
+import urllib.parse
+import zlib
+
+from gidgethub.aiohttp import GitHubAPI
+
+from marvin import constants
+from marvin import gh_util
+
+API_URL = "https://api.github.com"
+REPOSITORY = "NixOS/nixpkgs"
+STATUS_LABELS = [
+    "needs_reviewer",
+    "awaiting_reviewer",
+    "awaiting_changes",
+    "needs_merger",
+    "awaiting_merger",
+]
+# GitHub never returns more than this many search results.
+MAX_SEARCH_RESULTS = 1000
+# Comparisons in search qualifiers, longest prefix first.
+COMPARISONS: List[Tuple[str, Callable[[float, float], bool]]] = [
+    (">=", operator.ge),
+    ("<=", operator.le),
+    (">", operator.gt),
+    ("<", operator.lt),
+]
+
+Response = Tuple[int, Dict[str, str], bytes]
+
+
+def format_time(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%SZ"
+    )
+
+
+def parse_time(text: str) -> float:
+    """Parse a date or time as used in search qualifiers.
+
+    >>> parse_time("1970-01-02")
+    86400.0
+    >>> parse_time("1970-01-01T01:00:00+01:00")
+    0.0
+    """
+    if "T" not in text:
+        text += "T00:00:00+00:00"
+    parsed = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+class PullRequest:
+    def __init__(
+        self, number: int, author: str, created_at: float, labels: Iterable[str] = ()
+    ) -> None:
+        self.number = number
+        self.title = f"Pull request {number}"
+        self.author = author
+        self.created_at = created_at
+        self.updated_at = created_at
+        self.state = "open"
+        self.merged_at: Optional[float] = None
+        self.labels: Set[str] = set(labels)
+        # The labels over time, as seen by the (lagging) search index.
+        self._label_history: List[Tuple[float, FrozenSet[str]]] = [
+            (created_at, frozenset(self.labels))
+        ]
+        self.comments: List[Tuple[str, str]] = []
+        self.requested_reviewers: List[str] = []
+
+    @property
+    def involved(self) -> Set[str]:
+        """Users that `involves:` finds this pull request for."""
+        return (
+            {self.author}
+            | {author for author, _ in self.comments}
+            | set(self.requested_reviewers)
+        )
+
+    def touch(self, now: float) -> None:
+        self.updated_at = max(self.updated_at, now)
+
+    def set_labels(self, labels: Set[str], now: float) -> None:
+        self.labels = labels
+        self._label_history.append((now, frozenset(labels)))
+        self.touch(now)
+
+    def labels_at(self, timestamp: float) -> FrozenSet[str]:
+        index = bisect.bisect_right(
+            [changed_at for changed_at, _ in self._label_history], timestamp
+        )
+        return self._label_history[max(0, index - 1)][1]
+
+
+class FakeGitHub:
+    """The state of a fake GitHub and the handlers of its API.
+
+    `latency_seconds` delays every response, `index_lag_seconds` delays label
+    changes showing up in the search and the rate limits are applied per
+    resource like GitHub does for a single installation.
+    """
+
+    def __init__(
+        self,
+        repository: str = REPOSITORY,
+        collaborators: Optional[Set[str]] = None,
+        latency_seconds: float = 0,
+        index_lag_seconds: float = 0,
+        core_limit: int = 5000,
+        search_limit: int = 30,
+    ) -> None:
+        self.repository = repository
+        # The URL under which the API is reachable, used to build URLs in
+        # responses.
+        self.api_url = API_URL
+        # Reviews can only be requested from collaborators. Without a set of
+        # collaborators, everybody is one.
+        self.collaborators = collaborators
+        self.latency_seconds = latency_seconds
+        self.index_lag_seconds = index_lag_seconds
+        self.pulls: Dict[int, PullRequest] = dict()
+        self.gists: Dict[str, str] = dict()
+        # Attempts to deliver webhooks to the app, oldest first.
+        self.deliveries: List[Dict[str, Any]] = []
+        self.requests = 0
+        # Per resource: limit, length of the window, remaining and reset time.
+        self.rate_limits: Dict[str, List[float]] = {
+            "core": [core_limit, 60 * 60, core_limit, 0],
+            "search": [search_limit, 60, search_limit, 0],
+        }
+        routes: List[Tuple[str, str, Callable[..., Response]]] = [
+            ("POST", r"/app/installations/(?P<id>\d+)/access_tokens", self.token),
+            ("GET", r"/installation/repositories", self.repositories),
+            ("GET", r"/app/hook/deliveries", self.list_deliveries),
+            ("GET", r"/app/hook/deliveries/(?P<id>\d+)", self.get_delivery),
+            ("GET", r"/rate_limit", self.rate_limit),
+            ("GET", r"/search/issues", self.search_issues),
+            ("GET", r"/gists/(?P<gist_id>[^/]+)", self.gist),
+            ("GET", r"/repos/{repo}/issues/(?P<number>\d+)/labels", self.labels),
+            ("POST", r"/repos/{repo}/issues/(?P<number>\d+)/labels", self.add_labels),
+            (
+                "DELETE",
+                r"/repos/{repo}/issues/(?P<number>\d+)/labels/(?P<name>[^/]+)",
+                self.remove_label,
+            ),
+            (
+                "POST",
+                r"/repos/{repo}/issues/(?P<number>\d+)/comments",
+                self.add_comment,
+            ),
+            (
+                "POST",
+                r"/repos/{repo}/pulls/(?P<number>\d+)/requested_reviewers",
+                self.request_reviewers,
+            ),
+        ]
+        self._routes = [
+            (method, re.compile(pattern.format(repo=re.escape(repository)) + "$"), f)
+            for method, pattern, f in routes
+        ]
+
+    def seed(
+        self,
+        count: int,
+        reviewers: Iterable[str] = (),
+        seed: int = 0,
+        now: Optional[float] = None,
+    ) -> None:
+        """Add `count` opted-in pull requests in random states.
+
+        The pull requests were created within the last 90 days. Some of them
+        involve the given reviewers.
+        """
+        rng = random.Random(seed)
+        now = time.time() if now is None else now
+        reviewers = list(reviewers)
+        first = max(self.pulls, default=100000) + 1
+        for number in range(first, first + count):
+            created_at = now - rng.uniform(0, 90 * 24 * 60 * 60)
+            labels = {"marvin", rng.choice(STATUS_LABELS)}
+            if rng.random() < 0.1:
+                labels.add("timeout_pending")
+            pull = PullRequest(number, f"contributor{number % 500}", created_at, labels)
+            pull.updated_at = rng.uniform(created_at, now)
+            if len(reviewers) > 0 and rng.random() < 0.2:
+                pull.comments.append((rng.choice(reviewers), "LGTM"))
+            self.pulls[number] = pull
+
+    def add_delivery(
+        self,
+        event: str,
+        payload: Dict[str, Any],
+        status_code: int = 200,
+        guid: Optional[str] = None,
+        delivered_at: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """Record an attempt to deliver a webhook to the app.
+
+        Pass the `guid` of an earlier attempt for a redelivery.
+        """
+        delivery = {
+            "id": len(self.deliveries) + 1,
+            "guid": f"guid-{len(self.deliveries) + 1}" if guid is None else guid,
+            "delivered_at": format_time(
+                time.time() if delivered_at is None else delivered_at
+            ),
+            "redelivery": guid is not None,
+            "duration": 0.1,
+            "status": "OK" if status_code == 200 else f"HTTP {status_code}",
+            "status_code": status_code,
+            "event": event,
+            "action": payload.get("action"),
+            "installation_id": payload.get("installation", {}).get("id"),
+            "repository_id": None,
+            "request": {"headers": {}, "payload": payload},
+            "response": {"headers": {}, "payload": ""},
+        }
+        self.deliveries.append(delivery)
+        return delivery
+
+    def pull(self, number: int) -> PullRequest:
+        if number not in self.pulls:
+            self.pulls[number] = PullRequest(number, "somebody", time.time())
+        return self.pulls[number]
+
+    def issue_url(self, number: int) -> str:
+        return f"{self.api_url}/repos/{self.repository}/issues/{number}"
+
+    def issue(self, pull: PullRequest, labels: Iterable[str]) -> Dict[str, Any]:
+        """Render a pull request as returned by the issue search."""
+        issue_url = self.issue_url(pull.number)
+        return {
+            "url": issue_url,
+            "repository_url": f"{self.api_url}/repos/{self.repository}",
+            "comments_url": issue_url + "/comments",
+            "number": pull.number,
+            "title": pull.title,
+            "user": {"login": pull.author, "id": zlib.crc32(pull.author.encode())},
+            "labels": [{"name": name} for name in sorted(labels)],
+            "state": pull.state,
+            "comments": len(pull.comments),
+            "created_at": format_time(pull.created_at),
+            "updated_at": format_time(pull.updated_at),
+            "pull_request": {
+                "url": f"{self.api_url}/repos/{self.repository}/pulls/{pull.number}"
+            },
+        }
+
+    async def request(
+        self, method: str, url: str, body: bytes, headers: Mapping[str, str] = {}
+    ) -> Response:
+        """Answer an API request after the configured latency."""
+        if self.latency_seconds > 0:
+            await asyncio.sleep(self.latency_seconds)
+        return self.handle(method, url, body, headers)
+
+    def handle(
+        self, method: str, url: str, body: bytes, headers: Mapping[str, str] = {}
+    ) -> Response:
+        self.requests += 1
+        headers = {name.lower(): value for name, value in headers.items()}
+        parts = urllib.parse.urlsplit(url)
+        path = urllib.parse.unquote(parts.path)
+        query = dict(urllib.parse.parse_qsl(parts.query))
+        data = json.loads(body) if body else None
+        for route_method, pattern, handler in self._routes:
+            match = pattern.match(path)
+            if route_method == method and match is not None:
+                break
+        else:
+            return json_response({"message": "Not Found"}, status=404)
+        if handler == self.rate_limit:
+            # Checking the rate limit does not count against it.
+            return handler()
+        resource = "search" if path.startswith("/search/") else "core"
+        limit, window, remaining, reset = self.rate_limits[resource]
+        now = time.time()
+        if now >= reset:
+            remaining, reset = limit, now + window
+        if remaining > 0:
+            response = handler(
+                data=data, query=query, headers=headers, **match.groupdict()
+            )
+            # Conditional requests that find no change are free.
+            if response[0] != 304:
+                remaining -= 1
+        else:
+            message = f"API rate limit exceeded for {resource}."
+            response = json_response({"message": message}, status=403)
+        self.rate_limits[resource][2:] = [remaining, reset]
+        response[1].update(
+            {
+                "x-ratelimit-limit": str(int(limit)),
+                "x-ratelimit-remaining": str(int(remaining)),
+                "x-ratelimit-reset": str(int(reset)),
+                "x-ratelimit-used": str(int(limit - remaining)),
+                "x-ratelimit-resource": resource,
+            }
+        )
+        return response
+
+    def token(self, id: str, **kwargs: Any) -> Response:
+        return json_response(
+            {"token": f"token-{id}", "expires_at": "2100-01-01T00:00:00Z"}, status=201
+        )
+
+    def repositories(self, **kwargs: Any) -> Response:
+        repositories = [{"full_name": self.repository}]
+        return json_response({"total_count": 1, "repositories": repositories})
+
+    def list_deliveries(self, query: Dict[str, str], **kwargs: Any) -> Response:
+        """List delivery attempts newest first, paginated with a cursor."""
+        per_page = min(100, int(query.get("per_page", "30")))
+        cursor = int(query.get("cursor", str(len(self.deliveries) + 1)))
+        older = [
+            delivery
+            for delivery in reversed(self.deliveries)
+            if delivery["id"] < cursor
+        ]
+        page = older[:per_page]
+        response = json_response(
+            [
+                {
+                    key: value
+                    for key, value in delivery.items()
+                    if key not in ("request", "response")
+                }
+                for delivery in page
+            ]
+        )
+        if len(older) > per_page:
+            page_query = urllib.parse.urlencode(
+                {"per_page": str(per_page), "cursor": str(page[-1]["id"])}
+            )
+            next_url = f"{self.api_url}/app/hook/deliveries?{page_query}"
+            response[1]["link"] = f'<{next_url}>; rel="next"'
+        return response
+
+    def get_delivery(self, id: str, **kwargs: Any) -> Response:
+        if not 0 < int(id) <= len(self.deliveries):
+            return json_response({"message": "Not Found"}, status=404)
+        return json_response(self.deliveries[int(id) - 1])
+
+    def rate_limit(self) -> Response:
+        now = time.time()
+        resources = dict()
+        for resource, (limit, window, remaining, reset) in self.rate_limits.items():
+            if now >= reset:
+                remaining, reset = limit, now + window
+            resources[resource] = {
+                "limit": int(limit),
+                "remaining": int(remaining),
+                "reset": int(reset),
+                "used": int(limit - remaining),
+            }
+        return json_response({"resources": resources, "rate": resources["core"]})
+
+    def gist(self, gist_id: str, headers: Dict[str, str], **kwargs: Any) -> Response:
+        if gist_id not in self.gists:
+            return json_response({"message": "Not Found"}, status=404)
+        content = self.gists[gist_id]
+        etag = f'"{zlib.crc32(content.encode()):08x}"'
+        if headers.get("if-none-match") == etag:
+            return 304, {"etag": etag}, b""
+        files = {"gistfile1.txt": {"content": content}}
+        response = json_response({"id": gist_id, "files": files})
+        response[1]["etag"] = etag
+        return response
+
+    def search_issues(self, query: Dict[str, str], **kwargs: Any) -> Response:
+        matches = search(
+            self.pulls.values(),
+            query.get("q", ""),
+            indexed_at=time.time() - self.index_lag_seconds,
+            repository=self.repository,
+        )
+        if "sort" in query:
+            reverse = query.get("order", "desc") == "desc"
+            matches.sort(key=sort_key(query["sort"]), reverse=reverse)
+        matches = matches[:MAX_SEARCH_RESULTS]
+
+        per_page = min(100, int(query.get("per_page", "30")))
+        page = int(query.get("page", "1"))
+        page_matches = matches[(page - 1) * per_page : page * per_page]
+        items = [self.issue(pull, labels) for pull, labels in page_matches]
+        response = json_response(
+            {
+                "total_count": len(matches),
+                "incomplete_results": False,
+                "items": items,
+            }
+        )
+        last_page = max(1, -(-len(matches) // per_page))
+        if page < last_page:
+
+            def page_url(number: int) -> str:
+                page_query = urllib.parse.urlencode(
+                    dict(query, per_page=str(per_page), page=str(number))
+                )
+                return f"{self.api_url}/search/issues?{page_query}"
+
+            response[1]["link"] = (
+                f'<{page_url(page + 1)}>; rel="next", '
+                f'<{page_url(last_page)}>; rel="last"'
+            )
+        return response
+
+    def labels(self, number: str, **kwargs: Any) -> Response:
+        pull = self.pull(int(number))
+        return json_response([{"name": name} for name in sorted(pull.labels)])
+
+    def add_labels(self, number: str, data: Dict[str, Any], **kwargs: Any) -> Response:
+        pull = self.pull(int(number))
+        pull.set_labels(pull.labels | set(data["labels"]), time.time())
+        return json_response([{"name": name} for name in sorted(pull.labels)])
+
+    def remove_label(self, number: str, name: str, **kwargs: Any) -> Response:
+        pull = self.pull(int(number))
+        if name not in pull.labels:
+            return json_response({"message": "Label does not exist"}, status=404)
+        pull.set_labels(pull.labels - {name}, time.time())
+        return json_response([{"name": name} for name in sorted(pull.labels)])
+
+    def add_comment(self, number: str, data: Dict[str, Any], **kwargs: Any) -> Response:
+        pull = self.pull(int(number))
+        now = time.time()
+        pull.comments.append((constants.BOT_NAME, data["body"]))
+        pull.touch(now)
+        comment = {
+            "id": len(pull.comments),
+            "body": data["body"],
+            "created_at": format_time(now),
+        }
+        return json_response(comment, status=201)
+
+    def request_reviewers(
+        self, number: str, data: Dict[str, Any], **kwargs: Any
+    ) -> Response:
+        pull = self.pull(int(number))
+        reviewers = data["reviewers"]
+        if self.collaborators is not None and not self.collaborators.issuperset(
+            reviewers
+        ):
+            return json_response(
+                {
+                    "message": "Reviews may only be requested from collaborators. "
+                    f"One or more of the users or teams you specified is not a "
+                    f"collaborator of the {self.repository} repository."
+                },
+                status=422,
+            )
+        pull.requested_reviewers.extend(reviewers)
+        pull.touch(time.time())
+        return json_response({"number": pull.number}, status=201)
+
+
+def _compare(value: Optional[float], qualifier: str) -> bool:
+    """Check a time against a qualifier value such as ">=2020-01-01"."""
+    if value is None:
+        return False
+    for prefix, compare in COMPARISONS:
+        if qualifier.startswith(prefix):
+            return compare(value, parse_time(qualifier[len(prefix) :]))
+    return parse_time(qualifier) <= value < parse_time(qualifier) + 24 * 60 * 60
+
+
+def sort_key(field: str) -> Callable[[Tuple[PullRequest, FrozenSet[str]]], Any]:
+    return lambda match: getattr(match[0], field + "_at")
+
+
+def search(
+    pulls: Iterable[PullRequest], q: str, indexed_at: float, repository: str
+) -> List[Tuple[PullRequest, FrozenSet[str]]]:
+    """Find the pull requests matching a search query.
+
+    Supports the repo, is, label, involves, created, updated and merged
+    qualifiers (optionally negated) as well as sort. Labels are matched as of
+    `indexed_at`. Returns the matches with their indexed labels.
+    """
+    terms = q.split()
+    sort = None
+    for term in terms:
+        if term.startswith("sort:"):
+            sort = term[len("sort:") :]
+    matches = []
+    for pull in pulls:
+        labels = pull.labels_at(indexed_at)
+        for term in terms:
+            negated = term.startswith("-")
+            key, _, value = term.lstrip("-").partition(":")
+            if key == "repo":
+                matched = value == repository
+            elif key == "is":
+                matched = value in {"pr", pull.state} or (
+                    value == "merged" and pull.merged_at is not None
+                )
+            elif key == "label":
+                matched = value in labels
+            elif key == "involves":
+                matched = value in pull.involved
+            elif key in ("created", "updated", "merged"):
+                matched = _compare(getattr(pull, key + "_at"), value)
+            else:
+                continue
+            if matched == negated:
+                break
+        else:
+            matches.append((pull, labels))
+    if sort is not None:
+        field, _, order = sort.partition("-")
+        matches.sort(key=sort_key(field), reverse=order != "asc")
+    return matches
+
+
+def json_response(data: Any, status: int = 200) -> Response:
+    headers = {"content-type": "application/json; charset=utf-8"}
+    return status, headers, json.dumps(data).encode()
+
+
+class _InProcessTransport(GitHubAPI):
+    """Send requests to a FakeGitHub instead of over the network."""
+
+    github: FakeGitHub
+
+    async def _request(
+        self, method: str, url: str, headers: Mapping[str, str], body: bytes = b""
+    ) -> Tuple[int, Mapping[str, str], bytes]:
+        return await self.github.request(method, url, body, headers)
+
+
+class InProcessGitHubAPI(gh_util.InstrumentedGitHubAPI, _InProcessTransport):
+    """An instrumented GitHubAPI that talks to a FakeGitHub in this process.
+
+    Requests are still instrumented and traced, so API calls are counted just
+    as in production.
+    """
+
+    def __init__(self, github: FakeGitHub) -> None:
+        # Requests never reach the session.
+        super().__init__(None, constants.BOT_NAME, base_url=github.api_url)
+        self.github = github
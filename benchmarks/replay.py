@@ -0,0 +1,175 @@
+"""Replay a corpus of webhook deliveries and measure how marvin handles them.
+
+The corpus is a JSONL file with one delivery per line, as recorded with
+WEBHOOK_RECORD_PATH. Without a corpus, a synthetic one is generated. The
+deliveries are handled just like in process_webhook, but against an
+in-process fake GitHub, so no network access is needed:
+
+    $ python3 -m benchmarks.replay [corpus.jsonl] [--json]
+
+Reports throughput, latency percentiles, GitHub API calls per event and the
+memory high-water mark of the process.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import math
+import resource
+import sys
+import time
+import traceback
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Sequence
+
+from gidgethub import sansio
+
+from benchmarks import corpus
+from benchmarks import github
+from marvin import __main__ as main
+from marvin import status
+from marvin import tracing
+
+
+def percentile(sorted_values: Sequence[float], fraction: float) -> float:
+    """Get a percentile of sorted values by the nearest-rank method.
+
+    >>> percentile([1, 2, 3, 4], 0.5)
+    2
+    >>> percentile([1, 2, 3, 4], 0.99)
+    4
+    """
+    if len(sorted_values) == 0:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def max_rss_bytes() -> int:
+    """The memory high-water mark of this process."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def load(path: str) -> List[Dict[str, Any]]:
+    with open(path) as corpus_file:
+        return [json.loads(line) for line in corpus_file if line.strip() != ""]
+
+
+def event_kind(delivery: Dict[str, Any]) -> str:
+    return f"{delivery['event']}.{delivery['payload'].get('action', 'none')}"
+
+
+async def replay(
+    deliveries: Iterable[Dict[str, Any]], concurrency: int = 1
+) -> Dict[str, Any]:
+    """Handle deliveries with up to `concurrency` at a time and report on it."""
+    gh = github.InProcessGitHubAPI(github.FakeGitHub())
+    latencies: List[float] = []
+    events_by_kind: Dict[str, int] = dict()
+    errors = 0
+    calls_before = dict(tracing.CALLS_BY_CAUSE.values)
+    pending = iter(deliveries)
+
+    async def worker() -> None:
+        nonlocal errors
+        for delivery in pending:
+            kind = event_kind(delivery)
+            events_by_kind[kind] = events_by_kind.get(kind, 0) + 1
+            event = sansio.Event(
+                delivery["payload"],
+                event=delivery["event"],
+                delivery_id=delivery["delivery_id"],
+            )
+            token = f"token-{delivery['payload']['installation']['id']}"
+            start = time.perf_counter()
+            try:
+                with tracing.cause(kind, event.delivery_id):
+                    await main.handle_event(event, gh, token)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    # The handlers log every action, which would drown the report.
+    with contextlib.redirect_stdout(io.StringIO()):
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    seconds = time.perf_counter() - start
+
+    calls_by_kind = {
+        kind: tracing.CALLS_BY_CAUSE.values.get((kind,), 0)
+        - calls_before.get((kind,), 0)
+        for kind in events_by_kind
+    }
+    latencies.sort()
+    events = len(latencies)
+    return {
+        "events": events,
+        "errors": errors,
+        "seconds": seconds,
+        "events_per_second": events / seconds if seconds > 0 else 0.0,
+        "latency_p50_seconds": percentile(latencies, 0.5),
+        "latency_p99_seconds": percentile(latencies, 0.99),
+        "api_calls_per_event": sum(calls_by_kind.values()) / max(1, events),
+        "api_calls_per_event_kind": {
+            kind: calls_by_kind[kind] / count
+            for kind, count in sorted(events_by_kind.items())
+        },
+        "max_rss_bytes": max_rss_bytes(),
+    }
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(f"events:              {report['events']} ({report['errors']} errors)")
+    print(f"events/sec:          {report['events_per_second']:.1f}")
+    print(f"latency p50:         {report['latency_p50_seconds'] * 1000:.2f} ms")
+    print(f"latency p99:         {report['latency_p99_seconds'] * 1000:.2f} ms")
+    print(f"API calls/event:     {report['api_calls_per_event']:.2f}")
+    for kind, calls in report["api_calls_per_event_kind"].items():
+        print(f"  {kind:<35} {calls:.2f}")
+    print(f"memory high-water:   {report['max_rss_bytes'] / 2 ** 20:.1f} MiB")
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("corpus", nargs="?", help="JSONL file of deliveries")
+    parser.add_argument(
+        "--generate",
+        type=int,
+        default=2000,
+        metavar="N",
+        help="number of synthetic deliveries to use without a corpus",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument(
+        "--coalesce-seconds",
+        type=float,
+        default=0,
+        help="status coalescing window; the default measures the handling "
+        "cost rather than the time spent waiting for the window to close",
+    )
+    parser.add_argument("--json", action="store_true", help="print JSON")
+    args = parser.parse_args()
+
+    if args.corpus is not None:
+        deliveries = load(args.corpus)
+    else:
+        deliveries = list(corpus.generate(args.generate, args.seed))
+    status.coalescer.window_seconds = args.coalesce_seconds
+    report = asyncio.run(replay(deliveries, args.concurrency))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,63 @@
+"""Serve a FakeGitHub over HTTP.
+
+This allows running marvin itself against the fake, e.g. for load tests:
+
+    $ python3 -m benchmarks.server --pulls 5000 --latency 0.05 --port 8000
+    $ GITHUB_API_URL=http://localhost:8000 python3 -m marvin
+"""
+
+import argparse
+
+from aiohttp import web
+
+from benchmarks import github
+from marvin import team
+
+
+def make_app(fake: github.FakeGitHub) -> web.Application:
+    """Make an application that answers all requests with the fake."""
+
+    async def handle(request: web.Request) -> web.Response:
+        status, headers, body = await fake.request(
+            request.method, str(request.rel_url), await request.read(), request.headers
+        )
+        return web.Response(status=status, headers=headers, body=body)
+
+    async def set_api_url(app: web.Application) -> None:
+        # Only known once the server is started.
+        if app["api_url"] is not None:
+            fake.api_url = app["api_url"]
+
+    app = web.Application()
+    app["api_url"] = None
+    app.router.add_route("*", "/{path:.*}", handle)
+    app.on_startup.append(set_api_url)
+    return app
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(description="Serve a fake GitHub API.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--pulls", type=int, default=5000, help="PRs to seed")
+    parser.add_argument("--latency", type=float, default=0, help="in seconds")
+    parser.add_argument(
+        "--index-lag", type=float, default=0, help="search index lag in seconds"
+    )
+    parser.add_argument("--core-limit", type=int, default=5000)
+    parser.add_argument("--search-limit", type=int, default=30)
+    args = parser.parse_args()
+
+    fake = github.FakeGitHub(
+        latency_seconds=args.latency,
+        index_lag_seconds=args.index_lag,
+        core_limit=args.core_limit,
+        search_limit=args.search_limit,
+    )
+    fake.seed(args.pulls, reviewers=list(team.roster.by_login))
+    app = make_app(fake)
+    app["api_url"] = f"http://localhost:{args.port}"
+    web.run_app(app, port=args.port)
+
+
+if __name__ == "__main__":
+    run()
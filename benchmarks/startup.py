@@ -0,0 +1,233 @@
+"""Measure how long marvin takes to start and handle its first delivery.
+
+marvin is started in a new process against a fake GitHub served from this
+process. A webhook delivery is sent as soon as the port accepts connections:
+
+    $ python3 -m benchmarks.startup [--runs 5] [--json]
+
+Reports the median times until the port accepts connections and until the
+first delivery was answered with a 200, and the median time it takes to
+import marvin.__main__ alone. Also reports which of the modules that are only
+loaded on demand were imported along with marvin.__main__ anyway.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+import aiohttp
+from aiohttp import web
+
+from benchmarks import corpus
+from benchmarks import github
+from benchmarks import server
+
+WEBHOOK_SECRET = "secret"
+
+# Slow to import or only needed in some configurations.
+DEFERRED_MODULES = (
+    "jwt",
+    "cryptography",
+    "cProfile",
+    "marvin.backfill",
+    "marvin.event_loop",
+    "marvin.leader",
+    "marvin.loop_monitor",
+    "marvin.profiling",
+    "marvin.workers",
+)
+
+
+def private_key() -> str:
+    """Generate a private key for the app, to sign real JWTs with."""
+    # Only needed here, and slow to import.
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def signed(delivery: Dict[str, Any]) -> Tuple[bytes, Dict[str, str]]:
+    """The body and headers of a delivery as GitHub would send it."""
+    body = json.dumps(delivery["payload"]).encode()
+    signature = hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    headers = {
+        "Content-Type": "application/json",
+        "X-GitHub-Event": delivery["event"],
+        "X-GitHub-Delivery": delivery["delivery_id"],
+        "X-Hub-Signature-256": f"sha256={signature}",
+    }
+    return body, headers
+
+
+async def deliver(
+    session: aiohttp.ClientSession, url: str, delivery: Dict[str, Any]
+) -> int:
+    body, headers = signed(delivery)
+    async with session.post(url, data=body, headers=headers) as response:
+        return response.status
+
+
+def localize(delivery: Dict[str, Any], api_url: str) -> Dict[str, Any]:
+    """Point the URLs in a generated delivery to a fake GitHub."""
+    payload = json.dumps(delivery["payload"]).replace(github.API_URL, api_url)
+    return dict(delivery, payload=json.loads(payload))
+
+
+async def start_marvin(
+    api_url: str, key: str, port: int, directory: str, log: Any, **env: str
+) -> asyncio.subprocess.Process:
+    """Start marvin against a fake GitHub, keeping its state in `directory`."""
+    return await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-m",
+        "marvin",
+        env=dict(
+            os.environ,
+            PORT=str(port),
+            GITHUB_API_URL=api_url,
+            WEBHOOK_SECRET=WEBHOOK_SECRET,
+            GH_APP_ID="1",
+            GH_PRIVATE_KEY=key,
+            DATABASE_PATH=os.path.join(directory, "marvin.sqlite"),
+            SEARCH_INDEX_SETTLE_SECONDS="0",
+            REVIEWER_SEARCH_PACING_SECONDS="0",
+            **env,
+        ),
+        stdout=log,
+        stderr=log,
+    )
+
+
+async def wait_until_listening(port: int, timeout_seconds: float) -> None:
+    deadline = time.monotonic() + timeout_seconds
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("localhost", port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.005)
+
+
+async def start_and_deliver(
+    api_url: str, key: str, timeout_seconds: float = 10
+) -> Tuple[float, float]:
+    """Start marvin and send it a delivery.
+
+    Returns the seconds until the port accepted connections and until the
+    delivery was answered.
+    """
+    [delivery] = corpus.generate(1)
+    delivery = localize(delivery, api_url)
+    port = free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "marvin.log"), "wb") as log:
+            start = time.perf_counter()
+            # Without waiting for status changes to coalesce.
+            process = await start_marvin(
+                api_url, key, port, directory, log, STATUS_COALESCE_SECONDS="0"
+            )
+        try:
+            await wait_until_listening(port, timeout_seconds)
+            listening = time.perf_counter() - start
+            async with aiohttp.ClientSession() as session:
+                url = f"http://localhost:{port}/webhook"
+                status = await deliver(session, url, delivery)
+            first_response = time.perf_counter() - start
+            if status != 200:
+                raise Exception(f"First delivery was answered with {status}")
+        finally:
+            process.send_signal(signal.SIGTERM)
+            await process.wait()
+    return listening, first_response
+
+
+def import_seconds() -> float:
+    """Measure the import of marvin.__main__ in a new interpreter."""
+    code = (
+        "import time; start = time.perf_counter(); import marvin.__main__; "
+        "print(time.perf_counter() - start)"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], check=True, stdout=subprocess.PIPE
+    ).stdout
+    return float(output.splitlines()[-1])
+
+
+def eager_imports() -> List[str]:
+    """The deferred modules that importing marvin.__main__ loads anyway."""
+    code = (
+        "import json, sys, marvin.__main__; "
+        f"print(json.dumps([name for name in {DEFERRED_MODULES!r} "
+        "if name in sys.modules]))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], check=True, stdout=subprocess.PIPE
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+async def measure(runs: int) -> Dict[str, Any]:
+    fake = github.FakeGitHub()
+    runner = web.AppRunner(server.make_app(fake))
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, "localhost", port).start()
+    fake.api_url = f"http://localhost:{port}"
+    key = private_key()
+    try:
+        starts = [await start_and_deliver(fake.api_url, key) for _ in range(runs)]
+    finally:
+        await runner.cleanup()
+    return {
+        "runs": runs,
+        "listening_seconds": statistics.median(listening for listening, _ in starts),
+        "first_response_seconds": statistics.median(first for _, first in starts),
+        "import_seconds": statistics.median(import_seconds() for _ in range(runs)),
+        "eager_imports": eager_imports(),
+    }
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print JSON")
+    args = parser.parse_args()
+    report = asyncio.run(measure(args.runs))
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,130 @@
+"""Measure reviewer selection and roster reloads with a large team.
+
+A roster with many members is written to a temporary file. Most members have
+exhausted their limit, as is common for a busy team, so get_reviewer has to
+skip over them. No GitHub API calls are made:
+
+    $ python3 -m benchmarks.team --members 500 [--json]
+
+Reports the time to (re)load the roster and the time per get_reviewer call.
+"""
+
+import argparse
+import asyncio
+import contextlib
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+import io
+import json
+import os
+import random
+import tempfile
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+
+from marvin import team
+
+
+def entries(members: int, available: float, seed: int = 0) -> List[Dict[str, Any]]:
+    """Generate roster entries, a fifth of them for merging.
+
+    A fraction of `available` members is not activity limited.
+
+    >>> [entry["can_merge"] for entry in entries(6, 0.1)]
+    [True, False, False, False, False, True]
+    >>> entries(1, 1.0)
+    [{'gh_name': 'reviewer0', 'can_merge': True}]
+    """
+    rng = random.Random(seed)
+    result: List[Dict[str, Any]] = []
+    for i in range(members):
+        entry: Dict[str, Any] = {"gh_name": f"reviewer{i}", "can_merge": i % 5 == 0}
+        if rng.random() >= available:
+            entry["days"] = rng.choice([1, 3, 7])
+            entry["limit"] = rng.randint(1, 10)
+        result.append(entry)
+    return result
+
+
+def measure(members: int, selections: int, available: float) -> Dict[str, Any]:
+    """Load a roster and select reviewers from it.
+
+    Only a fraction of `available` members has capacity left.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "team.json")
+        with open(path, "w") as roster_file:
+            json.dump(entries(members, available), roster_file)
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            roster = team.Roster(path)
+            load_seconds = time.perf_counter() - start
+
+            # Change the file by adding a member to force a reload.
+            with open(path, "w") as roster_file:
+                json.dump(entries(members + 1, available), roster_file)
+            os.utime(path, (time.time() + 1, time.time() + 1))
+            start = time.perf_counter()
+            roster.reload_if_changed()
+            reload_seconds = time.perf_counter() - start
+
+            # Exhaust all activity limits, so no searches are made.
+            exhausted_until = datetime.now(timezone.utc) + timedelta(days=1)
+            for member in roster.members:
+                if isinstance(member, team.ActivityLimitedReviewer):
+                    member.cached_no_until = exhausted_until
+
+            previous_roster = team.roster
+            team.roster = roster
+            try:
+                start = time.perf_counter()
+                found = asyncio.run(select(selections))
+                select_seconds = time.perf_counter() - start
+            finally:
+                team.roster = previous_roster
+    return {
+        "members": members,
+        "load_seconds": load_seconds,
+        "reload_seconds": reload_seconds,
+        "selections": selections,
+        "found": found,
+        "seconds_per_selection": select_seconds / selections,
+    }
+
+
+async def select(selections: int) -> int:
+    found = 0
+    issue = {"user": {"login": "reviewer1"}}
+    for i in range(selections):
+        reviewer = await team.get_reviewer(
+            None, "token", issue, merge_permission_needed=i % 2 == 0  # type: ignore
+        )
+        found += reviewer is not None
+    return found
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--members", type=int, default=500)
+    parser.add_argument("--selections", type=int, default=1000)
+    parser.add_argument(
+        "--available",
+        type=float,
+        default=0.1,
+        help="fraction of members with capacity left",
+    )
+    parser.add_argument("--json", action="store_true", help="print JSON")
+    args = parser.parse_args()
+    report = measure(args.members, args.selections, args.available)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,133 @@
+"""Measure a triage run against a fake GitHub seeded with many pull requests.
+
+The fake is served over HTTP on localhost, so the whole client stack is
+exercised:
+
+    $ python3 -m benchmarks.triage --pulls 2000 --latency 0.05 [--json]
+
+Reports the duration of the triage cycle and the GitHub API calls it made,
+per phase.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import time
+from typing import Any
+from typing import Dict
+
+import aiohttp
+from aiohttp import web
+
+from benchmarks import github
+from benchmarks import server
+from marvin import constants
+from marvin import gh_util
+from marvin import team
+from marvin import tracing
+from marvin import triage
+
+
+async def run_cycle(fake: github.FakeGitHub) -> Dict[str, Any]:
+    """Run triage once against the fake and report on it."""
+    app = server.make_app(fake)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    fake.api_url = f"http://{host}:{port}"
+
+    calls_before = dict(tracing.CALLS_BY_CAUSE.values)
+    requests_before = fake.requests
+    error = None
+    start = time.perf_counter()
+    try:
+        async with aiohttp.ClientSession() as session:
+            gh = gh_util.InstrumentedGitHubAPI(
+                session, constants.BOT_NAME, base_url=fake.api_url
+            )
+            # Triage logs every decision, which would drown the report.
+            with contextlib.redirect_stdout(io.StringIO()):
+                with tracing.cause("triage", "benchmark"):
+                    result = await triage.run_triage(gh, "token")
+    except Exception as e:
+        error = repr(e)
+    seconds = time.perf_counter() - start
+    await runner.cleanup()
+
+    calls_by_cause = {
+        cause: count - calls_before.get((cause,), 0)
+        for (cause,), count in tracing.CALLS_BY_CAUSE.values.items()
+        if cause.startswith("triage") and count > calls_before.get((cause,), 0)
+    }
+    report: Dict[str, Any] = {
+        "pulls": len(fake.pulls),
+        "error": error,
+        "seconds": seconds,
+        "api_calls": fake.requests - requests_before,
+        "api_calls_by_phase": calls_by_cause,
+    }
+    if error is None:
+        report.update(
+            status_changes=result.status_changes,
+            reminders=result.reminders,
+            review_requests=result.review_requests,
+            unassigned=result.unassigned,
+        )
+    return report
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark a triage cycle.")
+    parser.add_argument("--pulls", type=int, default=2000, help="PRs to seed")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0, help="in seconds")
+    parser.add_argument(
+        "--index-lag", type=float, default=0, help="search index lag in seconds"
+    )
+    parser.add_argument("--core-limit", type=int, default=5000)
+    parser.add_argument("--search-limit", type=int, default=30)
+    parser.add_argument(
+        "--settle-seconds",
+        type=float,
+        default=constants.SEARCH_INDEX_SETTLE_SECONDS,
+        help="time triage waits for the search index to catch up",
+    )
+    parser.add_argument(
+        "--pacing-seconds",
+        type=float,
+        default=constants.REVIEWER_SEARCH_PACING_SECONDS,
+        help="pause before each reviewer activity search",
+    )
+    parser.add_argument("--json", action="store_true", help="print JSON")
+    args = parser.parse_args()
+
+    constants.SEARCH_INDEX_SETTLE_SECONDS = args.settle_seconds
+    constants.REVIEWER_SEARCH_PACING_SECONDS = args.pacing_seconds
+    fake = github.FakeGitHub(
+        latency_seconds=args.latency,
+        index_lag_seconds=args.index_lag,
+        core_limit=args.core_limit,
+        search_limit=args.search_limit,
+    )
+    fake.seed(args.pulls, reviewers=list(team.roster.by_login), seed=args.seed)
+    report = asyncio.run(run_cycle(fake))
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in report.items():
+        if isinstance(value, dict):
+            print(f"{key}:")
+            for name, count in sorted(value.items()):
+                print(f"  {name:<35} {count}")
+        elif isinstance(value, float):
+            print(f"{key + ':':<20} {value:.2f}")
+        else:
+            print(f"{key + ':':<20} {value}")
+
+
+if __name__ == "__main__":
+    run()
@@ -1,23 +1,60 @@
+import argparse
+import asyncio
+import hmac
+import json
 import logging
 import os
 import sys
+import time
 import traceback
+from typing import Optional
 
 import aiohttp
 from aiohttp import web
-from gidgethub import apps
 from gidgethub import routing
 from gidgethub import sansio
 from gidgethub.aiohttp import GitHubAPI
 
+from marvin import admission
 from marvin import commands
 from marvin import constants
+from marvin import gh_util
+from marvin import metrics
+from marvin import outbox
+from marvin import queues
 from marvin import status
+from marvin import supervision
+from marvin import tracing
+from marvin import triage
 from marvin import triage_runner
 
 router = routing.Router(commands.router, status.router)
 routes = web.RouteTableDef()
 
+WEBHOOK_LATENCY = metrics.Histogram(
+    "marvin_webhook_latency_seconds",
+    "Time spent handling a webhook delivery by event and action.",
+    ["event", "action"],
+)
+WEBHOOKS_IN_FLIGHT = metrics.Gauge(
+    "marvin_webhooks_in_flight", "Webhook deliveries currently being handled."
+)
+WEBHOOKS_SHED = metrics.Counter(
+    "marvin_webhooks_shed",
+    "Webhook deliveries rejected because too many were being handled.",
+    ["event", "action"],
+)
+metrics.Gauge(
+    "marvin_outbox_pending",
+    "Mutations waiting in the outbox.",
+    function=lambda: outbox.outbox.pending() if outbox.outbox is not None else 0,
+)
+metrics.Gauge(
+    "marvin_triage_queue_length",
+    "Installations waiting for a triage run.",
+    function=lambda: triage_runner.scheduler.queue_length(),
+)
+
 
 def is_bot_comment(event: sansio.Event) -> bool:
     """Determine whether an event was triggered by our own comments."""
@@ -61,6 +98,22 @@ def is_opted_in(event: sansio.Event) -> bool:
     return False
 
 
+def has_commands(event: sansio.Event) -> bool:
+    """Determine whether an event contains commands for us.
+
+    Such events are handled with priority when under load.
+    """
+    comment = event.data.get(
+        "comment", event.data.get("review", event.data.get("pull_request"))
+    )
+    if comment is None or comment.get("body") is None:
+        return False
+    body = comment["body"]
+    if "/marvin opt-in" in body:
+        return True
+    return len(commands.command_router.find_commands(body)) > 0
+
+
 def log_event(event: sansio.Event) -> None:
     action = event.data.get("action")
     number = (
@@ -73,9 +126,36 @@ def log_event(event: sansio.Event) -> None:
     print(f"New event: #{number} {event.event}->{action}")
 
 
+def record_event(event: sansio.Event) -> None:
+    """Append a delivery to the recorded corpus (see benchmarks/replay.py)."""
+    with open(constants.WEBHOOK_RECORD_PATH, "a") as corpus:
+        record = {
+            "event": event.event,
+            "delivery_id": event.delivery_id,
+            "payload": event.data,
+        }
+        corpus.write(json.dumps(record) + "\n")
+
+
+async def handle_event(event: sansio.Event, gh: GitHubAPI, token: str) -> None:
+    """Route an event to its handlers, unless we should ignore it."""
+    if is_opted_in(event) and not is_bot_comment(event):
+        log_event(event)
+        # call the appropriate callback for the event
+        await router.dispatch(event, gh, token)
+
+
 @routes.post("/webhook")
 async def process_webhook(request: web.Request) -> web.Response:
+    start = time.perf_counter()
+    event_name = "invalid"
+    action = "none"
+    WEBHOOKS_IN_FLIGHT.inc()
     try:
+        if request.app["draining"]:
+            # Let GitHub redeliver to the next instance.
+            return web.Response(status=503, headers={"Retry-After": "60"})
+
         # read the GitHub webhook payload
         body = await request.read()
 
@@ -83,48 +163,321 @@ async def process_webhook(request: web.Request) -> web.Response:
         event = sansio.Event.from_http(
             request.headers, body, secret=request.app["webhook_secret"]
         )
+        event_name = event.event
+        action = event.data.get("action", "none")
+        if constants.WEBHOOK_RECORD_PATH != "":
+            record_event(event)
+
+        if not await admission.control.admit(priority=has_commands(event)):
+            print(f"Shedding {event_name}->{action} delivery {event.delivery_id}")
+            WEBHOOKS_SHED.inc(event_name, action)
+            # The delivery is not recorded as handled, so the backfill replays
+            # it once GitHub lists it as failed.
+            installation = event.data.get("installation")
+            if installation is not None:
+                triage_runner.scheduler.record_shed(installation["id"])
+            return web.Response(status=503, headers={"Retry-After": "60"})
+        try:
+            await handle_admitted(request.app, event, event_name, action)
+        finally:
+            admission.control.release()
+        if constants.BACKFILL_INTERVAL_SECONDS > 0:
+            from marvin import backfill
 
+            # GitHub gives up waiting after ten seconds and records a failure,
+            # which must not be replayed if we got there in the end.
+            backfill.log.record(event.delivery_id, backfill.subject_of(event))
+
+        # HTTP success
+        return web.Response(status=200)
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+        return web.Response(status=500)
+    finally:
+        WEBHOOKS_IN_FLIGHT.dec()
+        WEBHOOK_LATENCY.observe(time.perf_counter() - start, event_name, action)
+
+
+async def handle_admitted(
+    app: web.Application, event: sansio.Event, event_name: str, action: str
+) -> None:
+    """Handle a webhook delivery that was admitted by admission control."""
+    # Queue up instead of failing while GitHub appears to be down.
+    await gh_util.breaker.wait_closed()
+    with tracing.cause(f"{event_name}.{action}", event.delivery_id):
         async with aiohttp.ClientSession() as session:
-            gh = GitHubAPI(session, constants.BOT_NAME)
+            gh = gh_util.InstrumentedGitHubAPI(session, constants.BOT_NAME)
 
-            # Fetch the installation_access_token once for each webhook delivery.
-            # The token is valid for an hour, so it could be cached if we need to
-            # save some API calls.
+            # Fetch the installation_access_token once for each webhook
+            # delivery. The token is valid for an hour, so it could be
+            # cached if we need to save some API calls.
             installation_id = event.data["installation"]["id"]
-            installation_access_token = await apps.get_installation_access_token(
+            installation_access_token = await gh_util.get_installation_access_token(
                 gh,
                 installation_id=installation_id,
-                app_id=request.app["gh_app_id"],
-                private_key=request.app["gh_private_key"],
+                app_id=app["gh_app_id"],
+                private_key=app["gh_private_key"],
             )
             # Make sure a triage runner exists for this installation. Triage
             # runners are only started once at least one webhook event was
             # received. That's not ideal, but getting access to the list of
             # installations would otherwise be a pain.
-            if installation_id not in triage_runner.runners:
-                triage_runner.runners[installation_id] = triage_runner.TriageRunner(
-                    installation_id,
-                    gh_app_id=request.app["gh_app_id"],
-                    gh_private_key=request.app["gh_private_key"],
-                    min_delay_seconds=60,
-                    max_delay_seconds=60 * 60 * 6,
-                )
-                print(f"Starting a triage runner for installation {installation_id}")
-                triage_runner.runners[installation_id].start()
-
-            if is_opted_in(event) and not is_bot_comment(event):
-                log_event(event)
-                # call the appropriate callback for the event
-                await router.dispatch(event, gh, installation_access_token["token"])
-
-        if gh.rate_limit is not None:
-            print("GH rate limit remaining:", gh.rate_limit.remaining)
+            triage_runner.scheduler.add_installation(
+                installation_id,
+                gh_app_id=app["gh_app_id"],
+                gh_private_key=app["gh_private_key"],
+                min_delay_seconds=60,
+                max_delay_seconds=60 * 60 * 6,
+            )
 
-        # HTTP success
-        return web.Response(status=200)
-    except Exception:
-        traceback.print_exc(file=sys.stderr)
-        return web.Response(status=500)
+            await handle_event(event, gh, installation_access_token["token"])
+
+    if gh.rate_limit is not None:
+        print("GH rate limit remaining:", gh.rate_limit.remaining)
+
+
+@routes.get("/metrics")
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    return web.Response(
+        body=metrics.render().encode(), headers={"Content-Type": metrics.CONTENT_TYPE}
+    )
+
+
+@routes.get("/triage")
+async def triage_schedule(request: web.Request) -> web.Response:
+    """Report the currently chosen triage interval for each installation."""
+    runners = triage_runner.scheduler.runners
+    return web.json_response(
+        {
+            str(installation_id): {
+                "delay_seconds": runner.schedule.delay_seconds,
+                "reason": runner.schedule.reason,
+            }
+            for installation_id, runner in runners.items()
+        }
+    )
+
+
+@routes.get("/queues")
+async def queue_status(request: web.Request) -> web.Response:
+    """Report the size and the oldest pull request of each status queue.
+
+    The queues are served from the snapshots of the last triage run of each
+    repository, which costs no API calls. Polling clients should send the
+    ETag back in If-None-Match.
+    """
+    body, etag = queues.snapshots.render()
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={queues.CACHE_SECONDS}",
+    }
+    if_none_match = request.headers.get("If-None-Match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type="application/json", headers=headers)
+
+
+def check_debug_token(request: web.Request) -> None:
+    """Only allow access to debug endpoints with the configured token."""
+    debug_token = request.app.get("debug_token")
+    if debug_token is None:
+        raise web.HTTPNotFound()
+    authorization = request.headers.get("Authorization")
+    if authorization is None:
+        raise web.HTTPUnauthorized()
+    if not hmac.compare_digest(authorization, f"Bearer {debug_token}"):
+        raise web.HTTPForbidden()
+
+
+@routes.get("/debug/api-calls")
+async def debug_api_calls(request: web.Request) -> web.Response:
+    """Report recent GitHub API calls and how many calls each event causes.
+
+    The calls can be filtered by `cause` (e.g. "issue_comment.created") and
+    the number of reported calls is limited by `limit`.
+    """
+    check_debug_token(request)
+    calls = list(tracing.calls)
+    if "cause" in request.query:
+        calls = [call for call in calls if call.cause == request.query["cause"]]
+    try:
+        limit = int(request.query.get("limit", "100"))
+    except ValueError:
+        raise web.HTTPBadRequest(text="limit must be a number")
+    return web.json_response(
+        {
+            "summary": tracing.summary(),
+            "calls": [call.to_dict() for call in calls[-limit:]] if limit > 0 else [],
+        }
+    )
+
+
+@routes.get("/debug/profile")
+async def debug_profile(request: web.Request) -> web.Response:
+    """Profile the event loop for `seconds` (10 by default).
+
+    By default, the stacks of the event loop are sampled and returned in the
+    collapsed format of flamegraph tools. With `format=pstats`, every call is
+    profiled instead, which is more precise but slows the bot down meanwhile.
+    Either way, the tasks and the coroutines they wait on are snapshotted
+    afterwards.
+    """
+    check_debug_token(request)
+    # Only loaded when needed, to keep the startup fast.
+    from marvin import profiling
+
+    try:
+        seconds = float(request.query.get("seconds", "10"))
+    except ValueError:
+        raise web.HTTPBadRequest(text="seconds must be a number")
+    try:
+        result = await profiling.profile(
+            seconds, request.query.get("format", "collapsed")
+        )
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    except profiling.AlreadyProfiling:
+        raise web.HTTPConflict(text="Already profiling")
+    return web.json_response(result)
+
+
+def start_outbox(app: web.Application) -> None:
+    if outbox.outbox is not None:
+        outbox.outbox.start(app["gh_app_id"], app["gh_private_key"])
+
+
+async def replay_delivery(app: web.Application, event: sansio.Event) -> None:
+    await handle_admitted(app, event, event.event, event.data.get("action", "none"))
+
+
+def start_backfill(app: web.Application) -> None:
+    if constants.BACKFILL_INTERVAL_SECONDS > 0:
+        from marvin import backfill
+
+        app["backfill"] = asyncio.create_task(
+            supervision.supervise(
+                "backfill",
+                lambda: backfill.run_periodically(
+                    app["gh_app_id"],
+                    app["gh_private_key"],
+                    lambda event: replay_delivery(app, event),
+                    constants.BACKFILL_INTERVAL_SECONDS,
+                    constants.BACKFILL_MAX_AGE_SECONDS,
+                ),
+            )
+        )
+
+
+async def start_background_work(app: web.Application) -> None:
+    start_outbox(app)
+    start_backfill(app)
+
+
+async def start_loop_monitor(app: web.Application) -> None:
+    if constants.LOOP_MONITOR_INTERVAL_SECONDS > 0:
+        from marvin import loop_monitor
+
+        app["loop_monitor"] = loop_monitor.LoopMonitor(
+            constants.LOOP_MONITOR_INTERVAL_SECONDS, constants.SLOW_CALLBACK_SECONDS
+        )
+        app["loop_monitor"].start()
+
+
+async def stop_loop_monitor(app: web.Application) -> None:
+    if "loop_monitor" in app:
+        app["loop_monitor"].stop()
+
+
+async def drain(app: web.Application) -> None:
+    """Finish the work in progress before shutting down.
+
+    New deliveries are turned away, open status coalescing windows are closed
+    and running triage stops after its current phase. Then the in-flight
+    deliveries, the triage runs and the due outbox entries are given until
+    the shutdown deadline to finish.
+    """
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + constants.SHUTDOWN_TIMEOUT_SECONDS
+    print("Shutting down, draining in-flight work")
+    app["draining"] = True
+    if "backfill" in app:
+        app["backfill"].cancel()
+    triage.stopping = True
+    triage_runner.scheduler.stop()
+    status.coalescer.window_seconds = 0
+    await status.coalescer.flush_all()
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(admission.control.idle(), triage_runner.scheduler.drain()),
+            deadline - loop.time(),
+        )
+        if outbox.outbox is not None:
+            await asyncio.wait_for(outbox.outbox.stop(), deadline - loop.time())
+    except asyncio.TimeoutError:
+        print("Shutdown deadline exceeded, cancelling the remaining work")
+    else:
+        print("Drained in-flight work")
+
+
+async def start_leader_election(app: web.Application) -> None:
+    """Run triage and the outbox in this worker once it becomes the leader."""
+    from marvin import leader
+
+    lease = leader.Lease(
+        constants.DATABASE_PATH, "triage", constants.LEADER_LEASE_SECONDS
+    )
+    app["lease"] = lease
+    shared_queue = triage_runner.scheduler
+    assert isinstance(shared_queue, triage_runner.SharedTriageQueue)
+    shared_outbox = outbox.outbox
+    assert shared_outbox is not None
+    # Entries may be recorded by other workers.
+    shared_outbox.poll_seconds = shared_queue.poll_seconds
+
+    def elected() -> None:
+        shared_queue.lead(app["gh_app_id"], app["gh_private_key"])
+        shared_outbox.start(app["gh_app_id"], app["gh_private_key"])
+        start_backfill(app)
+
+    app["leader_election"] = asyncio.create_task(leader.campaign(lease, elected))
+
+
+async def stop_leader_election(app: web.Application) -> None:
+    app["leader_election"].cancel()
+    app["lease"].release()
+
+
+def run_worker(app: web.Application, port: Optional[int], worker_count: int) -> None:
+    """Serve webhooks in this process.
+
+    With several workers, the state is shared through the database and the
+    workers elect a leader to run triage and drain the outbox.
+    """
+    if constants.DATABASE_PATH != "":
+        outbox.outbox = outbox.Outbox(constants.DATABASE_PATH)
+        queues.snapshots = queues.QueueSnapshots(constants.DATABASE_PATH)
+        if constants.BACKFILL_INTERVAL_SECONDS > 0:
+            from marvin import backfill
+
+            backfill.log = backfill.DeliveryLog(constants.DATABASE_PATH)
+    app["draining"] = False
+    app.on_startup.append(start_loop_monitor)
+    app.on_shutdown.append(drain)
+    app.on_cleanup.append(stop_loop_monitor)
+    if worker_count > 1:
+        triage_runner.scheduler = triage_runner.SharedTriageQueue(
+            constants.DATABASE_PATH
+        )
+        app.on_startup.append(start_leader_election)
+        app.on_cleanup.append(stop_leader_election)
+    else:
+        app.on_startup.append(start_background_work)
+    web.run_app(
+        app,
+        port=port,
+        reuse_port=worker_count > 1,
+        shutdown_timeout=constants.SHUTDOWN_TIMEOUT_SECONDS,
+    )
 
 
 def load_secret_from_env_or_file(key: str, file_key: str) -> str:
@@ -136,9 +489,59 @@ def load_secret_from_env_or_file(key: str, file_key: str) -> str:
         raise Exception(f"You need to set either {key} or {file_key}.")
 
 
+def load_optional_secret(key: str, file_key: str) -> Optional[str]:
+    if key not in os.environ and file_key not in os.environ:
+        return None
+    return load_secret_from_env_or_file(key, file_key)
+
+
+async def print_triage_plan(
+    installation_id: str, gh_app_id: str, gh_private_key: str
+) -> None:
+    """Print the changes triage would make for an installation."""
+    async with aiohttp.ClientSession() as session:
+        gh = gh_util.InstrumentedGitHubAPI(session, constants.BOT_NAME)
+        installation_access_token = await gh_util.get_installation_access_token(
+            gh,
+            installation_id=installation_id,
+            app_id=gh_app_id,
+            private_key=gh_private_key,
+        )
+        result = await triage.run_triage(
+            gh, installation_access_token["token"], dry_run=True
+        )
+    for mutation in result.mutations:
+        print(mutation)
+
+
 def main() -> None:
+    parser = argparse.ArgumentParser(description="Helpful nixpkgs PR bot")
+    parser.add_argument(
+        "--plan-triage",
+        metavar="INSTALLATION_ID",
+        help="Print the changes triage would make for an installation and exit.",
+    )
+    args = parser.parse_args()
+
     logging.basicConfig(level=logging.DEBUG)
 
+    if args.plan_triage is not None:
+        asyncio.run(
+            print_triage_plan(
+                args.plan_triage,
+                gh_app_id=load_secret_from_env_or_file("GH_APP_ID", "GH_APP_ID_FILE"),
+                gh_private_key=load_secret_from_env_or_file(
+                    "GH_PRIVATE_KEY", "GH_PRIVATE_KEY_FILE"
+                ),
+            )
+        )
+        return
+
+    # The modules only some configurations need are loaded on demand, to keep
+    # the startup fast.
+    from marvin import event_loop
+
+    event_loop.install(constants.EVENT_LOOP)
     app = web.Application()
     app["webhook_secret"] = load_secret_from_env_or_file(
         "WEBHOOK_SECRET", "WEBHOOK_SECRET_FILE"
@@ -147,11 +550,22 @@ def main() -> None:
         "GH_PRIVATE_KEY", "GH_PRIVATE_KEY_FILE"
     )
     app["gh_app_id"] = load_secret_from_env_or_file("GH_APP_ID", "GH_APP_ID_FILE")
+    # Debug endpoints are disabled unless a token is configured.
+    app["debug_token"] = load_optional_secret("DEBUG_TOKEN", "DEBUG_TOKEN_FILE")
     app.add_routes(routes)
     port_str = os.environ.get("PORT")
     port = int(port_str) if port_str is not None else None
 
-    web.run_app(app, port=port)
+    if constants.WORKERS > 1:
+        if constants.DATABASE_PATH == "":
+            raise Exception("Running several workers requires a DATABASE_PATH.")
+        from marvin import workers
+
+        workers.serve(
+            lambda: run_worker(app, port, constants.WORKERS), constants.WORKERS
+        )
+    else:
+        run_worker(app, port, worker_count=1)
 
 
 if __name__ == "__main__":
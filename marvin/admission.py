@@ -0,0 +1,87 @@
+import asyncio
+import collections
+from typing import Deque
+from typing import List
+
+from marvin import constants
+from marvin import metrics
+
+
+class AdmissionControl:
+    """Limit the number of webhook deliveries that are handled at once.
+
+    At most `max_in_flight` deliveries are handled at the same time, of which
+    `reserved` slots are kept for priority deliveries (those with commands).
+    Priority deliveries wait for a slot when all are taken, up to
+    `max_waiting` of them. Other deliveries are rejected right away instead,
+    so that they can be shed quickly.
+    """
+
+    def __init__(self, max_in_flight: int, reserved: int, max_waiting: int) -> None:
+        assert 0 <= reserved < max_in_flight
+        self.max_in_flight = max_in_flight
+        self.reserved = reserved
+        self.max_waiting = max_waiting
+        self.in_flight = 0
+        self._waiting: Deque[asyncio.Future] = collections.deque()
+        self._idle: List[asyncio.Future] = []
+
+    async def admit(self, priority: bool) -> bool:
+        """Take a slot, waiting for one if needed and allowed.
+
+        Returns whether the delivery was admitted. If it was, the slot has to
+        be given back with `release`.
+        """
+        limit = self.max_in_flight - (0 if priority else self.reserved)
+        if self.in_flight < limit and len(self._waiting) == 0:
+            self.in_flight += 1
+            return True
+        if not priority or len(self._waiting) >= self.max_waiting:
+            return False
+        slot: asyncio.Future = asyncio.get_event_loop().create_future()
+        self._waiting.append(slot)
+        try:
+            await slot
+        except asyncio.CancelledError:
+            if slot.done() and not slot.cancelled():
+                # The slot was handed to us just before the cancellation.
+                self.release()
+            else:
+                self._waiting.remove(slot)
+            raise
+        return True
+
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    def release(self) -> None:
+        """Give back a slot, handing it to the next waiting delivery if any."""
+        if len(self._waiting) > 0:
+            self._waiting.popleft().set_result(None)
+        else:
+            self.in_flight -= 1
+        if self.in_flight == 0:
+            for idle in self._idle:
+                if not idle.done():
+                    idle.set_result(None)
+            self._idle = []
+
+    async def idle(self) -> None:
+        """Wait until no delivery is handled or waiting for a slot."""
+        if self.in_flight == 0:
+            return
+        idle: asyncio.Future = asyncio.get_event_loop().create_future()
+        self._idle.append(idle)
+        await idle
+
+
+control = AdmissionControl(
+    max_in_flight=constants.WEBHOOK_MAX_IN_FLIGHT,
+    reserved=constants.WEBHOOK_RESERVED_FOR_COMMANDS,
+    max_waiting=constants.WEBHOOK_MAX_WAITING,
+)
+metrics.Gauge(
+    "marvin_webhook_admission_waiting",
+    "Webhook deliveries with commands waiting for a free slot.",
+    function=lambda: control.waiting(),
+)
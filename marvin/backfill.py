@@ -0,0 +1,275 @@
+import asyncio
+import sqlite3
+import sys
+import time
+import traceback
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+import aiohttp
+from gidgethub import sansio
+from gidgethub.aiohttp import GitHubAPI
+
+from marvin import constants
+from marvin import gh_util
+from marvin import metrics
+from marvin import tracing
+
+# Deliveries younger than this may still be in flight, so they are left for
+# the next pass.
+SETTLE_SECONDS = 60
+
+DELIVERIES_REPLAYED = metrics.Counter(
+    "marvin_deliveries_replayed",
+    "Missed webhook deliveries that were replayed by event.",
+    ["event"],
+)
+
+
+class DeliveryLog:
+    """Remember which webhook deliveries were handled.
+
+    Deliveries are identified by their GUID, which GitHub keeps for
+    redeliveries. The log also keeps the subject of a delivery (see
+    `subject_of`) where it is known, since the list of deliveries does not
+    include it. Besides the handled deliveries, the log keeps the time up to
+    which the deliveries were checked by the backfill, so that a pass only
+    has to look at the deliveries since.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._db = sqlite3.connect(path)
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS handled_deliveries (
+                    guid TEXT PRIMARY KEY,
+                    subject TEXT,
+                    handled_at REAL NOT NULL
+                )
+                """)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS backfill (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    checked_until REAL NOT NULL
+                )
+                """)
+
+    def record(self, guid: str, subject: Optional[str] = None) -> None:
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO handled_deliveries VALUES (?, ?, ?)",
+                (guid, subject, time.time()),
+            )
+
+    def handled(self, guid: str) -> bool:
+        row = self._db.execute(
+            "SELECT 1 FROM handled_deliveries WHERE guid = ?", (guid,)
+        ).fetchone()
+        return row is not None
+
+    def subject(self, guid: str) -> Optional[str]:
+        row = self._db.execute(
+            "SELECT subject FROM handled_deliveries WHERE guid = ?", (guid,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def prune(self, before: float) -> None:
+        """Forget deliveries handled before some time."""
+        with self._db:
+            self._db.execute(
+                "DELETE FROM handled_deliveries WHERE handled_at < ?", (before,)
+            )
+
+    def checked_until(self) -> Optional[float]:
+        row = self._db.execute("SELECT checked_until FROM backfill").fetchone()
+        return row[0] if row is not None else None
+
+    def set_checked_until(self, timestamp: float) -> None:
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO backfill VALUES (0, ?)", (timestamp,)
+            )
+
+
+# The delivery log of this process. It is kept in memory unless a database
+# is configured.
+log = DeliveryLog(":memory:")
+
+
+def delivered_at(delivery: Dict[str, Any]) -> float:
+    return gh_util.parse_time(delivery["delivered_at"]).timestamp()
+
+
+def attempt_order(delivery: Dict[str, Any]) -> Tuple[float, int]:
+    # Attempts within the same second are ordered by their ids.
+    return delivered_at(delivery), delivery["id"]
+
+
+def succeeded(attempt: Dict[str, Any]) -> bool:
+    return 200 <= attempt["status_code"] < 300
+
+
+async def find_missed(
+    gh: GitHubAPI, jwt: str, since: float, until: float, delivery_log: DeliveryLog
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Find the deliveries between `since` and `until` that were not handled.
+
+    GitHub lists the delivery attempts newest first, so the listing stops at
+    the first attempt before `since`. A delivery was missed if none of its
+    attempts succeeded and it was not handled otherwise, e.g. replayed by an
+    earlier pass. Returns the first attempt of each missed delivery and of
+    each handled delivery since `since`, both oldest first.
+    """
+    attempts: Dict[str, List[Dict[str, Any]]] = dict()
+    async for attempt in gh.getiter("/app/hook/deliveries?per_page=100", jwt=jwt):
+        if delivered_at(attempt) < since:
+            break
+        attempts.setdefault(attempt["guid"], []).append(attempt)
+    missed = []
+    handled = []
+    for guid, delivery_attempts in attempts.items():
+        first = min(delivery_attempts, key=attempt_order)
+        # Deliveries like "ping" do not belong to an installation.
+        if first["installation_id"] is None:
+            continue
+        if any(
+            succeeded(attempt) for attempt in delivery_attempts
+        ) or delivery_log.handled(guid):
+            handled.append(first)
+        elif delivered_at(first) < until:
+            missed.append(first)
+    missed.sort(key=attempt_order)
+    handled.sort(key=attempt_order)
+    return missed, handled
+
+
+def subject_of(event: sansio.Event) -> str:
+    """The pull request (or else the repository) an event is about."""
+    repository = event.data.get("repository", {}).get("full_name", "")
+    issue = event.data.get("issue", event.data.get("pull_request"))
+    return f"{repository}#{issue['number']}" if issue is not None else repository
+
+
+async def fetch_event(
+    gh: GitHubAPI, get_jwt: Callable[[], Awaitable[str]], delivery: Dict[str, Any]
+) -> sansio.Event:
+    detail = await gh.getitem(
+        f"/app/hook/deliveries/{delivery['id']}", jwt=await get_jwt()
+    )
+    return sansio.Event(
+        detail["request"]["payload"],
+        event=detail["event"],
+        delivery_id=detail["guid"],
+    )
+
+
+async def last_handled(
+    gh: GitHubAPI,
+    get_jwt: Callable[[], Awaitable[str]],
+    delivery_log: DeliveryLog,
+    handled: List[Dict[str, Any]],
+) -> Dict[str, Tuple[float, int]]:
+    """Find the last handled delivery of each subject.
+
+    Subjects that are not in the delivery log, e.g. of deliveries handled
+    before a restart, are fetched and then remembered.
+    """
+    last: Dict[str, Tuple[float, int]] = dict()
+    for delivery in handled:
+        subject = delivery_log.subject(delivery["guid"])
+        if subject is None:
+            subject = subject_of(await fetch_event(gh, get_jwt, delivery))
+            delivery_log.record(delivery["guid"], subject)
+        last[subject] = attempt_order(delivery)
+    return last
+
+
+async def backfill(
+    gh: GitHubAPI,
+    get_jwt: Callable[[], Awaitable[str]],
+    delivery_log: DeliveryLog,
+    handle: Callable[[sansio.Event], Awaitable[None]],
+    max_age_seconds: float,
+) -> int:
+    """Replay the deliveries missed since the last pass, oldest first.
+
+    Deliveries are only looked at up to `max_age_seconds` back. Like the
+    outbox, deliveries of a pull request are never handled out of order: if
+    the replay of one fails, the later ones of the same pull request wait
+    for the next pass together with it. A missed delivery is not replayed at
+    all once a later delivery of its pull request was handled, since that
+    one already acted on a newer state. Returns the number of replayed
+    deliveries.
+    """
+    now = time.time()
+    since = now - max_age_seconds
+    checked_until = delivery_log.checked_until()
+    if checked_until is not None:
+        since = max(since, checked_until)
+    until = now - SETTLE_SECONDS
+    missed, handled = await find_missed(gh, await get_jwt(), since, until, delivery_log)
+    last: Dict[str, Tuple[float, int]] = dict()
+    if len(missed) > 0:
+        print(f"Replaying {len(missed)} missed webhook deliveries")
+        # Only later deliveries can supersede a missed one.
+        first_missed = attempt_order(missed[0])
+        later = [
+            delivery for delivery in handled if attempt_order(delivery) > first_missed
+        ]
+        last = await last_handled(gh, get_jwt, delivery_log, later)
+    replayed = 0
+    blocked: Set[str] = set()
+    for delivery in missed:
+        try:
+            event = await fetch_event(gh, get_jwt, delivery)
+            subject = subject_of(event)
+            if subject in blocked:
+                continue
+            if subject in last and last[subject] > attempt_order(delivery):
+                print(f"Skipping delivery {delivery['guid']}, {subject} moved on")
+                delivery_log.record(delivery["guid"], subject)
+                continue
+            try:
+                await handle(event)
+            except Exception:
+                blocked.add(subject)
+                raise
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            print(f"Failed to replay delivery {delivery['guid']}, retrying later")
+            until = min(until, delivered_at(delivery))
+            continue
+        delivery_log.record(delivery["guid"], subject)
+        DELIVERIES_REPLAYED.inc(event.event)
+        replayed += 1
+    delivery_log.set_checked_until(until)
+    delivery_log.prune(now - max_age_seconds)
+    return replayed
+
+
+async def run_periodically(
+    gh_app_id: str,
+    gh_private_key: str,
+    handle: Callable[[sansio.Event], Awaitable[None]],
+    interval_seconds: float,
+    max_age_seconds: float,
+) -> None:
+    """Backfill missed deliveries right away and then every interval."""
+    while True:
+        with tracing.cause("backfill", str(int(time.time()))):
+            async with aiohttp.ClientSession() as session:
+                gh = gh_util.InstrumentedGitHubAPI(session, constants.BOT_NAME)
+                await backfill(
+                    gh,
+                    lambda: gh_util.app_jwt.get(gh_app_id, gh_private_key),
+                    log,
+                    handle,
+                    max_age_seconds,
+                )
+        await asyncio.sleep(interval_seconds)
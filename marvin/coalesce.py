@@ -0,0 +1,176 @@
+import asyncio
+import sys
+import traceback
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Set
+
+from gidgethub.aiohttp import GitHubAPI
+
+from marvin import mutations
+from marvin import outbox
+
+
+class _PendingStatus:
+    def __init__(self, issue: Dict[str, Any], status: str) -> None:
+        self.issue = issue
+        self.status = status
+        self.flush_now = asyncio.Event()
+        self.done = asyncio.Event()
+        self.error: Optional[BaseException] = None
+
+
+class StatusCoalescer:
+    """Coalesce the status changes of a pull request.
+
+    Bursts of activity on a pull request (e.g. a push followed by a comment
+    and a review) would otherwise change its status several times within
+    seconds. Instead, the first status change of a pull request opens a window
+    of window_seconds. Later changes within that window only replace the
+    target status and once the window closes, only the final status is set.
+
+    With an outbox, the final status is only recorded there, so the window
+    is left to a task of the coalescer and callers return right away. A
+    status change that is still in its window when the process dies is lost.
+    Without an outbox, the status is set with the GitHub session of a caller,
+    so every caller waits until the final status is set. Status changes that
+    arrive while the final status of a pull request is being written wait for
+    that write, so that a pull request is never written to by two callers at
+    once. Explicit status commands (`flush`) always wait until the status is
+    recorded or set.
+    """
+
+    def __init__(self, window_seconds: float) -> None:
+        self.window_seconds = window_seconds
+        self._pending: Dict[str, _PendingStatus] = dict()
+        # The last write of each pull request that is in flight.
+        self._writing: Dict[str, "asyncio.Future[None]"] = dict()
+        # Windows that are closed in the background.
+        self._windows: Set["asyncio.Future[None]"] = set()
+
+    async def _write(
+        self,
+        issue_url: str,
+        issue: Dict[str, Any],
+        status: str,
+        gh: GitHubAPI,
+        token: str,
+        installation_id: Optional[str],
+    ) -> None:
+        """Submit a status once the writes before it are done."""
+        previous = self._writing.get(issue_url)
+        written = asyncio.get_event_loop().create_future()
+        self._writing[issue_url] = written
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await outbox.submit(
+                gh, token, installation_id, [mutations.SetStatus(issue, status)]
+            )
+        finally:
+            written.set_result(None)
+            if self._writing.get(issue_url) is written:
+                del self._writing[issue_url]
+
+    async def _close_window(
+        self,
+        issue_url: str,
+        pending: _PendingStatus,
+        gh: GitHubAPI,
+        token: str,
+        installation_id: Optional[str],
+    ) -> None:
+        """Wait for the window of a pull request to close and write its status."""
+        try:
+            try:
+                await asyncio.wait_for(
+                    pending.flush_now.wait(), timeout=self.window_seconds
+                )
+            except asyncio.TimeoutError:
+                pass
+            del self._pending[issue_url]
+            await self._write(
+                issue_url, pending.issue, pending.status, gh, token, installation_id
+            )
+        except BaseException as e:
+            if self._pending.get(issue_url) is pending:
+                del self._pending[issue_url]
+            pending.error = e
+            raise
+        finally:
+            pending.done.set()
+
+    async def _close_window_in_background(
+        self,
+        issue_url: str,
+        pending: _PendingStatus,
+        gh: GitHubAPI,
+        token: str,
+        installation_id: Optional[str],
+    ) -> None:
+        try:
+            await self._close_window(issue_url, pending, gh, token, installation_id)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            print(f"Failed to record status {pending.status} of {issue_url}")
+
+    async def set_issue_status(
+        self,
+        issue: Dict[str, Any],
+        status: str,
+        gh: GitHubAPI,
+        token: str,
+        installation_id: Optional[str] = None,
+        flush: bool = False,
+    ) -> None:
+        """Set the status of an issue once the coalescing window closes.
+
+        With `flush`, the window is closed immediately. This is used for
+        explicit status commands. The final status is submitted to the outbox
+        of the installation if there is one.
+        """
+        # depending on whether the issue is actually a pull request
+        issue_url = issue.get("issue_url", issue["url"])
+        pending = self._pending.get(issue_url)
+        if pending is None and self.window_seconds <= 0:
+            await self._write(issue_url, issue, status, gh, token, installation_id)
+            return
+
+        in_background = outbox.outbox is not None and installation_id is not None
+        if pending is not None:
+            print(f"Coalescing status change of {issue_url}: {status}")
+            pending.issue = issue
+            pending.status = status
+            if flush:
+                pending.flush_now.set()
+        else:
+            pending = _PendingStatus(issue, status)
+            self._pending[issue_url] = pending
+            if flush:
+                pending.flush_now.set()
+            if in_background:
+                window = asyncio.ensure_future(
+                    self._close_window_in_background(
+                        issue_url, pending, gh, token, installation_id
+                    )
+                )
+                self._windows.add(window)
+                window.add_done_callback(self._windows.discard)
+            else:
+                await self._close_window(issue_url, pending, gh, token, installation_id)
+                return
+
+        if in_background and not flush:
+            return
+        await pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+
+    async def flush_all(self) -> None:
+        """Close all open windows and wait for the final statuses to be set."""
+        pending = list(self._pending.values())
+        for status in pending:
+            status.flush_now.set()
+        for status in pending:
+            await status.done.wait()
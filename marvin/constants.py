@@ -1,3 +1,96 @@
 import os
 
 BOT_NAME = os.environ.get("BOT_NAME", "marvin-mk2")
+# The GitHub API, e.g. a local stand-in for load tests (see benchmarks/).
+GITHUB_API_URL = os.environ.get("GITHUB_API_URL", "https://api.github.com")
+
+# Maximum number of installations that are triaged at the same time.
+TRIAGE_CONCURRENCY = int(os.environ.get("TRIAGE_CONCURRENCY", "2"))
+# Minimum time between the start of two triage runs.
+TRIAGE_STAGGER_SECONDS = float(os.environ.get("TRIAGE_STAGGER_SECONDS", "30"))
+# Maximum number of pull requests triage modifies at the same time.
+TRIAGE_WRITE_CONCURRENCY = int(os.environ.get("TRIAGE_WRITE_CONCURRENCY", "4"))
+# Status changes of a pull request within this window are coalesced.
+STATUS_COALESCE_SECONDS = float(os.environ.get("STATUS_COALESCE_SECONDS", "3"))
+# SQLite database for state that should survive a restart. It only does if
+# the path is on a persistent disk, unlike the filesystem of a Heroku dyno
+# (see USAGE.md). Set to an empty string to keep no state.
+DATABASE_PATH = os.environ.get("DATABASE_PATH", "marvin.sqlite")
+# Number of recent GitHub API calls kept for tracing.
+API_TRACE_SIZE = int(os.environ.get("API_TRACE_SIZE", "5000"))
+# Append all webhook deliveries to this JSONL file, e.g. to record a corpus
+# for the replay benchmark. Empty to record nothing.
+WEBHOOK_RECORD_PATH = os.environ.get("WEBHOOK_RECORD_PATH", "")
+# Time GitHub needs until label changes show up in the search.
+SEARCH_INDEX_SETTLE_SECONDS = float(os.environ.get("SEARCH_INDEX_SETTLE_SECONDS", "2"))
+# Pause before each search for the recent activity of a reviewer.
+REVIEWER_SEARCH_PACING_SECONDS = float(
+    os.environ.get("REVIEWER_SEARCH_PACING_SECONDS", "3")
+)
+# How long to remember whether reviews can be requested from a user.
+COLLABORATOR_CACHE_SECONDS = float(
+    os.environ.get("COLLABORATOR_CACHE_SECONDS", str(24 * 60 * 60))
+)
+# JSON file listing the reviewers of the team. It is reloaded when changed.
+TEAM_CONFIG_PATH = os.environ.get(
+    "TEAM_CONFIG_PATH", os.path.join(os.path.dirname(__file__), "team.json")
+)
+# How long the gists controlling the availability of reviewers are cached.
+GIST_CACHE_SECONDS = float(os.environ.get("GIST_CACHE_SECONDS", "600"))
+# Number of processes handling webhooks. With more than one, the processes
+# share DATABASE_PATH and only one of them (the leader) runs triage.
+WORKERS = int(os.environ.get("WORKERS", "1"))
+# The leader has to renew its lease this often. If it dies, another worker
+# takes over once the lease expired.
+LEADER_LEASE_SECONDS = float(os.environ.get("LEADER_LEASE_SECONDS", "30"))
+# Maximum number of webhook deliveries handled at the same time per worker.
+# Some of these slots are reserved for deliveries with commands. Deliveries
+# without commands are rejected once the rest are taken, while those with
+# commands wait for a slot as long as not too many are waiting already.
+WEBHOOK_MAX_IN_FLIGHT = int(os.environ.get("WEBHOOK_MAX_IN_FLIGHT", "32"))
+WEBHOOK_RESERVED_FOR_COMMANDS = int(
+    os.environ.get("WEBHOOK_RESERVED_FOR_COMMANDS", "8")
+)
+WEBHOOK_MAX_WAITING = int(os.environ.get("WEBHOOK_MAX_WAITING", "64"))
+# Timeout of GitHub API calls. It can be set per endpoint class (see
+# gh_util.ENDPOINT_CLASSES) with API_TIMEOUTS, e.g. "search=60,gists=10".
+API_TIMEOUT_SECONDS = float(os.environ.get("API_TIMEOUT_SECONDS", "30"))
+API_TIMEOUTS = {
+    endpoint: float(seconds)
+    for endpoint, _, seconds in (
+        pair.partition("=")
+        for pair in os.environ.get("API_TIMEOUTS", "search=60,gists=10").split(",")
+        if pair != ""
+    )
+}
+# Stop calling GitHub for a while after this many consecutive calls failed
+# (timeouts, connection errors or server errors).
+CIRCUIT_BREAKER_FAILURES = int(os.environ.get("CIRCUIT_BREAKER_FAILURES", "5"))
+CIRCUIT_BREAKER_OPEN_SECONDS = float(
+    os.environ.get("CIRCUIT_BREAKER_OPEN_SECONDS", "60")
+)
+# On shutdown, in-flight webhook deliveries, triage runs and due outbox
+# entries get this long to finish before they are cancelled. Heroku kills
+# the process 30 seconds after asking it to stop.
+SHUTDOWN_TIMEOUT_SECONDS = float(os.environ.get("SHUTDOWN_TIMEOUT_SECONDS", "25"))
+# Where to sign the JWTs that authenticate as the app: "inline" on the event
+# loop, or in a "thread" or "process" pool to keep the loop responsive.
+JWT_SIGNING = os.environ.get("JWT_SIGNING", "inline")
+# The event loop is checked for lag this often. A callback that blocks it
+# for longer than SLOW_CALLBACK_SECONDS is logged together with its task.
+# Set the interval to 0 to disable this.
+LOOP_MONITOR_INTERVAL_SECONDS = float(
+    os.environ.get("LOOP_MONITOR_INTERVAL_SECONDS", "0.5")
+)
+SLOW_CALLBACK_SECONDS = float(os.environ.get("SLOW_CALLBACK_SECONDS", "0.1"))
+# The event loop implementation: "asyncio" or "uvloop", which is faster but
+# has to be installed separately. Falls back to asyncio if it is not.
+EVENT_LOOP = os.environ.get("EVENT_LOOP", "asyncio")
+# Webhook deliveries that failed or never arrived (e.g. while marvin was down)
+# are replayed on startup and then this often. Set to 0 to disable this.
+BACKFILL_INTERVAL_SECONDS = float(os.environ.get("BACKFILL_INTERVAL_SECONDS", "600"))
+# Deliveries older than this are not replayed anymore. GitHub lists the
+# deliveries of the last three days.
+BACKFILL_MAX_AGE_SECONDS = float(
+    os.environ.get("BACKFILL_MAX_AGE_SECONDS", str(24 * 60 * 60))
+)
@@ -0,0 +1,24 @@
+import asyncio
+
+# Event loop implementations that can be chosen with EVENT_LOOP.
+EVENT_LOOPS = ("asyncio", "uvloop")
+
+
+def install(name: str) -> str:
+    """Use an event loop implementation for the event loops created from now on.
+
+    uvloop is an optional dependency. Without it, this falls back to the
+    default asyncio event loop. Returns the name of the implementation in use.
+    """
+    if name not in EVENT_LOOPS:
+        raise ValueError(f"Unknown event loop {name!r}, expected one of {EVENT_LOOPS}")
+    if name == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            print("uvloop is not installed, using the default asyncio event loop")
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return "uvloop"
+    asyncio.set_event_loop_policy(None)
+    return "asyncio"
@@ -1,14 +1,32 @@
 import asyncio
+import collections
+import concurrent.futures
+from datetime import datetime
+from datetime import timezone
+import functools
+import math
+import time
 from typing import Any
-from typing import AsyncGenerator
 from typing import Callable
+from typing import Deque
 from typing import Dict
 from typing import List
-import urllib
-
+from typing import Mapping
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+import urllib.parse
+
+import aiohttp
 import gidgethub
+from gidgethub import sansio
 from gidgethub.aiohttp import GitHubAPI
 
+from marvin import constants
+from marvin import metrics
+from marvin import tracing
+
 # List of mutually exclusive status labels
 ISSUE_STATUS_LABELS = {
     "needs_reviewer",
@@ -19,6 +37,180 @@ ISSUE_STATUS_LABELS = {
 }
 
 
+API_CALLS = metrics.Counter(
+    "marvin_github_api_calls",
+    "GitHub API calls by endpoint class, method and status.",
+    ["endpoint", "method", "status"],
+)
+API_LATENCY = metrics.Histogram(
+    "marvin_github_api_latency_seconds",
+    "Latency of GitHub API calls by endpoint class.",
+    ["endpoint"],
+)
+RATE_LIMIT_REMAINING = metrics.Gauge(
+    "marvin_github_rate_limit_remaining",
+    "Remaining GitHub rate limit by resource.",
+    ["resource"],
+)
+RATE_LIMIT_RESET = metrics.Gauge(
+    "marvin_github_rate_limit_reset_timestamp_seconds",
+    "Time at which the GitHub rate limit resets by resource.",
+    ["resource"],
+)
+
+# The largest page size and the most results GitHub returns for a search.
+SEARCH_PAGE_SIZE = 100
+MAX_SEARCH_RESULTS = 1000
+
+# Endpoint classes by a characteristic part of their URL, checked in order.
+ENDPOINT_CLASSES = [
+    ("/search/", "search"),
+    ("/access_tokens", "tokens"),
+    ("/requested_reviewers", "reviewers"),
+    ("/labels", "labels"),
+    ("/comments", "comments"),
+    ("/gists/", "gists"),
+    ("/installation/repositories", "repositories"),
+    ("/rate_limit", "rate_limit"),
+]
+
+
+def endpoint_class(url: str) -> str:
+    """Classify an API URL for metrics."""
+    for part, name in ENDPOINT_CLASSES:
+        if part in url:
+            return name
+    return "other"
+
+
+CIRCUIT_OPENINGS = metrics.Counter(
+    "marvin_github_circuit_openings",
+    "How often the circuit breaker suspended calls to GitHub.",
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling GitHub while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Suspend calls to GitHub while it appears to be down.
+
+    After `failure_threshold` consecutive failed calls, the breaker opens and
+    calls fail right away for `open_seconds`. After that, calls are let
+    through again. The first failure opens the breaker again, the first
+    success closes it.
+    """
+
+    def __init__(self, failure_threshold: int, open_seconds: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.failures = 0
+        # Monotonic time until which calls are suspended.
+        self.open_until = 0.0
+
+    def is_open(self) -> bool:
+        return time.monotonic() < self.open_until
+
+    def open_for(self) -> float:
+        """The time in seconds until calls are let through again."""
+        return max(0.0, self.open_until - time.monotonic())
+
+    def record_success(self) -> None:
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.failure_threshold and not self.is_open():
+            print(
+                f"{self.failures} consecutive GitHub API calls failed, suspending "
+                f"calls for {self.open_seconds:.0f} seconds"
+            )
+            CIRCUIT_OPENINGS.inc()
+            self.open_until = time.monotonic() + self.open_seconds
+
+    async def wait_closed(self) -> None:
+        """Wait until calls are let through again."""
+        while self.is_open():
+            await asyncio.sleep(self.open_for())
+
+
+breaker = CircuitBreaker(
+    constants.CIRCUIT_BREAKER_FAILURES, constants.CIRCUIT_BREAKER_OPEN_SECONDS
+)
+metrics.Gauge(
+    "marvin_github_circuit_open",
+    "Whether calls to GitHub are currently suspended by the circuit breaker.",
+    function=lambda: int(breaker.is_open()),
+)
+
+
+class InstrumentedGitHubAPI(GitHubAPI):
+    """A GitHubAPI that records metrics and a trace of each request.
+
+    The trace attributes each request to the `tracing.cause` it was made in.
+    Requests go to constants.GITHUB_API_URL unless another base_url is given.
+    Requests time out after the configured time for their endpoint class and
+    are guarded by the circuit breaker.
+    """
+
+    def __init__(self, session: Any, requester: str, **kwargs: Any) -> None:
+        kwargs.setdefault("base_url", constants.GITHUB_API_URL)
+        super().__init__(session, requester, **kwargs)
+
+    async def _request(
+        self, method: str, url: str, headers: Mapping[str, str], body: bytes = b""
+    ) -> Tuple[int, Mapping[str, str], bytes]:
+        endpoint = endpoint_class(url)
+        start = time.perf_counter()
+        status: Optional[int] = None
+        response_bytes = 0
+        resource: Optional[str] = None
+        remaining: Optional[int] = None
+        if breaker.is_open():
+            API_CALLS.inc(endpoint, method, "circuit_open")
+            raise CircuitOpenError(f"Not calling {url} while GitHub appears down")
+        timeout = constants.API_TIMEOUTS.get(endpoint, constants.API_TIMEOUT_SECONDS)
+        try:
+            try:
+                response = await asyncio.wait_for(
+                    super()._request(method, url, headers, body), timeout
+                )
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                breaker.record_failure()
+                raise
+            if response[0] >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            status = response[0]
+            response_bytes = len(response[2])
+            response_headers = response[1]
+            resource = response_headers.get("x-ratelimit-resource")
+            if resource is not None:
+                remaining = int(response_headers["x-ratelimit-remaining"])
+                RATE_LIMIT_REMAINING.set(remaining, resource)
+                RATE_LIMIT_RESET.set(
+                    float(response_headers["x-ratelimit-reset"]), resource
+                )
+            return response
+        finally:
+            latency = time.perf_counter() - start
+            API_LATENCY.observe(latency, endpoint)
+            API_CALLS.inc(endpoint, method, str(status or "error"))
+            tracing.record(
+                tracing.ApiCall(
+                    method,
+                    url,
+                    status,
+                    latency,
+                    response_bytes,
+                    rate_limit_resource=resource,
+                    rate_limit_remaining=remaining,
+                )
+            )
+
+
 def rate_limit_retry(wait_seconds: int) -> Callable[[Callable], Callable]:
     """Create a decorator that retries a request on rate limiting."""
 
@@ -51,6 +243,48 @@ async def post_comment(gh: GitHubAPI, token: str, comments_url: str, body: str)
     )
 
 
+class CollaboratorCache:
+    """Remember whether reviews can be requested from users in a repository.
+
+    GitHub only allows requesting reviews from collaborators. Remembering the
+    outcome of previous attempts saves a failing request for everybody else.
+    Entries expire after ttl_seconds, since people may become collaborators.
+    """
+
+    def __init__(self, ttl_seconds: float) -> None:
+        self.ttl_seconds = ttl_seconds
+        self._entries: Dict[Tuple[str, str], Tuple[bool, float]] = dict()
+
+    def get(self, repository: str, login: str) -> Optional[bool]:
+        entry = self._entries.get((repository, login))
+        if entry is None:
+            return None
+        requestable, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[(repository, login)]
+            return None
+        return requestable
+
+    def set(self, repository: str, login: str, requestable: bool) -> None:
+        self._entries[(repository, login)] = (
+            requestable,
+            time.monotonic() + self.ttl_seconds,
+        )
+
+
+collaborators = CollaboratorCache(constants.COLLABORATOR_CACHE_SECONDS)
+
+
+def repository_of(url: str) -> str:
+    """Get the full name of the repository an API URL belongs to.
+
+    >>> repository_of("https://api.github.com/repos/NixOS/nixpkgs/pulls/42")
+    'NixOS/nixpkgs'
+    """
+    parts = urllib.parse.urlsplit(url).path.split("/")
+    return "/".join(parts[parts.index("repos") + 1 :][:2])
+
+
 async def request_review_fallback(
     gh: GitHubAPI, token: str, pull_url: str, comments_url: str, gh_login: str
 ) -> None:
@@ -58,29 +292,223 @@ async def request_review_fallback(
 
     Attempts to request a review and @mentions the reviewer if GitHub doesn't
     allow us to do that (since the user is not a collaborator on the repo).
+    Users known not to be collaborators are @mentioned right away.
+    """
+    repository = repository_of(pull_url)
+    if collaborators.get(repository, gh_login) is not False:
+        try:
+            await request_review(pull_url, gh_login, gh, token)
+            collaborators.set(repository, gh_login, True)
+            return
+        except gidgethub.InvalidField as e:
+            if "collaborator" in str(e):
+                collaborators.set(repository, gh_login, False)
+    print("Falling back to @mention.")
+    await post_comment(gh, token, comments_url, f"@{gh_login} please review.")
+
+
+def format_time(timestamp: datetime) -> str:
+    """Format a time for search qualifiers.
+
+    >>> format_time(datetime(2020, 1, 2, 3, 4, 5, tzinfo=timezone.utc))
+    '2020-01-02T03:04:05Z'
+    """
+    return timestamp.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def parse_time(text: str) -> datetime:
+    """Parse a timestamp as returned by the API.
+
+    This is much faster than strptime, which matters when going through
+    thousands of search results.
+
+    >>> parse_time("2020-01-02T03:04:05Z")
+    datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+    """
+    if text.endswith("Z"):
+        text = text[:-1] + "+00:00"
+    return datetime.fromisoformat(text)
+
+
+class SearchQuery:
+    """A search for pull requests.
+
+    As documented here:
+    https://docs.github.com/en/github/searching-for-information-on-github/searching-issues-and-pull-requests
+
+    Time predicates are evaluated by GitHub, so only matching pull requests
+    are returned. With `is_pr=False`, issues match as well.
+
+    >>> query = SearchQuery(
+    ...     "NixOS/nixpkgs",
+    ...     labels=["marvin", "awaiting_reviewer"],
+    ...     excluded_labels=["timeout_pending"],
+    ...     updated_before=datetime(2020, 1, 1, tzinfo=timezone.utc),
+    ...     sort="updated",
+    ... )
+    >>> query.qualifiers()
+    ['repo:NixOS/nixpkgs', 'is:pr', 'is:open', 'label:marvin', 'label:awaiting_reviewer', '-label:timeout_pending', 'updated:<2020-01-01T00:00:00Z']
+    >>> SearchQuery("NixOS/nixpkgs", state=None, is_pr=False).qualifiers()
+    ['repo:NixOS/nixpkgs']
+    """
+
+    def __init__(
+        self,
+        repo: str,
+        state: Optional[str] = "open",
+        labels: Sequence[str] = (),
+        excluded_labels: Sequence[str] = (),
+        involves: Optional[str] = None,
+        updated_before: Optional[datetime] = None,
+        updated_since: Optional[datetime] = None,
+        created_before: Optional[datetime] = None,
+        not_merged_before: Optional[datetime] = None,
+        sort: Optional[str] = None,
+        order: str = "asc",
+        is_pr: bool = True,
+    ) -> None:
+        self.repo = repo
+        self.state = state
+        self.labels = labels
+        self.excluded_labels = excluded_labels
+        self.involves = involves
+        self.updated_before = updated_before
+        self.updated_since = updated_since
+        self.created_before = created_before
+        self.not_merged_before = not_merged_before
+        # "created" or "updated"
+        self.sort = sort
+        self.order = order
+        self.is_pr = is_pr
+
+    def qualifiers(self) -> List[str]:
+        qualifiers = [f"repo:{self.repo}"]
+        if self.is_pr:
+            qualifiers.append("is:pr")
+        if self.state is not None:
+            qualifiers.append(f"is:{self.state}")
+        qualifiers += [f"label:{label}" for label in self.labels]
+        qualifiers += [f"-label:{label}" for label in self.excluded_labels]
+        if self.involves is not None:
+            qualifiers.append(f"involves:{self.involves}")
+        if self.updated_before is not None:
+            qualifiers.append(f"updated:<{format_time(self.updated_before)}")
+        if self.updated_since is not None:
+            qualifiers.append(f"updated:>={format_time(self.updated_since)}")
+        if self.created_before is not None:
+            qualifiers.append(f"created:<{format_time(self.created_before)}")
+        if self.not_merged_before is not None:
+            qualifiers.append(f"-merged:<{format_time(self.not_merged_before)}")
+        return qualifiers
+
+    def url(self, page: int = 1, per_page: int = SEARCH_PAGE_SIZE) -> str:
+        query = "+".join(
+            urllib.parse.quote(qualifier, safe="") for qualifier in self.qualifiers()
+        )
+        url = f"/search/issues?q={query}&per_page={per_page}&page={page}"
+        if self.sort is not None:
+            url += f"&sort={self.sort}&order={self.order}"
+        return url
+
+    def __str__(self) -> str:
+        return " ".join(self.qualifiers())
+
+
+class SearchResults:
+    """The results of a search, fetching pages ahead in the background.
+
+    Pages of the maximum size are requested. While the current page is being
+    processed, the next one is already fetched, buffering at most
+    `prefetch_pages` pages. The results must be used as an async context
+    manager, so that pending prefetches are cancelled when the iteration
+    stops early:
+
+        async with search_issues(gh, token, query) as results:
+            async for issue in results:
+                ...
     """
-    try:
-        await request_review(pull_url, gh_login, gh, token)
-    except gidgethub.InvalidField:
-        print("Falling back to @mention.")
-        await post_comment(gh, token, comments_url, f"@{gh_login} please review.")
 
+    def __init__(
+        self, gh: GitHubAPI, token: str, query: SearchQuery, prefetch_pages: int = 1
+    ) -> None:
+        self._gh = gh
+        self._token = token
+        self._query = query
+        self._pages: "asyncio.Queue[Any]" = asyncio.Queue(maxsize=prefetch_pages)
+        self._items: Deque[Dict[str, Any]] = collections.deque()
+        self._fetch_task: Optional[asyncio.Task] = None
+        self._exhausted = False
+        self._entered = False
+        # The number of matches, known once the first page was fetched.
+        self.total_count: Optional[int] = None
+
+    async def _fetch_pages(self) -> None:
+        """Put pages into the buffer, followed by None or an exception."""
+        try:
+            page = 1
+            while True:
+                result = await self._gh.getitem(
+                    self._query.url(page=page), oauth_token=self._token
+                )
+                self.total_count = result["total_count"]
+                await self._pages.put(result["items"])
+                available = min(result["total_count"], MAX_SEARCH_RESULTS)
+                if page * SEARCH_PAGE_SIZE >= available or len(result["items"]) == 0:
+                    break
+                page += 1
+            await self._pages.put(None)
+        except Exception as e:
+            await self._pages.put(e)
+
+    def __aiter__(self) -> "SearchResults":
+        return self
+
+    async def __anext__(self) -> Dict[str, Any]:
+        # Otherwise, nothing would stop the prefetch when the iteration stops.
+        assert self._entered, "Search results must be used with `async with`"
+        while len(self._items) == 0:
+            if self._exhausted:
+                raise StopAsyncIteration
+            if self._fetch_task is None:
+                self._fetch_task = asyncio.ensure_future(self._fetch_pages())
+            page = await self._pages.get()
+            if page is None or isinstance(page, Exception):
+                self._exhausted = True
+                if page is None:
+                    raise StopAsyncIteration
+                raise page
+            self._items.extend(page)
+        return self._items.popleft()
+
+    async def aclose(self) -> None:
+        """Stop fetching pages."""
+        self._exhausted = True
+        self._items.clear()
+        if self._fetch_task is not None and not self._fetch_task.done():
+            self._fetch_task.cancel()
+            try:
+                await self._fetch_task
+            except asyncio.CancelledError:
+                pass
+
+    async def __aenter__(self) -> "SearchResults":
+        self._entered = True
+        return self
 
-def search_issues(
-    gh: GitHubAPI, token: str, query_parameters: List[str],
-) -> AsyncGenerator[Dict[str, Any], None]:
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.aclose()
+
+
+def search_issues(gh: GitHubAPI, token: str, query: SearchQuery) -> SearchResults:
     """Search github issues and pull requests.
 
     As documented here:
     https://developer.github.com/v3/search/#search-issues-and-pull-requests
 
-    A common query string is likely "repo:NixOS/nixpkgs". Returns an async
-    iterator of issues, automatically handling pagination.
+    Returns an async iterator of issues, automatically handling pagination.
+    It has to be entered with `async with` (see `SearchResults`).
     """
-    query = "+".join([urllib.parse.quote(param, safe="") for param in query_parameters])
-    return gh.getiter(
-        f"https://api.github.com/search/issues?q={query}", oauth_token=token
-    )
+    return SearchResults(gh, token, query)
 
 
 async def get_installation_repositories(
@@ -97,38 +525,167 @@ async def get_installation_repositories(
     # iterator over the items in the json dict such as "total_count") and its
     # unlikely enough that pagination is an issue h ere.
     result = await gh.getitem(
-        f"https://api.github.com/installation/repositories",
+        "/installation/repositories",
         accept="application/vnd.github.machine-man-preview+json",
         oauth_token=token,
     )
     return result["repositories"]
 
 
+async def get_rate_limits(gh: GitHubAPI, token: str) -> Dict[str, sansio.RateLimit]:
+    """Get the current rate limits, keyed by resource (e.g. "core", "search").
+
+    As documented here:
+    https://developer.github.com/v3/rate_limit/
+
+    Fetching the rate limit status does not count against the rate limit.
+    """
+    result = await gh.getitem("/rate_limit", oauth_token=token)
+    for name, resource in result["resources"].items():
+        RATE_LIMIT_REMAINING.set(resource["remaining"], name)
+        RATE_LIMIT_RESET.set(resource["reset"], name)
+    return {
+        name: sansio.RateLimit(
+            limit=resource["limit"],
+            remaining=resource["remaining"],
+            reset_epoch=resource["reset"],
+        )
+        for name, resource in result["resources"].items()
+    }
+
+
+async def get_if_changed(
+    gh: GitHubAPI, url: str, etag: Optional[str] = None
+) -> Tuple[Optional[Any], Optional[str]]:
+    """Get an API resource unless it still has the given ETag.
+
+    As documented here:
+    https://docs.github.com/en/rest/overview/resources-in-the-rest-api#conditional-requests
+
+    Returns the data (None if unchanged) and the new ETag. The request is not
+    authenticated. gidgethub does not expose response headers, so this talks
+    to the transport directly.
+    """
+    headers = sansio.create_headers(gh.requester)
+    if etag is not None:
+        headers["if-none-match"] = etag
+    filled_url = sansio.format_url(url, {}, base_url=gh.base_url)
+    status, response_headers, body = await gh._request("GET", filled_url, headers, b"")
+    if status == 304:
+        return None, etag
+    data, _, _ = sansio.decipher_response(status, response_headers, body)
+    return data, response_headers.get("etag")
+
+
+class AppJWT:
+    """Sign the JWTs that authenticate as the app, reusing them for a while.
+
+    Signing takes tens of milliseconds of CPU time, mostly to load the
+    private key, and would block the event loop meanwhile. gidgethub's JWTs
+    are valid for ten minutes, so one is only signed every few minutes.
+    `executor` moves the signing into a "thread" or a "process" pool
+    instead of the event loop ("inline").
+    """
+
+    def __init__(self, reuse_seconds: float = 5 * 60, executor: str = "inline") -> None:
+        assert executor in ("inline", "thread", "process")
+        self.reuse_seconds = reuse_seconds
+        self.executor = executor
+        self._pool: Optional[concurrent.futures.Executor] = None
+        # By app id and private key: the JWT and when it was signed.
+        self._signed: Dict[Tuple[str, str], Tuple[str, float]] = dict()
+
+    async def get(self, app_id: str, private_key: str) -> str:
+        token, signed_at = self._signed.get((app_id, private_key), ("", -math.inf))
+        if time.monotonic() - signed_at < self.reuse_seconds:
+            return token
+        # Loading PyJWT and cryptography takes a while, so that is put off
+        # until the first token is needed instead of delaying the startup.
+        from gidgethub import apps
+
+        sign = functools.partial(apps.get_jwt, app_id=app_id, private_key=private_key)
+        if self.executor == "inline":
+            token = sign()
+        else:
+            if self._pool is None:
+                self._pool = (
+                    concurrent.futures.ProcessPoolExecutor(max_workers=1)
+                    if self.executor == "process"
+                    else concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                )
+            token = await asyncio.get_event_loop().run_in_executor(self._pool, sign)
+        self._signed[(app_id, private_key)] = (token, time.monotonic())
+        return token
+
+
+app_jwt = AppJWT(executor=constants.JWT_SIGNING)
+
+
+async def get_installation_access_token(
+    gh: GitHubAPI, installation_id: str, app_id: str, private_key: str
+) -> Dict[str, Any]:
+    """Get an access token for an installation of the app.
+
+    Like gidgethub.apps.get_installation_access_token, but with the JWT from
+    `app_jwt`.
+    """
+    return await gh.post(
+        f"/app/installations/{installation_id}/access_tokens",
+        data=b"",
+        jwt=await app_jwt.get(app_id, private_key),
+    )
+
+
 async def set_issue_status(
-    issue: Dict[str, Any], status: str, gh: GitHubAPI, token: str
+    issue: Dict[str, Any],
+    status: str,
+    gh: GitHubAPI,
+    token: str,
+    refresh_labels: bool = False,
 ) -> None:
-    """Sets the status of an issue while resetting other status labels"""
+    """Sets the status of an issue while resetting other status labels
+
+    The labels of `issue` may be outdated by the time a recorded status change
+    is applied, e.g. when an earlier one was applied in the meantime. With
+    `refresh_labels`, they are read again first. Otherwise, status labels we
+    did not know about are noticed in the labels GitHub returns after adding
+    the new status and removed then.
+    """
     assert status in ISSUE_STATUS_LABELS
 
     # depending on whether the issue is actually a pull request
     issue_url = issue.get("issue_url", issue["url"])
 
+    async def remove_labels(labels: Set[str]) -> None:
+        for label in labels:
+            try:
+                await gh.delete(issue_url + "/labels/" + label, oauth_token=token)
+            except gidgethub.BadRequest as e:
+                # The label may already be gone when a partially applied
+                # status change is retried.
+                if e.status_code != 404:
+                    raise
+
+    if refresh_labels:
+        labels = await gh.getitem(issue_url + "/labels?per_page=100", oauth_token=token)
+    else:
+        labels = issue["labels"]
     # Labels are mutually exclusive, so clear other labels first.
-    labels = issue["labels"]
     label_names = {label["name"] for label in labels}
     # should never be more than one, but better to make it a set anyway
-    status_labels = label_names.intersection(
-        ISSUE_STATUS_LABELS.union("timeout_pending",)
-    )
-    for label in status_labels:
-        if label == status:  # Don't touch the label we're supposed to set.
-            continue
-        await gh.delete(issue_url + "/labels/" + label, oauth_token=token)
+    status_labels = label_names.intersection(ISSUE_STATUS_LABELS | {"timeout_pending"})
+    # Don't touch the label we're supposed to set.
+    await remove_labels(status_labels - {status})
 
     if status not in status_labels:
-        await gh.post(
+        current = await gh.post(
             issue_url + "/labels", data={"labels": [status]}, oauth_token=token,
         )
+        if current is not None:
+            leftover = {label["name"] for label in current}.intersection(
+                ISSUE_STATUS_LABELS | {"timeout_pending"}
+            )
+            await remove_labels(leftover - status_labels - {status})
 
 
 async def mark_timeout(issue: Dict[str, Any], gh: GitHubAPI, token: str) -> None:
@@ -0,0 +1,94 @@
+import asyncio
+import os
+import signal
+import socket
+import sqlite3
+import sys
+import time
+import traceback
+from typing import Callable
+from typing import Optional
+import uuid
+
+
+class Lease:
+    """A lease on a role that only one process may have at a time.
+
+    The processes share the lease through a SQLite database. The holder has
+    to renew the lease before it expires after `ttl_seconds`. Once it is
+    expired, e.g. because its holder died, any process can acquire it.
+    """
+
+    def __init__(self, path: str, name: str, ttl_seconds: float) -> None:
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        # Unique even if a process id is reused.
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._db = sqlite3.connect(path)
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+                """)
+
+    def acquire(self, now: Optional[float] = None) -> bool:
+        """Acquire or renew the lease and return whether we hold it."""
+        if now is None:
+            now = time.time()
+        with self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO leases VALUES (?, ?, 0)",
+                (self.name, self.holder),
+            )
+            cursor = self._db.execute(
+                "UPDATE leases SET holder = ?, expires_at = ?"
+                " WHERE name = ? AND (holder = ? OR expires_at < ?)",
+                (self.holder, now + self.ttl_seconds, self.name, self.holder, now),
+            )
+        return cursor.rowcount == 1
+
+    def release(self) -> None:
+        """Give up the lease if we hold it, so another process can take over."""
+        with self._db:
+            self._db.execute(
+                "UPDATE leases SET expires_at = 0 WHERE name = ? AND holder = ?",
+                (self.name, self.holder),
+            )
+
+
+def step_down() -> None:
+    """Shut down this worker. The master process starts a fresh one."""
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+async def campaign(
+    lease: Lease,
+    elected: Callable[[], None],
+    deposed: Callable[[], None] = step_down,
+) -> None:
+    """Keep trying to acquire a lease and renew it once acquired.
+
+    `elected` is called once the lease is acquired. If it is lost again, for
+    example because the event loop was blocked for longer than the lease
+    lasts, `deposed` is called. Since the new holder may already have taken
+    over, the default is to shut down instead of trying to hand back work.
+    """
+    leading = False
+    while True:
+        try:
+            held = lease.acquire()
+        except sqlite3.Error:
+            traceback.print_exc(file=sys.stderr)
+            held = False
+        if held and not leading:
+            print(f"Acquired the {lease.name} lease as {lease.holder}")
+            leading = True
+            elected()
+        elif not held and leading:
+            print(f"Lost the {lease.name} lease")
+            deposed()
+            return
+        await asyncio.sleep(lease.ttl_seconds / 3)
@@ -0,0 +1,91 @@
+import asyncio
+import sys
+import threading
+import time
+from typing import Optional
+
+from marvin import metrics
+from marvin import profiling
+
+LOOP_LAG = metrics.Histogram(
+    "marvin_event_loop_lag_seconds",
+    "How late callbacks run on the event loop.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+LOOP_BLOCKED = metrics.Counter(
+    "marvin_event_loop_blocked",
+    "Callbacks that blocked the event loop for too long by the coroutine of "
+    "their task.",
+    ["task"],
+)
+
+# Innermost frames of a blocking callback that are logged.
+LOGGED_FRAMES = 8
+
+
+class LoopMonitor:
+    """Measure the lag of the event loop and catch callbacks that block it.
+
+    A heartbeat callback reschedules itself every `interval_seconds` and
+    records how late it runs. A watchdog thread notices when the heartbeat is
+    more than `slow_seconds` overdue. It then logs the task and stack that are
+    running on the event loop, while they are still blocking it.
+    """
+
+    def __init__(self, interval_seconds: float, slow_seconds: float) -> None:
+        self.interval_seconds = interval_seconds
+        self.slow_seconds = slow_seconds
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread_id = 0
+        self._last_beat = 0.0
+        self._heartbeat: Optional[asyncio.TimerHandle] = None
+        self._stopped = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._loop = asyncio.get_event_loop()
+        self._thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._beat(self._loop.time())
+        self._watchdog = threading.Thread(
+            target=self._watch, name="loop-monitor", daemon=True
+        )
+        self._watchdog.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+        if self._watchdog is not None:
+            self._watchdog.join()
+
+    def _beat(self, scheduled_at: float) -> None:
+        assert self._loop is not None
+        now = self._loop.time()
+        LOOP_LAG.observe(max(0.0, now - scheduled_at))
+        self._last_beat = time.monotonic()
+        self._heartbeat = self._loop.call_at(
+            now + self.interval_seconds, self._beat, now + self.interval_seconds
+        )
+
+    def _watch(self) -> None:
+        reported_beat = None
+        while not self._stopped.wait(self.slow_seconds / 2):
+            last_beat = self._last_beat
+            overdue = time.monotonic() - last_beat - self.interval_seconds
+            if overdue > self.slow_seconds and last_beat != reported_beat:
+                reported_beat = last_beat
+                self._report(overdue)
+
+    def _report(self, overdue: float) -> None:
+        assert self._loop is not None
+        task = asyncio.current_task(self._loop)
+        name = profiling.coroutine_name(task) if task is not None else "unknown"
+        frame = sys._current_frames().get(self._thread_id)
+        stack = profiling.collapsed_stack(frame).split(";")[-LOGGED_FRAMES:]
+        del frame
+        LOOP_BLOCKED.inc(name)
+        print(
+            f"Event loop blocked for over {overdue:.3f} seconds by task {name} in "
+            + " <- ".join(reversed(stack))
+        )
@@ -0,0 +1,176 @@
+import abc
+import contextlib
+import math
+import time
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+Sample = Tuple[str, Sequence[Tuple[str, str]], float]
+
+
+class Metric(abc.ABC):
+    """A minimal Prometheus metric.
+
+    Values are kept in plain dictionaries keyed by their label values, so that
+    updating them is cheap. They are only rendered when the metrics are
+    scraped.
+    """
+
+    type = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def _labels(self, labelvalues: Sequence[str]) -> List[Tuple[str, str]]:
+        return list(zip(self.labelnames, labelvalues))
+
+    @property
+    def exposed_name(self) -> str:
+        """The name the samples are exposed under, which the metadata names."""
+        return self.name
+
+    @abc.abstractmethod
+    def samples(self) -> Iterator[Sample]:
+        pass
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = dict()
+
+    @property
+    def exposed_name(self) -> str:
+        return self.name + "_total"
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def samples(self) -> Iterator[Sample]:
+        for labelvalues, value in self.values.items():
+            yield self.exposed_name, self._labels(labelvalues), value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        function: Optional[Callable[[], float]] = None,
+    ) -> None:
+        """Create a gauge.
+
+        If a `function` is given, it is called to get the (unlabelled) value
+        whenever the metrics are rendered.
+        """
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = dict()
+        self.function = function
+
+    def set(self, value: float, *labelvalues: str) -> None:
+        self.values[labelvalues] = value
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues: str, amount: float = 1) -> None:
+        self.inc(*labelvalues, amount=-amount)
+
+    def samples(self) -> Iterator[Sample]:
+        if self.function is not None:
+            yield self.name, [], self.function()
+        for labelvalues, value in self.values.items():
+            yield self.name, self._labels(labelvalues), value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Per label values: the count of each bucket, the sum and the count.
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = dict()
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        entry = self.values.get(labelvalues)
+        if entry is None:
+            entry = ([0] * len(self.buckets), [0.0, 0.0])
+            self.values[labelvalues] = entry
+        counts, total = entry
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        total[0] += value
+        total[1] += 1
+
+    @contextlib.contextmanager
+    def time(self, *labelvalues: str) -> Iterator[None]:
+        """Observe the time spent in a block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def samples(self) -> Iterator[Sample]:
+        for labelvalues, (counts, (total, count)) in self.values.items():
+            labels = self._labels(labelvalues)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == math.inf else repr(float(bound))
+                yield self.name + "_bucket", labels + [("le", le)], cumulative
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, count
+
+
+REGISTRY: List[Metric] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render() -> str:
+    """Render all metrics in the Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.exposed_name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.exposed_name} {metric.type}")
+        for name, labels, value in metric.samples():
+            if len(labels) > 0:
+                label_text = ",".join(
+                    f'{key}="{_escape(str(label))}"' for key, label in labels
+                )
+                name = f"{name}{{{label_text}}}"
+            lines.append(f"{name} {float(value)!r}")
+    return "\n".join(lines) + "\n"
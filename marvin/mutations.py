@@ -0,0 +1,177 @@
+import abc
+import asyncio
+import sys
+import traceback
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Type
+
+from gidgethub.aiohttp import GitHubAPI
+
+from marvin import gh_util
+
+
+class Mutation(abc.ABC):
+    """A change to a pull request that we intend to make on GitHub.
+
+    Triage first plans all mutations and then executes them. Mutations of the
+    same pull request share a `key` and are applied in order.
+    """
+
+    kind = ""
+
+    def __init__(self, issue: Dict[str, Any]) -> None:
+        self.issue = issue
+        # Earlier attempts to apply the mutation, as counted by the outbox.
+        self.attempts = 0
+
+    @property
+    def key(self) -> str:
+        # depending on whether the issue is actually a pull request
+        return self.issue.get("issue_url", self.issue["url"])
+
+    @abc.abstractmethod
+    async def apply(self, gh: GitHubAPI, token: str) -> None:
+        pass
+
+    @abc.abstractmethod
+    def describe(self) -> str:
+        pass
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialize the mutation, keeping only the parts of the issue we use."""
+        issue: Dict[str, Any] = {
+            key: self.issue[key]
+            for key in ("url", "issue_url", "number", "comments_url")
+            if key in self.issue
+        }
+        issue["labels"] = [{"name": label["name"]} for label in self.issue["labels"]]
+        if "pull_request" in self.issue:
+            issue["pull_request"] = {"url": self.issue["pull_request"]["url"]}
+        return {"kind": self.kind, "issue": issue}
+
+    def __str__(self) -> str:
+        return f"#{self.issue.get('number')}: {self.describe()}"
+
+
+class SetStatus(Mutation):
+    kind = "set_status"
+
+    def __init__(self, issue: Dict[str, Any], status: str) -> None:
+        super().__init__(issue)
+        self.status = status
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(super().to_dict(), status=self.status)
+
+    async def apply(self, gh: GitHubAPI, token: str) -> None:
+        # A retry may follow a partially applied change.
+        await gh_util.set_issue_status(
+            self.issue, self.status, gh, token, refresh_labels=self.attempts > 0
+        )
+
+    def describe(self) -> str:
+        return f"set status to {self.status}"
+
+
+class PostComment(Mutation):
+    kind = "post_comment"
+
+    def __init__(self, issue: Dict[str, Any], body: str) -> None:
+        super().__init__(issue)
+        self.body = body
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(super().to_dict(), body=self.body)
+
+    async def apply(self, gh: GitHubAPI, token: str) -> None:
+        await gh_util.post_comment(gh, token, self.issue["comments_url"], self.body)
+
+    def describe(self) -> str:
+        first_line = self.body.splitlines()[0] if self.body else ""
+        return f"post comment {first_line!r}"
+
+
+class PostReminder(PostComment):
+    """Post a reminder and mark the pull request as pending timeout."""
+
+    kind = "post_reminder"
+
+    async def apply(self, gh: GitHubAPI, token: str) -> None:
+        # Mark first, so that a retry after a failure does not post the
+        # reminder twice.
+        await gh_util.mark_timeout(self.issue, gh, token)
+        await super().apply(gh, token)
+
+    def describe(self) -> str:
+        return "post reminder"
+
+
+class RequestReview(Mutation):
+    kind = "request_review"
+
+    def __init__(self, issue: Dict[str, Any], reviewer: str) -> None:
+        super().__init__(issue)
+        self.reviewer = reviewer
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(super().to_dict(), reviewer=self.reviewer)
+
+    async def apply(self, gh: GitHubAPI, token: str) -> None:
+        await gh_util.request_review_fallback(
+            gh,
+            token,
+            self.issue["pull_request"]["url"],
+            self.issue["comments_url"],
+            self.reviewer,
+        )
+
+    def describe(self) -> str:
+        return f"request review from {self.reviewer}"
+
+
+KINDS: Dict[str, Type[Mutation]] = {
+    mutation_type.kind: mutation_type
+    for mutation_type in (SetStatus, PostComment, PostReminder, RequestReview)
+}
+
+
+def from_dict(data: Dict[str, Any]) -> Mutation:
+    """Deserialize a mutation created by `Mutation.to_dict`."""
+    arguments = dict(data)
+    mutation_type = KINDS[arguments.pop("kind")]
+    return mutation_type(**arguments)  # type: ignore
+
+
+async def execute(
+    gh: GitHubAPI, token: str, mutations: List[Mutation], max_concurrency: int
+) -> List[Mutation]:
+    """Apply mutations concurrently.
+
+    Mutations of the same pull request are applied one after another in the
+    given order. If one of them fails, the remaining mutations of that pull
+    request are skipped while the other pull requests are unaffected. Returns
+    the mutations that were not applied.
+    """
+    groups: Dict[str, List[Mutation]] = dict()
+    for mutation in mutations:
+        groups.setdefault(mutation.key, []).append(mutation)
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    not_applied: List[Mutation] = []
+
+    async def apply_group(group: List[Mutation]) -> None:
+        async with semaphore:
+            for i, mutation in enumerate(group):
+                print(f"Applying {mutation}")
+                try:
+                    await mutation.apply(gh, token)
+                except Exception:
+                    traceback.print_exc(file=sys.stderr)
+                    not_applied.extend(group[i:])
+                    return
+
+    await asyncio.gather(*[apply_group(group) for group in groups.values()])
+    return not_applied
@@ -0,0 +1,347 @@
+import asyncio
+import json
+import sqlite3
+import sys
+import time
+import traceback
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import aiohttp
+from gidgethub.aiohttp import GitHubAPI
+
+from marvin import constants
+from marvin import gh_util
+from marvin import mutations
+from marvin import supervision
+from marvin import tracing
+
+# Entries that are being applied right away are hidden from the drainer for
+# this long. If the process dies in the meantime, they are resumed on startup.
+IN_FLIGHT_SECONDS = 10 * 60
+# Installation access tokens are valid for an hour.
+TOKEN_REUSE_SECONDS = 50 * 60
+
+
+class Outbox:
+    """A durable queue of mutations that still have to be applied on GitHub.
+
+    Mutations are recorded before they are applied and only removed once
+    they succeeded. A background drainer applies recorded mutations in
+    batches, retries failed ones with exponential backoff and resumes
+    unfinished ones after a restart. Mutations of the same pull request are
+    never applied out of order.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        batch_size: int = 50,
+        max_attempts: int = 10,
+        retry_delay_seconds: float = 10,
+    ) -> None:
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay_seconds = retry_delay_seconds
+        self._db = sqlite3.connect(path)
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    installation_id TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    mutation TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL
+                )
+                """)
+        # Check for entries recorded by other processes this often, if set.
+        self.poll_seconds: Optional[float] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._drain_task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._tokens: Dict[str, Tuple[str, float]] = dict()
+
+    def record(
+        self,
+        installation_id: str,
+        mutation_list: List[mutations.Mutation],
+        in_flight: bool = False,
+    ) -> List[int]:
+        """Record mutations and return their entry ids.
+
+        Mutations recorded `in_flight` are being applied by the caller and are
+        left alone by the drainer until they are completed or retried.
+        """
+        next_attempt_at = time.time() + (IN_FLIGHT_SECONDS if in_flight else 0)
+        entry_ids: List[int] = []
+        with self._db:
+            for mutation in mutation_list:
+                cursor = self._db.execute(
+                    "INSERT INTO outbox (installation_id, key, mutation, next_attempt_at)"
+                    " VALUES (?, ?, ?, ?)",
+                    (
+                        str(installation_id),
+                        mutation.key,
+                        json.dumps(mutation.to_dict()),
+                        next_attempt_at,
+                    ),
+                )
+                assert cursor.lastrowid is not None
+                entry_ids.append(cursor.lastrowid)
+        if not in_flight:
+            self.wake()
+        return entry_ids
+
+    def complete(self, entry_id: int) -> None:
+        with self._db:
+            self._db.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+
+    def retry_later(self, entry_id: int) -> None:
+        """Schedule another attempt, giving up after max_attempts.
+
+        When giving up, the later entries of the same pull request are dropped
+        as well, since they would otherwise be applied out of order.
+        """
+        with self._db:
+            (key, attempts) = self._db.execute(
+                "SELECT key, attempts FROM outbox WHERE id = ?", (entry_id,)
+            ).fetchone()
+            attempts += 1
+            if attempts >= self.max_attempts:
+                cursor = self._db.execute(
+                    "DELETE FROM outbox WHERE key = ? AND id >= ?", (key, entry_id)
+                )
+                print(
+                    f"Giving up on outbox entry {entry_id} after {attempts} attempts,"
+                    f" dropping {cursor.rowcount} entries of {key}"
+                )
+                return
+            delay = self.retry_delay_seconds * 2 ** (attempts - 1)
+            self._db.execute(
+                "UPDATE outbox SET attempts = ?, next_attempt_at = ? WHERE id = ?",
+                (attempts, time.time() + delay, entry_id),
+            )
+        self.wake()
+
+    def due(self, now: float) -> List[Tuple[int, str, mutations.Mutation]]:
+        """Get the next batch of entries that are due.
+
+        Entries queue up behind earlier entries of the same pull request that
+        are not yet due.
+        """
+        rows = self._db.execute(
+            """
+            SELECT id, installation_id, mutation, attempts FROM outbox AS entry
+            WHERE next_attempt_at <= :now AND NOT EXISTS (
+                SELECT 1 FROM outbox AS earlier
+                WHERE earlier.key = entry.key
+                AND earlier.id < entry.id
+                AND earlier.next_attempt_at > :now
+            )
+            ORDER BY id
+            LIMIT :limit
+            """,
+            {"now": now, "limit": self.batch_size},
+        ).fetchall()
+        batch = []
+        for entry_id, installation_id, data, attempts in rows:
+            mutation = mutations.from_dict(json.loads(data))
+            mutation.attempts = attempts
+            batch.append((entry_id, installation_id, mutation))
+        return batch
+
+    def pending(self) -> int:
+        (count,) = self._db.execute("SELECT COUNT(*) FROM outbox").fetchone()
+        return count
+
+    def pending_for(self, key: str) -> int:
+        """Count the entries of a pull request that were not applied yet."""
+        (count,) = self._db.execute(
+            "SELECT COUNT(*) FROM outbox WHERE key = ?", (key,)
+        ).fetchone()
+        return count
+
+    def _next_due_in(self) -> Optional[float]:
+        (next_attempt_at,) = self._db.execute(
+            "SELECT MIN(next_attempt_at) FROM outbox"
+        ).fetchone()
+        due_in = self.poll_seconds
+        if next_attempt_at is not None:
+            next_due_in = max(0.0, next_attempt_at - time.time())
+            if due_in is None or next_due_in < due_in:
+                due_in = next_due_in
+        return due_in
+
+    def wake(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self, gh_app_id: str, gh_private_key: str) -> None:
+        """Resume unfinished entries and start draining in the background."""
+        with self._db:
+            self._db.execute("UPDATE outbox SET next_attempt_at = ?", (time.time(),))
+        print(f"Resuming {self.pending()} unfinished outbox entries")
+        self._wakeup = asyncio.Event()
+        self._drain_task = asyncio.create_task(
+            supervision.supervise(
+                "outbox_drain", lambda: self._drain(gh_app_id, gh_private_key)
+            )
+        )
+
+    async def stop(self) -> None:
+        """Apply the entries that are due, then stop draining.
+
+        Entries that are not due yet stay recorded for the next start.
+        """
+        self._stopping = True
+        if self._drain_task is not None:
+            self.wake()
+            await self._drain_task
+        remaining = self.pending()
+        if remaining > 0:
+            print(f"Leaving {remaining} outbox entries for the next start")
+
+    async def _get_token(
+        self, gh: GitHubAPI, installation_id: str, gh_app_id: str, gh_private_key: str
+    ) -> str:
+        token, fetched_at = self._tokens.get(installation_id, ("", 0.0))
+        if time.monotonic() - fetched_at < TOKEN_REUSE_SECONDS:
+            return token
+        result = await gh_util.get_installation_access_token(
+            gh,
+            installation_id=installation_id,
+            app_id=gh_app_id,
+            private_key=gh_private_key,
+        )
+        self._tokens[installation_id] = (result["token"], time.monotonic())
+        return result["token"]
+
+    async def _drain(self, gh_app_id: str, gh_private_key: str) -> None:
+        assert self._wakeup is not None
+        while True:
+            self._wakeup.clear()
+            batch = self.due(time.time())
+            if len(batch) == 0:
+                if self._stopping:
+                    return
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self._next_due_in())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            by_installation: Dict[str, List[Tuple[int, mutations.Mutation]]] = dict()
+            for entry_id, installation_id, mutation in batch:
+                by_installation.setdefault(installation_id, []).append(
+                    (entry_id, mutation)
+                )
+            try:
+                with tracing.cause("outbox", f"batch@{batch[0][0]}"):
+                    async with aiohttp.ClientSession() as session:
+                        gh = gh_util.InstrumentedGitHubAPI(session, constants.BOT_NAME)
+                        for installation_id, entries in by_installation.items():
+                            await self._apply(
+                                gh, installation_id, entries, gh_app_id, gh_private_key
+                            )
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+                await asyncio.sleep(self.retry_delay_seconds)
+
+    async def _apply(
+        self,
+        gh: GitHubAPI,
+        installation_id: str,
+        entries: List[Tuple[int, mutations.Mutation]],
+        gh_app_id: str,
+        gh_private_key: str,
+    ) -> None:
+        try:
+            token = await self._get_token(
+                gh, installation_id, gh_app_id, gh_private_key
+            )
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            for entry_id, _ in entries:
+                self.retry_later(entry_id)
+            return
+        await execute_recorded(gh, token, entries, constants.TRIAGE_WRITE_CONCURRENCY)
+
+
+# The outbox of this process. Mutations are applied directly if it is unset.
+outbox: Optional[Outbox] = None
+
+
+async def applied(key: str, timeout_seconds: float, poll_seconds: float = 0.1) -> bool:
+    """Wait until the recorded mutations of a pull request were applied.
+
+    Returns False if some are still pending after `timeout_seconds`, e.g.
+    because they failed and are retried later.
+    """
+    if outbox is None:
+        return True
+    deadline = time.monotonic() + timeout_seconds
+    while outbox.pending_for(key) > 0:
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(poll_seconds)
+    return True
+
+
+async def execute_recorded(
+    gh: GitHubAPI,
+    token: str,
+    entries: List[Tuple[int, mutations.Mutation]],
+    max_concurrency: int,
+) -> None:
+    """Apply recorded mutations, completing or retrying their entries."""
+    assert outbox is not None
+    not_applied = await mutations.execute(
+        gh, token, [mutation for _, mutation in entries], max_concurrency
+    )
+    failed = {id(mutation) for mutation in not_applied}
+    for entry_id, mutation in entries:
+        if id(mutation) in failed:
+            outbox.retry_later(entry_id)
+        else:
+            outbox.complete(entry_id)
+
+
+async def execute(
+    gh: GitHubAPI,
+    token: str,
+    installation_id: Optional[str],
+    mutation_list: List[mutations.Mutation],
+    max_concurrency: int,
+) -> None:
+    """Record mutations and apply them right away.
+
+    Mutations that fail are retried by the drainer.
+    """
+    if outbox is None or installation_id is None:
+        await mutations.execute(gh, token, mutation_list, max_concurrency)
+        return
+    entry_ids = outbox.record(installation_id, mutation_list, in_flight=True)
+    await execute_recorded(
+        gh, token, list(zip(entry_ids, mutation_list)), max_concurrency
+    )
+
+
+async def submit(
+    gh: GitHubAPI,
+    token: str,
+    installation_id: Optional[str],
+    mutation_list: List[mutations.Mutation],
+) -> None:
+    """Record mutations and leave them to the drainer.
+
+    This returns as soon as the mutations are recorded. Without an outbox, the
+    mutations are applied directly instead.
+    """
+    if outbox is None or installation_id is None:
+        for mutation in mutation_list:
+            await mutation.apply(gh, token)
+        return
+    outbox.record(installation_id, mutation_list)
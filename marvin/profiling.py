@@ -0,0 +1,160 @@
+import asyncio
+import collections
+import io
+import sys
+import threading
+import time
+from types import FrameType
+from typing import Any
+from typing import Counter
+from typing import Dict
+from typing import List
+from typing import Optional
+
+# Longest profile that can be requested at once.
+MAX_SECONDS = 5 * 60
+
+
+class AlreadyProfiling(Exception):
+    pass
+
+
+# Whether a profile is being taken. Only one can be taken at a time.
+active = False
+
+
+def frame_label(frame: FrameType) -> str:
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}:{frame.f_code.co_name}"
+
+
+def collapsed_stack(frame: Optional[FrameType]) -> str:
+    """Render a stack as a line of the collapsed format, outermost first."""
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+def sample(thread_id: int, seconds: float, interval_seconds: float) -> Counter[str]:
+    """Sample the stack of a thread for a while.
+
+    This is meant to run in another thread than the sampled one, which keeps
+    running undisturbed in the meantime. Nothing is installed in the sampled
+    thread, so there is no overhead when not sampling.
+    """
+    stacks: Counter[str] = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            stacks[collapsed_stack(frame)] += 1
+        del frame
+        time.sleep(interval_seconds)
+    return stacks
+
+
+def render_collapsed(stacks: Counter[str]) -> str:
+    """Render samples in the format of flamegraph.pl and speedscope."""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+async def sample_event_loop(seconds: float, interval_seconds: float = 0.005) -> str:
+    """Sample the thread of the running event loop and return collapsed stacks.
+
+    Idle time shows up as stacks ending in the selector.
+    """
+    loop = asyncio.get_event_loop()
+    return render_collapsed(
+        await loop.run_in_executor(
+            None, sample, threading.get_ident(), seconds, interval_seconds
+        )
+    )
+
+
+async def profile_event_loop(seconds: float, limit: int = 50) -> str:
+    """Profile all code on the event loop for a while and return pstats.
+
+    Unlike sampling, this slows down the event loop while profiling.
+    """
+    # Only loaded when needed, to keep the startup fast.
+    import cProfile
+    import pstats
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profile.disable()
+    output = io.StringIO()
+    stats = pstats.Stats(profile, stream=output)
+    stats.sort_stats("cumulative").print_stats(limit)
+    return output.getvalue()
+
+
+def await_chain(coroutine: Any) -> List[str]:
+    """The coroutines a suspended coroutine is waiting on, outermost first.
+
+    The chain ends at the first awaited object that is not a coroutine, e.g. a
+    future.
+    """
+    chain = []
+    while coroutine is not None and getattr(coroutine, "cr_frame", None) is not None:
+        frame = coroutine.cr_frame
+        chain.append(f"{frame_label(frame)} line {frame.f_lineno}")
+        coroutine = coroutine.cr_await
+    return chain
+
+
+def coroutine_of(task: "asyncio.Task[Any]") -> Any:
+    # Task.get_coro() needs Python 3.8.
+    return getattr(task, "_coro", None)
+
+
+def coroutine_name(task: "asyncio.Task[Any]") -> str:
+    coroutine = coroutine_of(task)
+    return getattr(coroutine, "__qualname__", repr(coroutine))
+
+
+def task_snapshots() -> List[Dict[str, Any]]:
+    """Describe all tasks of the running event loop and what they wait on."""
+    snapshots = []
+    for task in asyncio.all_tasks():
+        snapshots.append(
+            {
+                # Task names need Python 3.8.
+                "name": task.get_name() if hasattr(task, "get_name") else "",
+                "coroutine": coroutine_name(task),
+                "awaiting": await_chain(coroutine_of(task)),
+            }
+        )
+    return sorted(snapshots, key=lambda snapshot: snapshot["coroutine"])
+
+
+async def profile(seconds: float, profile_format: str) -> Dict[str, Any]:
+    """Profile the event loop for a while and snapshot its tasks afterwards.
+
+    The format is either "collapsed" (sampled stacks) or "pstats".
+    """
+    global active
+    if active:
+        raise AlreadyProfiling()
+    active = True
+    try:
+        seconds = max(0.0, min(seconds, MAX_SECONDS))
+        if profile_format == "collapsed":
+            result = await sample_event_loop(seconds)
+        elif profile_format == "pstats":
+            result = await profile_event_loop(seconds)
+        else:
+            raise ValueError(f"Unknown profile format {profile_format!r}")
+    finally:
+        active = False
+    return {
+        "seconds": seconds,
+        "format": profile_format,
+        "profile": result,
+        "tasks": task_snapshots(),
+    }
@@ -0,0 +1,137 @@
+from datetime import datetime
+from datetime import timezone
+import hashlib
+import json
+import sqlite3
+import time
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+from gidgethub.aiohttp import GitHubAPI
+
+from marvin import gh_util
+
+# How long clients may cache the queue status. Triage runs at most once a
+# minute, so the snapshots do not change more often.
+CACHE_SECONDS = 60
+# The queues triage does not search anyway are only counted every this many
+# runs, to spare the search rate limit.
+FULL_COUNT_RUNS = 10
+
+
+def queue_status(
+    count: int, oldest_created_at: Optional[str], taken_at: float
+) -> Dict[str, Any]:
+    """Describe a queue by its size and its oldest pull request.
+
+    The age of the oldest pull request is counted from its creation up to the
+    time the queue was looked at.
+    """
+    oldest_age_seconds = (
+        taken_at - gh_util.parse_time(oldest_created_at).timestamp()
+        if oldest_created_at is not None
+        else None
+    )
+    return {
+        "count": count,
+        "oldest_created_at": oldest_created_at,
+        "oldest_age_seconds": oldest_age_seconds,
+    }
+
+
+async def count_queue(
+    gh: GitHubAPI, token: str, repository_name: str, status: str
+) -> Dict[str, Any]:
+    """Look up the size and the oldest pull request of a queue.
+
+    A single search result is enough, GitHub counts all matches.
+    """
+    query = gh_util.SearchQuery(
+        repository_name, labels=[status, "marvin"], sort="created"
+    )
+    result = await gh.getitem(query.url(per_page=1), oauth_token=token)
+    oldest = result["items"][0]["created_at"] if len(result["items"]) > 0 else None
+    return queue_status(result["total_count"], oldest, time.time())
+
+
+class QueueSnapshots:
+    """The status queues of each repository as last seen by triage.
+
+    Each triage run records the size and the oldest pull request of the
+    status queues of a repository that it searched anyway. The other queues
+    are counted separately every FULL_COUNT_RUNS runs, and their last counts
+    are kept in between. The snapshots can then be served without any API
+    calls.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._db = sqlite3.connect(path)
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS queue_snapshots (
+                    repository TEXT PRIMARY KEY,
+                    queues TEXT NOT NULL,
+                    taken_at REAL NOT NULL
+                )
+                """)
+        # Runs per repository since all of its queues were counted.
+        self._runs: Dict[str, int] = dict()
+
+    def due_for_full_count(self, repository: str) -> bool:
+        return self._runs.get(repository, FULL_COUNT_RUNS) >= FULL_COUNT_RUNS
+
+    def record(
+        self, repository: str, queues: Dict[str, Dict[str, Any]], taken_at: float
+    ) -> None:
+        """Record the queues of a repository that were counted in a run.
+
+        Queues that were not counted keep their last count.
+        """
+        if set(queues) >= gh_util.ISSUE_STATUS_LABELS:
+            self._runs[repository] = 0
+        else:
+            self._runs[repository] = self._runs.get(repository, 0) + 1
+        row = self._db.execute(
+            "SELECT queues FROM queue_snapshots WHERE repository = ?", (repository,)
+        ).fetchone()
+        previous = json.loads(row[0]) if row is not None else dict()
+        queues = dict(queues)
+        for status, queue in previous.items():
+            if status not in queues:
+                # The age of the oldest pull request goes on regardless.
+                queues[status] = queue_status(
+                    queue["count"], queue["oldest_created_at"], taken_at
+                )
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO queue_snapshots VALUES (?, ?, ?)",
+                (repository, json.dumps(queues, sort_keys=True), taken_at),
+            )
+
+    def render(self) -> Tuple[bytes, str]:
+        """Render the snapshots of all repositories as JSON and tag them.
+
+        The ETag only changes when a snapshot does.
+        """
+        rows = self._db.execute(
+            "SELECT repository, queues, taken_at FROM queue_snapshots "
+            "ORDER BY repository"
+        ).fetchall()
+        snapshots = {
+            repository: {
+                "taken_at": gh_util.format_time(
+                    datetime.fromtimestamp(taken_at, timezone.utc)
+                ),
+                "queues": json.loads(queues),
+            }
+            for repository, queues, taken_at in rows
+        }
+        body = json.dumps(snapshots, sort_keys=True).encode()
+        return body, '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+# The queue snapshots of this process. They are kept in memory unless a
+# database is configured.
+snapshots = QueueSnapshots(":memory:")
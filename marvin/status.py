@@ -1,17 +1,24 @@
-import asyncio
 from typing import Any
 from typing import Dict
+from typing import Optional
 
 from gidgethub import routing
 from gidgethub import sansio
 from gidgethub.aiohttp import GitHubAPI
 
-from marvin import gh_util
+from marvin import coalesce
+from marvin import constants
+from marvin import outbox
 from marvin import triage_runner
 from marvin.command_router import CommandRouter
 
 router = routing.Router()
 command_router = CommandRouter()
+coalescer = coalesce.StatusCoalescer(constants.STATUS_COALESCE_SECONDS)
+
+# How long a status command waits for its status to be set before it triggers
+# triage anyway. GitHub gives up on a webhook delivery after ten seconds.
+NEW_STATUS_TIMEOUT_SECONDS = 5
 
 NO_SELF_REVIEW_TEXT = f"""
 The PR author cannot set the status to `needs_merger`. Please wait for an external review.
@@ -20,6 +27,12 @@ If you are not the PR author and you are reading this, please review the [usage]
 """.strip()
 
 
+def get_installation_id(event: sansio.Event) -> Optional[str]:
+    """Get the id of the installation that received the event, if any."""
+    installation = event.data.get("installation")
+    return installation["id"] if installation is not None else None
+
+
 # Unfortunately the opposite event does not currently exist:
 # https://github.community/t/no-webhook-event-for-convert-to-draft/14857
 @router.register("pull_request", action="ready_for_review")
@@ -33,7 +46,9 @@ async def pull_request_ready_for_review(
         and "awaiting_reviewer" not in labels
         and "awaiting_merger" not in labels
     ):
-        await gh_util.set_issue_status(issue, "needs_reviewer", gh, token)
+        await coalescer.set_issue_status(
+            issue, "needs_reviewer", gh, token, get_installation_id(event)
+        )
 
 
 @router.register("pull_request", action="synchronize")
@@ -47,8 +62,12 @@ async def pull_request_synchronize(
         or "awaiting_changes" in labels
         or "awaiting_merger" in labels
     ):
-        await gh_util.set_issue_status(
-            event.data["pull_request"], "awaiting_reviewer", gh, token
+        await coalescer.set_issue_status(
+            event.data["pull_request"],
+            "awaiting_reviewer",
+            gh,
+            token,
+            get_installation_id(event),
         )
 
 
@@ -59,8 +78,12 @@ async def pull_request_assigned(
 ) -> None:
     labels = {label["name"] for label in event.data["pull_request"]["labels"]}
     if "needs_reviewer" in labels:
-        await gh_util.set_issue_status(
-            event.data["pull_request"], "awaiting_reviewer", gh, token
+        await coalescer.set_issue_status(
+            event.data["pull_request"],
+            "awaiting_reviewer",
+            gh,
+            token,
+            get_installation_id(event),
         )
 
 
@@ -81,10 +104,14 @@ async def issue_comment_event(
     if by_pr_author and "awaiting_changes" in labels:
         # A new comment by the author is probably some justification or request
         # for clarification. Action of the reviewer is needed.
-        await gh_util.set_issue_status(issue, "awaiting_reviewer", gh, token)
+        await coalescer.set_issue_status(
+            issue, "awaiting_reviewer", gh, token, get_installation_id(event)
+        )
     elif not by_pr_author and "needs_reviewer" in labels:
         # A new comment indicates that someone is reviewing this PR.
-        await gh_util.set_issue_status(issue, "awaiting_reviewer", gh, token)
+        await coalescer.set_issue_status(
+            issue, "awaiting_reviewer", gh, token, get_installation_id(event)
+        )
 
 
 @router.register("pull_request_review", action="submitted")
@@ -108,12 +135,20 @@ async def pull_request_review_submitted(
         return
 
     if event.data["review"]["state"] == "changes_requested":
-        await gh_util.set_issue_status(
-            event.data["pull_request"], "awaiting_changes", gh, token
+        await coalescer.set_issue_status(
+            event.data["pull_request"],
+            "awaiting_changes",
+            gh,
+            token,
+            get_installation_id(event),
         )
     elif "needs_reviewer" in labels:
-        await gh_util.set_issue_status(
-            event.data["pull_request"], "awaiting_reviewer", gh, token
+        await coalescer.set_issue_status(
+            event.data["pull_request"],
+            "awaiting_reviewer",
+            gh,
+            token,
+            get_installation_id(event),
         )
 
 
@@ -121,23 +156,34 @@ async def pull_request_review_submitted(
 async def needs_reviewer_command(
     gh: GitHubAPI, event: sansio.Event, token: str, issue: Dict[str, Any], **kwargs: Any
 ) -> None:
-    await gh_util.set_issue_status(issue, "needs_reviewer", gh, token)
-    await asyncio.sleep(2)  # Make sure the new label has "set".
-    triage_runner.runners[event.data["installation"]["id"]].run_soon(gh, token)
+    await coalescer.set_issue_status(
+        issue, "needs_reviewer", gh, token, get_installation_id(event), flush=True
+    )
+    # The status change is only recorded in the outbox, but triage should
+    # find the pull request in the needs_reviewer queue. Depending on whether
+    # the issue is actually a pull request:
+    issue_url = issue.get("issue_url", issue["url"])
+    if not await outbox.applied(issue_url, NEW_STATUS_TIMEOUT_SECONDS):
+        print(f"Status of {issue_url} not set yet, triaging anyway")
+    triage_runner.scheduler.run_soon(event.data["installation"]["id"])
 
 
 @command_router.register_command("/status awaiting_changes")
 async def awaiting_changes_command(
-    gh: GitHubAPI, token: str, issue: Dict[str, Any], **kwargs: Any
+    gh: GitHubAPI, event: sansio.Event, token: str, issue: Dict[str, Any], **kwargs: Any
 ) -> None:
-    await gh_util.set_issue_status(issue, "awaiting_changes", gh, token)
+    await coalescer.set_issue_status(
+        issue, "awaiting_changes", gh, token, get_installation_id(event), flush=True
+    )
 
 
 @command_router.register_command("/status awaiting_reviewer")
 async def awaiting_reviewer_command(
-    gh: GitHubAPI, token: str, issue: Dict[str, Any], **kwargs: Any
+    gh: GitHubAPI, event: sansio.Event, token: str, issue: Dict[str, Any], **kwargs: Any
 ) -> None:
-    await gh_util.set_issue_status(issue, "awaiting_reviewer", gh, token)
+    await coalescer.set_issue_status(
+        issue, "awaiting_reviewer", gh, token, get_installation_id(event), flush=True
+    )
 
 
 @command_router.register_command("/status needs_merger")
@@ -158,14 +204,17 @@ async def needs_merger_command(
             oauth_token=token,
         )
     else:
-        await gh_util.set_issue_status(issue, "needs_merger", gh, token)
-        triage_runner.runners[event.data["installation"]["id"]].run_soon(gh, token)
+        await coalescer.set_issue_status(
+            issue, "needs_merger", gh, token, get_installation_id(event), flush=True
+        )
+        triage_runner.scheduler.run_soon(event.data["installation"]["id"])
 
 
 @command_router.register_command("/status awaiting_merger")
 async def awaiting_merger_command(
     gh: GitHubAPI,
     token: str,
+    event: sansio.Event,
     issue: Dict[str, Any],
     comment: Dict[str, Any],
     **kwargs: Any,
@@ -178,4 +227,6 @@ async def awaiting_merger_command(
             oauth_token=token,
         )
     else:
-        await gh_util.set_issue_status(issue, "awaiting_merger", gh, token)
+        await coalescer.set_issue_status(
+            issue, "awaiting_merger", gh, token, get_installation_id(event), flush=True
+        )
@@ -0,0 +1,45 @@
+import asyncio
+import sys
+import time
+import traceback
+from typing import Awaitable
+from typing import Callable
+
+from marvin import metrics
+
+TASK_RESTARTS = metrics.Counter(
+    "marvin_task_restarts",
+    "Restarts of background tasks after they failed.",
+    ["task"],
+)
+
+
+async def supervise(
+    name: str,
+    run: Callable[[], Awaitable[None]],
+    initial_backoff_seconds: float = 1,
+    max_backoff_seconds: float = 5 * 60,
+) -> None:
+    """Run a background task, restarting it whenever it fails.
+
+    The delay before a restart doubles with every failure up to
+    `max_backoff_seconds`. It is reset once the task ran for longer than that
+    without failing.
+    """
+    backoff = initial_backoff_seconds
+    while True:
+        started = time.monotonic()
+        try:
+            await run()
+            return
+        except asyncio.CancelledError:
+            # Not an Exception since Python 3.8, but it is before.
+            raise
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+        if time.monotonic() - started > max_backoff_seconds:
+            backoff = initial_backoff_seconds
+        print(f"Task {name} failed, restarting in {backoff:.0f} seconds")
+        TASK_RESTARTS.inc(name)
+        await asyncio.sleep(backoff)
+        backoff = min(2 * backoff, max_backoff_seconds)
@@ -2,44 +2,107 @@ import asyncio
 from datetime import datetime
 from datetime import timedelta
 from datetime import timezone
+import json
+import math
+import os
 import random
+import sys
+import time
+import traceback
 from typing import Any
 from typing import Awaitable
 from typing import Callable
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
 from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+from typing import TypeVar
 
 from gidgethub import aiohttp as gh_aiohttp
 
+from marvin import constants
 from marvin import gh_util
+from marvin import metrics
+
+T = TypeVar("T")
+
+REVIEWER_PROBES = metrics.Counter(
+    "marvin_reviewer_probes",
+    "Reviewer candidates tested by get_reviewer by outcome.",
+    ["outcome"],
+)
+
+
+GIST_FETCHES = metrics.Counter(
+    "marvin_gist_fetches",
+    "Fetches of availability control gists by outcome.",
+    ["outcome"],
+)
 
 
 class Reviewer:
+    """A member of the team.
+
+    With a `gist`, the reviewer only gets requests while the content of that
+    gist is "enable".
+    """
+
     def __init__(
-        self, gh_name: str, can_merge: bool = False,
+        self, gh_name: str, can_merge: bool = False, gist: Optional[str] = None
     ):
         self.gh_name = gh_name
         self.can_merge = can_merge
+        self.gist = gist
+        self.control = gist_controlled(gist) if gist is not None else None
 
-    async def request_allowed(self, gh: gh_aiohttp.GitHubAPI, token: str) -> bool:
+    async def request_allowed(
+        self, gh: gh_aiohttp.GitHubAPI, token: str, pending: int = 0
+    ) -> bool:
+        if self.control is not None and not await self.control(gh, token):
+            print(f"Disabled by gist {self.gist}.")
+            return False
         return True
 
 
 class ActivityLimitedReviewer(Reviewer):
-    def __init__(self, gh_name: str, days: int, limit: int, can_merge: bool = False):
-        super().__init__(gh_name, can_merge)
+    def __init__(
+        self,
+        gh_name: str,
+        days: int,
+        limit: int,
+        can_merge: bool = False,
+        gist: Optional[str] = None,
+    ):
+        super().__init__(gh_name, can_merge, gist)
         self.days = days
         self.limit = limit
         self.cached_no_until = datetime.now(timezone.utc)
 
-    async def request_allowed(self, gh: gh_aiohttp.GitHubAPI, token: str) -> bool:
+    async def request_allowed(
+        self, gh: gh_aiohttp.GitHubAPI, token: str, pending: int = 0
+    ) -> bool:
         """Determine whether a given active PR limit over a timeframe has already been reached.
 
         This searches GitHub for recently active nixpkgs PRs the user is involved
         in (ignoring any activity after the PR was merged) and compares the number
         of results to a limit. This is useful when you want to only get a request
         for new reviews when your current open-source work "plate" is not yet full.
+
+        `pending` review requests that are planned but not yet sent count
+        towards the limit as well.
         """
+        if not await super().request_allowed(gh, token, pending):
+            return False
+
+        limit = self.limit - pending
+        if limit <= 0:
+            print(f"Limit ({self.limit}/{self.days}d) reached by pending requests.")
+            return False
+
         if datetime.now(timezone.utc) < self.cached_no_until:
             print(
                 f"Cached: Limit ({self.limit}/{self.days}d) exceeded until {self.cached_no_until}."
@@ -49,47 +112,93 @@ class ActivityLimitedReviewer(Reviewer):
         # GitHub rate limits us to 30 searches per minute. This prevents us
         # from exceeding that limit. Not pretty but it works for now. Shouldn't
         # slow the reviewer search down too much due to caching.
-        await asyncio.sleep(3)
-        timeframe_start = (
-            datetime.now(timezone.utc) - timedelta(days=self.days)
-        ).strftime("%Y-%m-%dT%H:%M:%S+00:00")
-        search_results = gh_util.search_issues(
+        await asyncio.sleep(constants.REVIEWER_SEARCH_PACING_SECONDS)
+        timeframe_start = datetime.now(timezone.utc) - timedelta(days=self.days)
+        async with gh_util.search_issues(
             gh,
             token,
-            query_parameters=[
-                "repo:NixOS/nixpkgs",
-                f"involves:{self.gh_name}",
-                f"updated:>={timeframe_start}",
-                f"-merged:<{timeframe_start}",
-            ],
-        )
-        cur_issue = 0
-        async for issue in search_results:
-            cur_issue += 1
-            if cur_issue == self.limit:
-                last_updated = datetime.strptime(
-                    issue["updated_at"], "%Y-%m-%dT%H:%M:%S%z"
-                )
-                # Remember when the PR that pushed us over the limit will "fall
-                # out" of the time window.
-                self.cached_no_until = last_updated + timedelta(days=self.days)
-                print(
-                    f"Limit ({self.limit}/{self.days}d) exceeded until {self.cached_no_until}."
-                )
-                return False
+            gh_util.SearchQuery(
+                "NixOS/nixpkgs",
+                state=None,
+                involves=self.gh_name,
+                updated_since=timeframe_start,
+                not_merged_before=timeframe_start,
+                # Activity on issues counts as well.
+                is_pr=False,
+            ),
+        ) as search_results:
+            cur_issue = 0
+            async for issue in search_results:
+                cur_issue += 1
+                if cur_issue == limit:
+                    last_updated = gh_util.parse_time(issue["updated_at"])
+                    # Remember when the PR that pushed us over the limit will
+                    # "fall out" of the time window.
+                    self.cached_no_until = last_updated + timedelta(days=self.days)
+                    print(
+                        f"Limit ({self.limit}/{self.days}d) exceeded until {self.cached_no_until}."
+                    )
+                    return False
 
         return True
 
 
-async def fetch_gist_content(gh: gh_aiohttp.GitHubAPI, gist_id: str) -> str:
-    """Fetch the content of a one-file github gist using the API."""
-    # Not authenticated on purpose
-    # https://github.community/t/github-apps-gist-api/13806. This may lead to
-    # rate limiting issues in the future.
-    gist_response = await gh.getitem(f"https://api.github.com/gists/{gist_id}")
-    # We only support one file per gist, just pick the first one
-    gist_file = list(gist_response["files"].values())[0]
-    return gist_file["content"]
+class GistCache:
+    """The contents of the gists that control the availability of reviewers.
+
+    All gists are fetched concurrently once per triage run and decisions are
+    then served from memory. A gist is only fetched again once it is older
+    than `ttl_seconds`, with a conditional request so that an unchanged gist
+    does not count against the rate limit. If a fetch fails, the last known
+    content is used and the fetch is only retried after the TTL as well.
+    """
+
+    def __init__(self, ttl_seconds: float) -> None:
+        self.ttl_seconds = ttl_seconds
+        # Content and ETag by gist id.
+        self._gists: Dict[str, Tuple[str, Optional[str]]] = dict()
+        self._fetched_at: Dict[str, float] = dict()
+
+    def content(self, gist_id: str) -> Optional[str]:
+        """The last known content of a gist, if any."""
+        cached = self._gists.get(gist_id)
+        return cached[0] if cached is not None else None
+
+    async def refresh(self, gh: gh_aiohttp.GitHubAPI, gist_ids: Iterable[str]) -> None:
+        """Fetch the given gists that are not cached or older than the TTL."""
+        now = time.monotonic()
+        stale = [
+            gist_id
+            for gist_id in set(gist_ids)
+            if now - self._fetched_at.get(gist_id, -math.inf) >= self.ttl_seconds
+        ]
+        await asyncio.gather(*(self._fetch(gh, gist_id) for gist_id in stale))
+
+    async def _fetch(self, gh: gh_aiohttp.GitHubAPI, gist_id: str) -> None:
+        self._fetched_at[gist_id] = time.monotonic()
+        cached = self._gists.get(gist_id)
+        etag = cached[1] if cached is not None else None
+        try:
+            # Not authenticated on purpose
+            # https://github.community/t/github-apps-gist-api/13806.
+            gist, etag = await gh_util.get_if_changed(gh, f"/gists/{gist_id}", etag)
+        except Exception:
+            GIST_FETCHES.inc("failed")
+            print(f"Fetching gist {gist_id} failed, using the last known content:")
+            traceback.print_exc(file=sys.stderr)
+            return
+        if gist is None:
+            GIST_FETCHES.inc("not_modified")
+            assert cached is not None
+            content = cached[0]
+        else:
+            GIST_FETCHES.inc("modified")
+            # We only support one file per gist, just pick the first one
+            content = list(gist["files"].values())[0]["content"]
+        self._gists[gist_id] = (content, etag)
+
+
+gists = GistCache(constants.GIST_CACHE_SECONDS)
 
 
 def gist_controlled(
@@ -99,40 +208,114 @@ def gist_controlled(
 
     This enables decentralized control. People can decide to enable or disable
     review request at any time, without having to go through a PR and deploy
-    process.
+    process. The gist is read from the `gists` cache, which triage refreshes
+    for all members at once. Without any known content, requests are disabled.
     """
 
     async def control_function(gh: gh_aiohttp.GitHubAPI, token: str) -> bool:
-        return (await fetch_gist_content(gh, gist_id)).strip() == "enable"
+        await gists.refresh(gh, [gist_id])
+        content = gists.content(gist_id)
+        return content is not None and content.strip() == "enable"
 
     return control_function
 
 
-TEAM = {
-    ActivityLimitedReviewer(
-        gh_name="timokau",
-        days=1,
-        limit=100,  # practically no limit on merge for now
-        can_merge=True,
-    ),
-    ActivityLimitedReviewer(gh_name="timokau", days=1, limit=1),
-    ActivityLimitedReviewer(gh_name="fgaz", days=7, limit=2),
-    ActivityLimitedReviewer(gh_name="glittershark", days=7, limit=2),
-    ActivityLimitedReviewer(gh_name="kevincox", days=7, limit=7),
-    ActivityLimitedReviewer(gh_name="kevincox", days=7, limit=28, can_merge=True),
-    ActivityLimitedReviewer(gh_name="turion", days=7, limit=3),
-    ActivityLimitedReviewer(gh_name="symphorien", days=7, limit=3),
-    ActivityLimitedReviewer(gh_name="Ekleog", days=3, limit=1),
-    ActivityLimitedReviewer(gh_name="Ekleog", days=3, limit=3, can_merge=True),
-    ActivityLimitedReviewer(gh_name="lovesegfault", days=3, limit=1),
-    ActivityLimitedReviewer(gh_name="lovesegfault", days=7, limit=7, can_merge=True),
-    ActivityLimitedReviewer(gh_name="thiagokokada", days=7, limit=5),
-    ActivityLimitedReviewer(gh_name="supersandro2000", days=1, limit=25),
-    ActivityLimitedReviewer(
-        gh_name="supersandro2000", days=1, limit=25, can_merge=True
-    ),
-    ActivityLimitedReviewer(gh_name="asymmetric", days=7, limit=3),
-}
+def from_config(entry: Dict[str, Any]) -> Reviewer:
+    """Create a team member from an entry of the roster file."""
+    if "days" in entry or "limit" in entry:
+        return ActivityLimitedReviewer(**entry)
+    return Reviewer(**entry)
+
+
+class Roster:
+    """The team of reviewers, loaded from a JSON file.
+
+    The file contains a list of members such as
+    `{"gh_name": "timokau", "days": 7, "limit": 3, "can_merge": false}`. A
+    person may be listed several times, e.g. with different limits for
+    reviewing and merging. The file is reloaded when it changes, keeping the
+    cached limits of members whose entry did not change. Members are indexed
+    by role to select reviewers, and by login to look up all entries of a
+    person.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path
+        self.members: List[Reviewer] = []
+        # Members by whether they can merge.
+        self.by_role: Dict[bool, List[Reviewer]] = {True: [], False: []}
+        self.by_login: Dict[str, List[Reviewer]] = dict()
+        self._entries: Dict[str, Reviewer] = dict()
+        self._mtime: Optional[float] = None
+        if path is not None:
+            self.reload_if_changed()
+
+    def load(self, entries: List[Dict[str, Any]]) -> None:
+        """Replace the members, reusing the members of unchanged entries."""
+        # Only replace anything once every entry is valid.
+        loaded: Dict[str, Reviewer] = dict()
+        for entry in entries:
+            key = json.dumps(entry, sort_keys=True)
+            loaded[key] = self._entries.get(key) or from_config(entry)
+        self._entries = loaded
+        self.members = list(self._entries.values())
+        self.by_role = {True: [], False: []}
+        self.by_login = dict()
+        for member in self.members:
+            self.by_role[member.can_merge].append(member)
+            self.by_login.setdefault(member.gh_name, []).append(member)
+
+    def gist_ids(self) -> Set[str]:
+        """The gists controlling the availability of members."""
+        return {member.gist for member in self.members if member.gist is not None}
+
+    def reload_if_changed(self) -> None:
+        """Reload the roster file if it was modified since the last load.
+
+        An invalid file is reported and the current members are kept.
+        """
+        assert self.path is not None
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self._mtime:
+                return
+            with open(self.path) as roster_file:
+                self.load(json.load(roster_file))
+            self._mtime = mtime
+            print(f"Loaded {len(self.members)} team members from {self.path}")
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+
+
+roster = Roster(constants.TEAM_CONFIG_PATH)
+
+
+def shuffled(items: Sequence[T]) -> Iterator[T]:
+    """Iterate over items in random order.
+
+    Items are only shuffled as far as they are consumed, so stopping early
+    is cheap.
+    """
+    pool = list(items)
+    for i in range(len(pool)):
+        j = random.randrange(i, len(pool))
+        pool[i], pool[j] = pool[j], pool[i]
+        yield pool[i]
+
+
+def next_capacity_change() -> Optional[datetime]:
+    """Find the earliest time at which an exhausted reviewer regains capacity.
+
+    Only considers the cached limits, so this is a cheap lower bound for when
+    another triage run could assign a new reviewer.
+    """
+    now = datetime.now(timezone.utc)
+    limits: List[datetime] = [
+        member.cached_no_until
+        for member in roster.members
+        if isinstance(member, ActivityLimitedReviewer) and member.cached_no_until > now
+    ]
+    return min(limits, default=None)
 
 
 async def get_reviewer(
@@ -140,32 +323,36 @@ async def get_reviewer(
     token: str,
     issue: Dict[str, Any],
     merge_permission_needed: bool,
+    planned: Optional[Dict[str, int]] = None,
 ) -> Optional[str]:
-    """Attempt to find a random reviewer that is currently allowing requests."""
+    """Attempt to find a random reviewer that is currently allowing requests.
 
-    candidates = TEAM
-    if merge_permission_needed:
-        candidates = {member for member in candidates if member.can_merge}
-    else:
-        # For now people should sign up with two different "Memeber" listings
-        # if they want to review both kinds of PRs. This allows for different
-        # rate limits.
-        candidates = {member for member in candidates if not member.can_merge}
+    `planned` counts the review requests per reviewer that were already
+    decided on but not yet sent.
+    """
+    if planned is None:
+        planned = dict()
 
-    print(
-        f"Selecting reviewer from candidates: {[candidate.gh_name for candidate in candidates]}"
-    )
+    # For now people should sign up with two different "Memeber" listings
+    # if they want to review both kinds of PRs. This allows for different
+    # rate limits.
+    candidates = roster.by_role[merge_permission_needed]
+    print(f"Selecting reviewer from {len(candidates)} candidates")
 
     pr_author_login = issue["user"]["login"]
+    excluded = set(roster.by_login.get(pr_author_login, []))
 
     # Go through candidates in random order and return the first that is
     # willing to review.
-    for candidate in random.sample(candidates, len(candidates)):
-        if candidate.gh_name == pr_author_login:
+    for candidate in shuffled(candidates):
+        if candidate in excluded:
             print(f"Skipping pr author {pr_author_login}")
             continue
         print(f"Testing {candidate.gh_name}")
-        if await candidate.request_allowed(gh, token):
+        pending = planned.get(candidate.gh_name, 0)
+        if await candidate.request_allowed(gh, token, pending):
+            REVIEWER_PROBES.inc("allowed")
             return candidate.gh_name
+        REVIEWER_PROBES.inc("denied")
 
     return None
@@ -0,0 +1,123 @@
+import collections
+import contextlib
+import contextvars
+import time
+from typing import Any
+from typing import Deque
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+import urllib.parse
+
+from marvin import constants
+from marvin import metrics
+
+CALLS_BY_CAUSE = metrics.Counter(
+    "marvin_github_api_calls_by_cause",
+    "GitHub API calls by the kind of work that caused them.",
+    ["cause"],
+)
+
+# What caused the GitHub API calls in the current context: the kind of work
+# (e.g. "issue_comment.created" or "triage.assign_reviewers") and an id of the
+# specific piece of work (e.g. the delivery id).
+current_cause: "contextvars.ContextVar[Tuple[str, str]]" = contextvars.ContextVar(
+    "current_cause", default=("unknown", "")
+)
+
+
+class ApiCall:
+    """A GitHub API call as recorded for tracing."""
+
+    def __init__(
+        self,
+        method: str,
+        url: str,
+        status: Optional[int],
+        latency_seconds: float,
+        response_bytes: int,
+        rate_limit_resource: Optional[str],
+        rate_limit_remaining: Optional[int],
+    ) -> None:
+        self.time = time.time()
+        self.method = method
+        self.url_template = url_template(url)
+        self.status = status
+        self.latency_seconds = latency_seconds
+        self.response_bytes = response_bytes
+        self.rate_limit_resource = rate_limit_resource
+        self.rate_limit_remaining = rate_limit_remaining
+        self.cause, self.cause_id = current_cause.get()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(vars(self))
+
+
+# The most recent API calls.
+calls: Deque[ApiCall] = collections.deque(maxlen=constants.API_TRACE_SIZE)
+
+
+def url_template(url: str) -> str:
+    """Replace the variable parts of an API URL by placeholders.
+
+    >>> url_template("https://api.github.com/repos/NixOS/nixpkgs/issues/42/labels/marvin")
+    '/repos/{owner}/{repo}/issues/{number}/labels/{name}'
+    >>> url_template("https://api.github.com/search/issues?q=is%3Apr")
+    '/search/issues'
+    """
+    parts = urllib.parse.urlsplit(url).path.strip("/").split("/")
+    template = []
+    for i, part in enumerate(parts):
+        previous = parts[i - 1] if i >= 1 else None
+        if part.isdigit():
+            template.append("{number}")
+        elif previous == "repos":
+            template.append("{owner}")
+        elif i >= 2 and parts[i - 2] == "repos":
+            template.append("{repo}")
+        elif previous == "labels":
+            template.append("{name}")
+        elif previous == "gists":
+            template.append("{gist_id}")
+        else:
+            template.append(part)
+    return "/" + "/".join(template)
+
+
+@contextlib.contextmanager
+def cause(kind: str, cause_id: Optional[str] = None) -> Iterator[None]:
+    """Attribute the API calls made within a block to some kind of work.
+
+    Without a `cause_id`, the id of the enclosing cause is kept.
+    """
+    if cause_id is None:
+        _, cause_id = current_cause.get()
+    reset_token = current_cause.set((kind, cause_id))
+    try:
+        yield
+    finally:
+        current_cause.reset(reset_token)
+
+
+def record(call: ApiCall) -> None:
+    calls.append(call)
+    CALLS_BY_CAUSE.inc(call.cause)
+
+
+def summary() -> Dict[str, Dict[str, float]]:
+    """Summarize the recorded calls per kind of cause."""
+    by_cause: Dict[str, List[ApiCall]] = dict()
+    for call in calls:
+        by_cause.setdefault(call.cause, []).append(call)
+    result = dict()
+    for kind, kind_calls in by_cause.items():
+        causes = len({call.cause_id for call in kind_calls})
+        result[kind] = {
+            "calls": len(kind_calls),
+            "causes": causes,
+            "calls_per_cause": len(kind_calls) / causes,
+            "latency_seconds": sum(call.latency_seconds for call in kind_calls),
+        }
+    return result
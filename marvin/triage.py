@@ -1,21 +1,50 @@
 import asyncio
+import contextlib
 from datetime import datetime
+from datetime import timedelta
 from datetime import timezone
+import time
 from typing import Any
 from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
 
 from gidgethub import sansio
 from gidgethub.aiohttp import GitHubAPI
 
+from marvin import constants
 from marvin import gh_util
+from marvin import metrics
+from marvin import mutations
+from marvin import outbox
+from marvin import queues
 from marvin import team
+from marvin import tracing
 from marvin import triage_runner
 from marvin.command_router import CommandRouter
-from marvin.gh_util import post_comment
-from marvin.gh_util import set_issue_status
 
 command_router = CommandRouter()
 
+# Set when shutting down. Running triage then stops planning further changes,
+# but still executes those that are already planned.
+stopping = False
+
+TRIAGE_PHASE_SECONDS = metrics.Histogram(
+    "marvin_triage_phase_seconds",
+    "Duration of the phases of a triage run.",
+    ["phase"],
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+
+
+@contextlib.contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Measure a triage phase and attribute its API calls to it."""
+    with TRIAGE_PHASE_SECONDS.time(name), tracing.cause("triage." + name):
+        yield
+
+
 AFTER_WARNING_SECONDS = 60 * 60 * 24 * 1  # one day
 AWAITING_REVIEWER_TIMEOUT_SECONDS = 60 * 60 * 24 * 3  # three days
 AWAITING_MERGER_TIMEOUT_SECONDS = 60 * 60 * 24 * 3  # three days
@@ -23,184 +52,292 @@ AWAITING_MERGER_TIMEOUT_SECONDS = 60 * 60 * 24 * 3  # three days
 REVIEW_REMINDER_TEXT = """
 **Reminder: Please review!**
 
-This Pull Request is awaiting review. If you are the assigned reviewer, please have a look. Try to find another reviewer if necessary. If you can't, please say so. If the status is not accurate, please change it. If nothing happens, this PR ~will be~ should be put back in the `needs_reviewer` queue in one day.
-
----
-
-Note: This feature is currently broken. The bot will not actually change the status. If you see this message multiple times, please request a status change manually.
+This Pull Request is awaiting review. If you are the assigned reviewer, please have a look. Try to find another reviewer if necessary. If you can't, please say so. If the status is not accurate, please change it. If nothing happens, this PR will be put back in the `needs_reviewer` queue in one day.
 """.strip()
 MERGE_REMINDER_TEXT = """
 **Reminder: Please review!**
 
-Reminder: This Pull Request is **awaiting merger**. If you are the assigned reviewer with commit permission, please have a look. If you can't, please say so. If the status is not accurate, please change it. If nothing happens, this PR ~will be~ should be put back in the `needs_reviewer` queue in one day.
+Reminder: This Pull Request is **awaiting merger**. If you are the assigned reviewer with commit permission, please have a look. If you can't, please say so. If the status is not accurate, please change it. If nothing happens, this PR will be put back in the `needs_merger` queue in one day.
+""".strip()
+
 
----
+class TriageResult:
+    """The changes a triage run plans to make.
 
-Note: This feature is currently broken. The bot will not actually change the status. If you see this message multiple times, please request a status change manually.
-""".strip()
+    The summary is used to adapt the triage interval to the activity in the
+    queues.
+    """
 
+    def __init__(self) -> None:
+        self.mutations: List[mutations.Mutation] = []
+        # Number of planned review requests per reviewer.
+        self.reviewers: Dict[str, int] = dict()
+        self.status_changes = 0
+        self.reminders = 0
+        self.review_requests = 0
+        # PRs that needed a reviewer but no reviewer had capacity.
+        self.unassigned = 0
+        # The earliest time at which a currently exhausted reviewer regains
+        # capacity, if any.
+        self.capacity_frees_at: Optional[datetime] = None
+        # The status queues by repository and status (see queues.queue_status).
+        self.queues: Dict[str, Dict[str, Dict[str, Any]]] = dict()
 
-async def timeout_awaiting_reviewer(
-    gh: GitHubAPI, token: str, repository_name: str
-) -> None:
-    print("Timing out awaiting_reviewer PRs")
-    search_results = gh_util.search_issues(
-        gh,
-        token,
-        query_parameters=[
-            f"repo:{repository_name}",
-            "is:open",
-            "is:pr",
-            "label:timeout_pending",
-            "label:awaiting_reviewer",
-            "label:marvin",
-            "sort:updated-asc",  # stale first
-        ],
-    )
-    async for issue in search_results:
-        last_updated = datetime.strptime(issue["updated_at"], "%Y-%m-%dT%H:%M:%S%z")
-        age = datetime.now(timezone.utc) - last_updated
-        if age.total_seconds() < AFTER_WARNING_SECONDS:
-            break
+    @property
+    def changes(self) -> int:
+        return self.status_changes + self.reminders + self.review_requests
 
-        print(
-            f"awaiting_reviewer -> needs_reviewer: #{issue['number']} ({issue['title']})"
+    def record_queue(
+        self,
+        repository_name: str,
+        status: str,
+        search_results: gh_util.SearchResults,
+        oldest_created_at: Optional[str],
+    ) -> None:
+        """Record a queue that was searched oldest first."""
+        assert search_results.total_count is not None
+        self.queues.setdefault(repository_name, dict())[status] = queues.queue_status(
+            search_results.total_count, oldest_created_at, time.time()
         )
-        await set_issue_status(issue, "needs_reviewer", gh, token)
 
-    print("Posting warnings in awaiting_review PRs")
-    search_results = gh_util.search_issues(
+    def plan(self, mutation: mutations.Mutation) -> None:
+        self.mutations.append(mutation)
+        if isinstance(mutation, mutations.SetStatus):
+            self.status_changes += 1
+        elif isinstance(mutation, mutations.PostComment):
+            self.reminders += 1
+        elif isinstance(mutation, mutations.RequestReview):
+            self.review_requests += 1
+            self.reviewers[mutation.reviewer] = (
+                self.reviewers.get(mutation.reviewer, 0) + 1
+            )
+
+
+async def remind_or_timeout(
+    gh: GitHubAPI,
+    token: str,
+    repository_name: str,
+    result: TriageResult,
+    status: str,
+    timeout_status: str,
+    reminder_text: str,
+    reminder_after_seconds: int,
+) -> None:
+    """Remind stale PRs of a status and time out those that stayed stale.
+
+    A reminder is posted once a PR had no activity for reminder_after_seconds.
+    The PR is then marked with the timeout_pending label, which the next
+    status change removes again. If nothing happens in the
+    AFTER_WARNING_SECONDS after that, the PR is set to timeout_status. Since
+    the label is kept on GitHub, a reminder is not repeated even when marvin
+    is restarted in between.
+    """
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(seconds=AFTER_WARNING_SECONDS)
+    async with gh_util.search_issues(
         gh,
         token,
-        query_parameters=[
-            f"repo:{repository_name}",
-            "is:open",
-            "is:pr",
-            "label:awaiting_reviewer",
-            "-label:timeout_pending",
-            "label:marvin",
-            "sort:updated-asc",
-        ],
-    )
-    async for issue in search_results:
-        last_updated = datetime.strptime(issue["updated_at"], "%Y-%m-%dT%H:%M:%S%z")
-        age = datetime.now(timezone.utc) - last_updated
-        if age.total_seconds() < AWAITING_REVIEWER_TIMEOUT_SECONDS:
-            break
+        gh_util.SearchQuery(
+            repository_name,
+            labels=["timeout_pending", status, "marvin"],
+            updated_before=cutoff,
+            sort="updated",  # stale first
+        ),
+    ) as search_results:
+        async for issue in search_results:
+            if gh_util.parse_time(issue["updated_at"]) >= cutoff:
+                break  # the search index may lag behind
+            print(
+                f"{status} -> {timeout_status}: #{issue['number']} ({issue['title']})"
+            )
+            result.plan(mutations.SetStatus(issue, timeout_status))
 
-        print(f"awaiting_reviewer reminder: #{issue['number']} ({issue['title']})")
-        await post_comment(gh, token, issue["comments_url"], REVIEW_REMINDER_TEXT)
+    cutoff = now - timedelta(seconds=reminder_after_seconds)
+    async with gh_util.search_issues(
+        gh,
+        token,
+        gh_util.SearchQuery(
+            repository_name,
+            labels=[status, "marvin"],
+            excluded_labels=["timeout_pending"],
+            updated_before=cutoff,
+            sort="updated",
+        ),
+    ) as search_results:
+        async for issue in search_results:
+            if gh_util.parse_time(issue["updated_at"]) >= cutoff:
+                break  # the search index may lag behind
+            print(f"{status} reminder: #{issue['number']} ({issue['title']})")
+            result.plan(mutations.PostReminder(issue, reminder_text))
 
 
-async def timeout_awaiting_merger(
-    gh: GitHubAPI, token: str, repository_name: str
+async def timeout_awaiting_reviewer(
+    gh: GitHubAPI, token: str, repository_name: str, result: TriageResult
 ) -> None:
-    print("Timing out awaiting_merger PRs")
-    search_results = gh_util.search_issues(
+    print("Reminding and timing out awaiting_reviewer PRs")
+    await remind_or_timeout(
         gh,
         token,
-        query_parameters=[
-            f"repo:{repository_name}",
-            "is:open",
-            "is:pr",
-            "label:timeout_pending",
-            "label:awaiting_merger",
-            "label:marvin",
-            "sort:updated-asc",  # stale first
-        ],
+        repository_name,
+        result,
+        status="awaiting_reviewer",
+        timeout_status="needs_reviewer",
+        reminder_text=REVIEW_REMINDER_TEXT,
+        reminder_after_seconds=AWAITING_REVIEWER_TIMEOUT_SECONDS,
     )
-    async for issue in search_results:
-        last_updated = datetime.strptime(issue["updated_at"], "%Y-%m-%dT%H:%M:%S%z")
-        age = datetime.now(timezone.utc) - last_updated
-        if age.total_seconds() < AFTER_WARNING_SECONDS:
-            break
 
-        print(f"awaiting_merger -> needs_merger: #{issue['number']} ({issue['title']})")
-        await set_issue_status(issue, "needs_merger", gh, token)
 
-    print("Posting warnings in awaiting_merger PRs")
-    search_results = gh_util.search_issues(
+async def timeout_awaiting_merger(
+    gh: GitHubAPI, token: str, repository_name: str, result: TriageResult
+) -> None:
+    print("Reminding and timing out awaiting_merger PRs")
+    await remind_or_timeout(
         gh,
         token,
-        query_parameters=[
-            f"repo:{repository_name}",
-            "is:open",
-            "is:pr",
-            "label:awaiting_merger",
-            "-label:timeout_pending",
-            "label:marvin",
-            "sort:updated-asc",
-        ],
+        repository_name,
+        result,
+        status="awaiting_merger",
+        timeout_status="needs_merger",
+        reminder_text=MERGE_REMINDER_TEXT,
+        reminder_after_seconds=AWAITING_MERGER_TIMEOUT_SECONDS,
     )
-    async for issue in search_results:
-        last_updated = datetime.strptime(issue["updated_at"], "%Y-%m-%dT%H:%M:%S%z")
-        age = datetime.now(timezone.utc) - last_updated
-        if age.total_seconds() < AWAITING_REVIEWER_TIMEOUT_SECONDS:
-            break
-
-        print(f"awaiting_merger reminder: #{issue['number']} ({issue['title']})")
-        await post_comment(
-            gh, token, issue["comments_url"], MERGE_REMINDER_TEXT,
-        )
 
 
-async def assign_mergers(gh: GitHubAPI, token: str, repository_name: str) -> None:
+async def assign_mergers(
+    gh: GitHubAPI, token: str, repository_name: str, result: TriageResult
+) -> None:
     print("Assigning mergers to needs_merger PRs")
-    search_results = gh_util.search_issues(
+    async with gh_util.search_issues(
         gh,
         token,
-        query_parameters=[
-            f"repo:{repository_name}",
-            "is:open",
-            "is:pr",
-            "label:needs_merger",
-            "label:marvin",
-            "sort:created-asc",  # oldest first
-        ],
-    )
-    async for issue in search_results:
-        reviewer = await team.get_reviewer(
-            gh, token, issue, merge_permission_needed=True
-        )
-        if reviewer is not None:
-            print(f"Requesting review (merge) from {reviewer} for #{issue['number']}.")
-            await gh_util.request_review_fallback(
-                gh, token, issue["pull_request"]["url"], issue["comments_url"], reviewer
+        gh_util.SearchQuery(
+            repository_name,
+            labels=["needs_merger", "marvin"],
+            sort="created",  # oldest first
+        ),
+    ) as search_results:
+        oldest_created_at = None
+        async for issue in search_results:
+            if oldest_created_at is None:
+                oldest_created_at = issue["created_at"]
+            reviewer = await team.get_reviewer(
+                gh, token, issue, merge_permission_needed=True, planned=result.reviewers
             )
-            await set_issue_status(issue, "awaiting_merger", gh, token)
-        else:
-            print(f"No reviewer with merge permission found for #{issue['number']}.")
+            if reviewer is not None:
+                print(
+                    f"Requesting review (merge) from {reviewer} for #{issue['number']}."
+                )
+                result.plan(mutations.RequestReview(issue, reviewer))
+                result.plan(mutations.SetStatus(issue, "awaiting_merger"))
+            else:
+                print(
+                    f"No reviewer with merge permission found for #{issue['number']}."
+                )
+                result.unassigned += 1
+        result.record_queue(
+            repository_name, "needs_merger", search_results, oldest_created_at
+        )
 
 
-async def assign_reviewers(gh: GitHubAPI, token: str, repository_name: str) -> None:
+async def assign_reviewers(
+    gh: GitHubAPI, token: str, repository_name: str, result: TriageResult
+) -> None:
     print("Assigning reviewers to needs_reviewer PRs")
-    search_results = gh_util.search_issues(
+    async with gh_util.search_issues(
         gh,
         token,
-        query_parameters=[
-            f"repo:{repository_name}",
-            "is:open",
-            "is:pr",
-            "label:needs_reviewer",
-            "label:marvin",
-            "sort:created-asc",  # oldest first
-        ],
-    )
-    async for issue in search_results:
-        reviewer = await team.get_reviewer(
-            gh, token, issue, merge_permission_needed=False
-        )
-        if reviewer is not None:
-            print(f"Requesting review from {reviewer} for #{issue['number']}.")
-            await gh_util.request_review_fallback(
-                gh, token, issue["pull_request"]["url"], issue["comments_url"], reviewer
+        gh_util.SearchQuery(
+            repository_name,
+            labels=["needs_reviewer", "marvin"],
+            sort="created",  # oldest first
+        ),
+    ) as search_results:
+        oldest_created_at = None
+        async for issue in search_results:
+            if oldest_created_at is None:
+                oldest_created_at = issue["created_at"]
+            reviewer = await team.get_reviewer(
+                gh,
+                token,
+                issue,
+                merge_permission_needed=False,
+                planned=result.reviewers,
             )
-            await set_issue_status(issue, "awaiting_reviewer", gh, token)
-        else:
-            print(f"No reviewer found for #{issue['number']}.")
+            if reviewer is not None:
+                print(f"Requesting review from {reviewer} for #{issue['number']}.")
+                result.plan(mutations.RequestReview(issue, reviewer))
+                result.plan(mutations.SetStatus(issue, "awaiting_reviewer"))
+            else:
+                print(f"No reviewer found for #{issue['number']}.")
+                result.unassigned += 1
+        result.record_queue(
+            repository_name, "needs_reviewer", search_results, oldest_created_at
+        )
+
 
+async def plan_timeouts(
+    gh: GitHubAPI, token: str, repository_name: str, result: TriageResult
+) -> None:
+    with phase("timeout_awaiting_reviewer"):
+        await timeout_awaiting_reviewer(gh, token, repository_name, result)
+    with phase("timeout_awaiting_merger"):
+        await timeout_awaiting_merger(gh, token, repository_name, result)
+
+
+async def plan_assignments(
+    gh: GitHubAPI, token: str, repository_name: str, result: TriageResult
+) -> None:
+    with phase("assign_mergers"):
+        await assign_mergers(gh, token, repository_name, result)
+    with phase("assign_reviewers"):
+        await assign_reviewers(gh, token, repository_name, result)
 
-async def run_triage(gh: GitHubAPI, token: str, **kwargs: Any) -> None:
+
+async def count_queues(
+    gh: GitHubAPI, token: str, repository_name: str, result: TriageResult
+) -> None:
+    """Count the queues the assignments did not search, for the snapshot.
+
+    This costs a search per queue, so it is only done every
+    queues.FULL_COUNT_RUNS runs.
+    """
+    counted = result.queues.setdefault(repository_name, dict())
+    for status in sorted(gh_util.ISSUE_STATUS_LABELS - set(counted)):
+        counted[status] = await queues.count_queue(gh, token, repository_name, status)
+
+
+async def execute_planned(
+    gh: GitHubAPI,
+    token: str,
+    installation_id: Optional[str],
+    planned: List[mutations.Mutation],
+) -> None:
+    with phase("execute"):
+        await outbox.execute(
+            gh, token, installation_id, planned, constants.TRIAGE_WRITE_CONCURRENCY
+        )
+
+
+async def run_triage(
+    gh: GitHubAPI,
+    token: str,
+    installation_id: Optional[str] = None,
+    dry_run: bool = False,
+    **kwargs: Any,
+) -> TriageResult:
+    """Plan and execute triage on all repositories of the installation.
+
+    The changes are recorded in the outbox of the installation before they are
+    executed. With `dry_run`, they are only collected and not executed, and
+    the queues are not recorded.
+    Note that a dry run cannot account for the effects of the timeouts on the
+    assignments, since those would only show up in the search once executed.
+    When `stopping` is set, the run ends after the current phase.
+    """
+    result = TriageResult()
+    team.roster.reload_if_changed()
+    with phase("refresh_gists"):
+        await team.gists.refresh(gh, team.roster.gist_ids())
     repositories = await gh_util.get_installation_repositories(gh, token)
     for repository in repositories:
         repository_name = repository["full_name"]
@@ -208,16 +345,37 @@ async def run_triage(gh: GitHubAPI, token: str, **kwargs: Any) -> None:
         # Give GitHub some time to reach internal consistency to make sure the
         # newly labeled PR turns up in the triage search. Without this sleep and ~2
         # seconds between setting the label and running the triage this failed.
-        await asyncio.sleep(2)
-        await timeout_awaiting_reviewer(gh, token, repository_name)
-        await timeout_awaiting_merger(gh, token, repository_name)
-        await asyncio.sleep(2)
-        await assign_mergers(gh, token, repository_name)
-        await assign_reviewers(gh, token, repository_name)
+        await asyncio.sleep(constants.SEARCH_INDEX_SETTLE_SECONDS)
+        if stopping:
+            break
+        planned = len(result.mutations)
+        await plan_timeouts(gh, token, repository_name, result)
+        if not dry_run:
+            await execute_planned(
+                gh, token, installation_id, result.mutations[planned:]
+            )
+            await asyncio.sleep(constants.SEARCH_INDEX_SETTLE_SECONDS)
+        if stopping:
+            break
+        planned = len(result.mutations)
+        await plan_assignments(gh, token, repository_name, result)
+        if not dry_run:
+            await execute_planned(
+                gh, token, installation_id, result.mutations[planned:]
+            )
+        if not dry_run:
+            if queues.snapshots.due_for_full_count(repository_name):
+                with phase("count_queues"):
+                    await count_queues(gh, token, repository_name, result)
+            queues.snapshots.record(
+                repository_name, result.queues[repository_name], time.time()
+            )
+    result.capacity_frees_at = team.next_capacity_change()
+    return result
 
 
 @command_router.register_command("/marvin triage")
 async def triage_command(
     gh: GitHubAPI, event: sansio.Event, token: str, issue: Dict[str, Any], **kwargs: Any
 ) -> None:
-    triage_runner.runners[event.data["installation"]["id"]].run_soon(gh, token)
+    triage_runner.scheduler.run_soon(event.data["installation"]["id"])
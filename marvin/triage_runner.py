@@ -1,19 +1,121 @@
 import asyncio
+from datetime import datetime
+from datetime import timezone
+import heapq
+import itertools
+import sqlite3
+import sys
+import time
+import traceback
 from typing import Dict
+from typing import List
+from typing import Mapping
 from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import Union
 
 import aiohttp
-from gidgethub import apps
+from gidgethub import sansio
 from gidgethub.aiohttp import GitHubAPI
 
 from marvin import constants
+from marvin import gh_util
+from marvin import metrics
+from marvin import supervision
+from marvin import tracing
 from marvin import triage
 
+TRIAGE_DELAY = metrics.Gauge(
+    "marvin_triage_delay_seconds",
+    "Chosen delay until the next periodic triage run by installation.",
+    ["installation"],
+)
+
+
+class AdaptiveSchedule:
+    """Choose the delay between two triage runs.
+
+    The delay is shortened while the queues are moving, after webhook
+    deliveries were shed or when a reviewer is about to regain capacity, and
+    lengthened when triage has nothing to do or when we are running low on
+    rate limit. The chosen delay and the reason for it are kept in
+    `delay_seconds` and `reason`.
+    """
+
+    def __init__(
+        self,
+        min_delay_seconds: int,
+        max_delay_seconds: int,
+        low_rate_limit_fraction: float = 0.1,
+    ) -> None:
+        self.min_delay_seconds = min_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.low_rate_limit_fraction = low_rate_limit_fraction
+        self.delay_seconds: float = min_delay_seconds
+        self.reason = "initial delay"
+
+    def _clamp(self, delay_seconds: float) -> float:
+        return max(self.min_delay_seconds, min(self.max_delay_seconds, delay_seconds))
+
+    def update(
+        self,
+        result: "triage.TriageResult",
+        rate_limits: Mapping[str, sansio.RateLimit],
+        now: Optional[datetime] = None,
+        shed_deliveries: int = 0,
+    ) -> float:
+        """Pick the delay until the next run based on the last run.
+
+        `shed_deliveries` is the number of webhook deliveries that were shed
+        since the last run. The backfill replays them later, but they show
+        that the queues are moving.
+        """
+        if now is None:
+            now = datetime.now(timezone.utc)
+
+        if result.changes > 0:
+            delay = self._clamp(self.delay_seconds / 2)
+            reason = f"queues moving ({result.changes} changes in last run)"
+        elif shed_deliveries > 0:
+            delay = self._clamp(self.delay_seconds / 2)
+            reason = f"{shed_deliveries} webhook deliveries shed since last run"
+        else:
+            delay = self._clamp(self.delay_seconds * 2)
+            reason = "no changes in last run"
+
+        if result.unassigned > 0 and result.capacity_frees_at is not None:
+            capacity_delay = (result.capacity_frees_at - now).total_seconds()
+            if capacity_delay < delay:
+                delay = self._clamp(capacity_delay)
+                reason = f"reviewer capacity frees up at {result.capacity_frees_at}"
+
+        for resource in ("core", "search"):
+            rate_limit = rate_limits.get(resource)
+            if rate_limit is None:
+                continue
+            if rate_limit.remaining < rate_limit.limit * self.low_rate_limit_fraction:
+                reset_delay = (rate_limit.reset_datetime - now).total_seconds()
+                if reset_delay > delay:
+                    delay = self._clamp(reset_delay)
+                    reason = (
+                        f"low {resource} rate limit "
+                        f"({rate_limit.remaining}/{rate_limit.limit} remaining)"
+                    )
+
+        self.delay_seconds = delay
+        self.reason = reason
+        return delay
+
 
 class TriageRunner:
-    """Run regular triage.
+    """Run triage for one installation.
 
-    Triage is run at least once every max_delay_seconds or whenever requested.
+    Triage is run at least once every max_delay_seconds or whenever requested,
+    but never more often than every min_delay_seconds. Failed runs are retried
+    with exponential backoff. The delay between successful runs is chosen by
+    an `AdaptiveSchedule`. The runs themselves are started by the
+    `TriageScheduler`.
     """
 
     def __init__(
@@ -29,11 +131,17 @@ class TriageRunner:
         self.gh_private_key = gh_private_key
         self.max_delay_seconds = max_delay_seconds
         self.min_delay_seconds = min_delay_seconds
-        self.sleep_task: Optional[asyncio.Task] = None
+        self.schedule = AdaptiveSchedule(min_delay_seconds, max_delay_seconds)
+        # Event loop time at which the last run finished.
+        self.last_finished: Optional[float] = None
+        # Webhook deliveries that were shed since the last run started.
+        self.shed_deliveries = 0
+        # Consecutive failed runs, to back off.
+        self.failures = 0
 
     async def _get_installation_access_token(self, gh: GitHubAPI) -> str:
         # Valid for an hour, needs to be re-generated regularly.
-        result = await apps.get_installation_access_token(
+        result = await gh_util.get_installation_access_token(
             gh,
             installation_id=self.installation_id,
             app_id=self.gh_app_id,
@@ -41,34 +149,349 @@ class TriageRunner:
         )
         return result["token"]
 
-    def start(self) -> None:
-        """Start running regular triage."""
-
-        async def loop() -> None:
-            print("Starting triage runner")
-            while True:
-                async with aiohttp.ClientSession() as session:
-                    gh = GitHubAPI(session, constants.BOT_NAME)
-                    token = await self._get_installation_access_token(gh)
-                    await triage.run_triage(gh, token)
-                try:
-                    self.sleep_task = asyncio.create_task(
-                        asyncio.sleep(self.max_delay_seconds)
-                    )
-                    await asyncio.sleep(self.min_delay_seconds)
-                    await self.sleep_task
-                    self.sleep_task = None
-                except asyncio.CancelledError:
-                    print("Running triage early")
+    async def run_once(self) -> float:
+        """Run triage once and return the delay until the next periodic run."""
+        run_id = f"{self.installation_id}@{time.time():.0f}"
+        shed_deliveries, self.shed_deliveries = self.shed_deliveries, 0
+        if shed_deliveries > 0:
+            print(f"{shed_deliveries} webhook deliveries shed since the last run")
+        with tracing.cause("triage", run_id):
+            async with aiohttp.ClientSession() as session:
+                gh = gh_util.InstrumentedGitHubAPI(session, constants.BOT_NAME)
+                token = await self._get_installation_access_token(gh)
+                result = await triage.run_triage(gh, token, self.installation_id)
+                rate_limits = await gh_util.get_rate_limits(gh, token)
+        delay = self.schedule.update(
+            result, rate_limits, shed_deliveries=shed_deliveries
+        )
+        TRIAGE_DELAY.set(delay, str(self.installation_id))
+        print(
+            f"Next triage for installation {self.installation_id} in "
+            f"{delay:.0f} seconds: {self.schedule.reason}"
+        )
+        return delay
+
+
+# Priorities of queued triage runs, lower is more urgent.
+PRIORITY_REQUESTED = 0
+PRIORITY_PERIODIC = 1
+
+
+class TriageScheduler:
+    """Schedule the triage runs of all installations.
+
+    All installations share one process and one event loop, so their triage
+    runs are coordinated here: at most max_concurrent runs are active at a
+    time, two runs are never started less than stagger_seconds apart and each
+    installation is queued at most once, so installations are served in turn.
+    Requested runs (e.g. through a command) are served before periodic ones.
+    """
+
+    def __init__(self, max_concurrent: int, stagger_seconds: float) -> None:
+        self.max_concurrent = max_concurrent
+        self.stagger_seconds = stagger_seconds
+        self.runners: Dict[str, TriageRunner] = dict()
+        # Heap of (priority, sequence number, installation id).
+        self._queue: List[Tuple[int, int, str]] = []
+        # The priority each installation is currently queued with.
+        self._queued: Dict[str, int] = dict()
+        self._running: Set[str] = set()
+        self._timers: Dict[str, asyncio.TimerHandle] = dict()
+        self._sequence = itertools.count()
+        self._last_start: Optional[float] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatch_task: Optional[asyncio.Task] = None
+        self._run_tasks: Set[asyncio.Task] = set()
+        self._stopped = False
 
-        asyncio.create_task(loop())
+    def add_installation(
+        self,
+        installation_id: str,
+        gh_app_id: str,
+        gh_private_key: str,
+        min_delay_seconds: int,
+        max_delay_seconds: int,
+    ) -> None:
+        """Start running regular triage for an installation, if not yet done."""
+        if installation_id in self.runners:
+            return
+        print(f"Starting a triage runner for installation {installation_id}")
+        self.runners[installation_id] = TriageRunner(
+            installation_id,
+            gh_app_id=gh_app_id,
+            gh_private_key=gh_private_key,
+            min_delay_seconds=min_delay_seconds,
+            max_delay_seconds=max_delay_seconds,
+        )
+        self._start()
+        self._enqueue(installation_id, PRIORITY_PERIODIC)
 
-    def run_soon(self, gh: GitHubAPI, token: str) -> None:
+    def run_soon(self, installation_id: str) -> None:
         """Request a new triage run soon if none is already in progress."""
         print("Requesting triage")
-        # Use the requester's authentication for the next triage.
-        if self.sleep_task is not None:
-            self.sleep_task.cancel()
+        runner = self.runners[installation_id]
+        if installation_id in self._running:
+            return
+        loop = asyncio.get_event_loop()
+        delay = 0.0
+        if runner.last_finished is not None:
+            delay = runner.last_finished + runner.min_delay_seconds - loop.time()
+        self._schedule(installation_id, max(0.0, delay), PRIORITY_REQUESTED)
+
+    def queue_length(self) -> int:
+        return len(self._queued)
+
+    def record_shed(self, installation_id: str, count: int = 1) -> None:
+        """Note webhook deliveries that were shed, so that triage runs sooner.
+
+        The deliveries themselves are replayed by the backfill. Installations
+        without a runner get their first run soon anyway.
+        """
+        runner = self.runners.get(installation_id)
+        if runner is not None:
+            runner.shed_deliveries += count
+
+    def stop(self) -> None:
+        """Start no further runs. Running ones are left to finish."""
+        self._stopped = True
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        if self._dispatch_task is not None:
+            self._dispatch_task.cancel()
+
+    async def drain(self) -> None:
+        """Wait for the running triage runs to finish."""
+        if len(self._run_tasks) > 0:
+            await asyncio.wait(self._run_tasks)
+
+    def _start(self) -> None:
+        if self._dispatch_task is None and not self._stopped:
+            self._wakeup = asyncio.Event()
+            self._dispatch_task = asyncio.create_task(
+                supervision.supervise("triage_dispatch", self._dispatch)
+            )
+
+    def _schedule(self, installation_id: str, delay: float, priority: int) -> None:
+        if self._stopped:
+            return
+        timer = self._timers.pop(installation_id, None)
+        if timer is not None:
+            timer.cancel()
+        self._timers[installation_id] = asyncio.get_event_loop().call_later(
+            delay, self._enqueue, installation_id, priority
+        )
+
+    def _enqueue(self, installation_id: str, priority: int) -> None:
+        self._timers.pop(installation_id, None)
+        if self._stopped:
+            return
+        queued_priority = self._queued.get(installation_id)
+        if queued_priority is not None and queued_priority <= priority:
+            return
+        # Entries with an outdated priority are skipped when popped.
+        self._queued[installation_id] = priority
+        heapq.heappush(self._queue, (priority, next(self._sequence), installation_id))
+        assert self._wakeup is not None
+        self._wakeup.set()
+
+    def _pop(self) -> Optional[str]:
+        while len(self._queue) > 0:
+            priority, _, installation_id = heapq.heappop(self._queue)
+            if self._queued.get(installation_id) == priority:
+                del self._queued[installation_id]
+                return installation_id
+        return None
+
+    async def _dispatch(self) -> None:
+        assert self._wakeup is not None
+        slots = asyncio.Semaphore(self.max_concurrent)
+        loop = asyncio.get_event_loop()
+        while True:
+            await slots.acquire()
+            installation_id = self._pop()
+            while installation_id is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                installation_id = self._pop()
+
+            if self._last_start is not None:
+                stagger_delay = self._last_start + self.stagger_seconds - loop.time()
+                if stagger_delay > 0:
+                    await asyncio.sleep(stagger_delay)
+            self._last_start = loop.time()
+            self._running.add(installation_id)
+            task = asyncio.create_task(self._run(installation_id, slots))
+            self._run_tasks.add(task)
+            task.add_done_callback(self._run_tasks.discard)
+
+    async def _run(self, installation_id: str, slots: asyncio.Semaphore) -> None:
+        runner = self.runners[installation_id]
+        try:
+            if gh_util.breaker.is_open():
+                print(f"Skipping triage for {installation_id} while GitHub is down")
+                delay = max(runner.min_delay_seconds, gh_util.breaker.open_for())
+            else:
+                delay = await runner.run_once()
+                runner.failures = 0
+        except gh_util.CircuitOpenError:
+            delay = max(runner.min_delay_seconds, gh_util.breaker.open_for())
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            runner.failures += 1
+            delay = min(
+                runner.max_delay_seconds,
+                runner.min_delay_seconds * 2 ** runner.failures,
+            )
+            print(f"Triage for {installation_id} failed, retrying in {delay} seconds")
+        finally:
+            runner.last_finished = asyncio.get_event_loop().time()
+            self._running.discard(installation_id)
+            slots.release()
+        self._schedule(installation_id, delay, PRIORITY_PERIODIC)
+
+
+class SharedTriageQueue:
+    """Hand triage over to the leader of several worker processes.
+
+    All workers handle webhooks, but only the one holding the triage lease
+    (see marvin.leader) runs triage. The workers record installations and
+    requested runs in a shared database. The leader polls it and feeds them
+    to its own TriageScheduler. Since the installations are recorded, a new
+    leader takes over all of them after a failover.
+    """
+
+    def __init__(self, path: str, poll_seconds: float = 1) -> None:
+        self.poll_seconds = poll_seconds
+        self._db = sqlite3.connect(path)
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS triage_installations (
+                    installation_id TEXT PRIMARY KEY,
+                    min_delay_seconds INTEGER NOT NULL,
+                    max_delay_seconds INTEGER NOT NULL,
+                    requested_at REAL
+                )
+                """)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS triage_shed_deliveries (
+                    installation_id TEXT PRIMARY KEY,
+                    deliveries INTEGER NOT NULL
+                )
+                """)
+        # The local scheduler, if this process is the leader.
+        self.leader: Optional[TriageScheduler] = None
+        self._poll_task: Optional[asyncio.Task] = None
+
+    @property
+    def runners(self) -> Dict[str, TriageRunner]:
+        return self.leader.runners if self.leader is not None else dict()
+
+    def queue_length(self) -> int:
+        return self.leader.queue_length() if self.leader is not None else 0
+
+    def add_installation(
+        self,
+        installation_id: str,
+        gh_app_id: str,
+        gh_private_key: str,
+        min_delay_seconds: int,
+        max_delay_seconds: int,
+    ) -> None:
+        """Record an installation for the leader.
+
+        The leader uses its own app credentials, which are the same for all
+        workers.
+        """
+        with self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO triage_installations VALUES (?, ?, ?, NULL)",
+                (str(installation_id), min_delay_seconds, max_delay_seconds),
+            )
+
+    def run_soon(self, installation_id: str) -> None:
+        print("Requesting triage from the leader")
+        with self._db:
+            self._db.execute(
+                "UPDATE triage_installations SET requested_at = ?"
+                " WHERE installation_id = ?",
+                (time.time(), str(installation_id)),
+            )
+
+    def record_shed(self, installation_id: str, count: int = 1) -> None:
+        with self._db:
+            self._db.execute(
+                "INSERT INTO triage_shed_deliveries VALUES (?, ?) ON CONFLICT"
+                " (installation_id) DO UPDATE SET deliveries = deliveries + ?",
+                (str(installation_id), count, count),
+            )
+
+    def stop(self) -> None:
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+        if self.leader is not None:
+            self.leader.stop()
+
+    async def drain(self) -> None:
+        if self.leader is not None:
+            await self.leader.drain()
+
+    def lead(self, gh_app_id: str, gh_private_key: str) -> None:
+        """Start running triage in this process."""
+        self.leader = TriageScheduler(
+            max_concurrent=constants.TRIAGE_CONCURRENCY,
+            stagger_seconds=constants.TRIAGE_STAGGER_SECONDS,
+        )
+        self._poll_task = asyncio.create_task(
+            supervision.supervise(
+                "triage_poll", lambda: self._poll(gh_app_id, gh_private_key)
+            )
+        )
+
+    def forward(self, gh_app_id: str, gh_private_key: str) -> None:
+        """Pass the recorded installations and requests on to the leader."""
+        assert self.leader is not None
+        rows = self._db.execute("SELECT * FROM triage_installations").fetchall()
+        for installation_id, min_delay, max_delay, requested_at in rows:
+            self.leader.add_installation(
+                installation_id,
+                gh_app_id=gh_app_id,
+                gh_private_key=gh_private_key,
+                min_delay_seconds=min_delay,
+                max_delay_seconds=max_delay,
+            )
+            if requested_at is not None:
+                self.leader.run_soon(installation_id)
+                with self._db:
+                    # Unless it was requested again in the meantime.
+                    self._db.execute(
+                        "UPDATE triage_installations SET requested_at = NULL"
+                        " WHERE installation_id = ? AND requested_at = ?",
+                        (installation_id, requested_at),
+                    )
+        rows = self._db.execute(
+            "SELECT * FROM triage_shed_deliveries WHERE deliveries > 0"
+        ).fetchall()
+        for installation_id, count in rows:
+            self.leader.record_shed(installation_id, count)
+            with self._db:
+                self._db.execute(
+                    "UPDATE triage_shed_deliveries SET deliveries = deliveries - ?"
+                    " WHERE installation_id = ?",
+                    (count, installation_id),
+                )
+
+    async def _poll(self, gh_app_id: str, gh_private_key: str) -> None:
+        while True:
+            try:
+                self.forward(gh_app_id, gh_private_key)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+            await asyncio.sleep(self.poll_seconds)
 
 
-runners: Dict[str, TriageRunner] = dict()
+# Replaced by a SharedTriageQueue when running several worker processes.
+scheduler: Union[TriageScheduler, SharedTriageQueue] = TriageScheduler(
+    max_concurrent=constants.TRIAGE_CONCURRENCY,
+    stagger_seconds=constants.TRIAGE_STAGGER_SECONDS,
+)
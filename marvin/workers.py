@@ -0,0 +1,59 @@
+import os
+import signal
+import sys
+import time
+import traceback
+from types import FrameType
+from typing import Callable
+from typing import Dict
+from typing import Optional
+
+# Pause before restarting a worker that died, to avoid a tight crash loop.
+RESTART_DELAY_SECONDS = 1
+
+
+def serve(run_worker: Callable[[], None], workers: int) -> None:
+    """Run `run_worker` in several forked processes until told to stop.
+
+    Workers that die are restarted. SIGTERM and SIGINT are forwarded to the
+    workers, and this returns once they all exited. The workers are expected
+    to listen on the same port with SO_REUSEPORT, so that the kernel spreads
+    the connections across them.
+    """
+    # Worker number by process id.
+    children: Dict[int, int] = dict()
+    stopping = False
+
+    def start(number: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker()
+            except BaseException:
+                traceback.print_exc(file=sys.stderr)
+                code = 1
+            finally:
+                os._exit(code)
+        print(f"Started worker {number} (pid {pid})")
+        children[pid] = number
+
+    def stop(signum: int, frame: Optional[FrameType]) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for number in range(workers):
+        start(number)
+    while len(children) > 0:
+        pid, status = os.wait()
+        number = children.pop(pid)
+        print(f"Worker {number} (pid {pid}) exited with status {status}")
+        if not stopping:
+            time.sleep(RESTART_DELAY_SECONDS)
+            start(number)
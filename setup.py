@@ -9,6 +9,8 @@ setup(
     description="Helpful nixpkgs PR bot with an improved Genuine People Personality",
     author="Timo Kaufmann",
     packages=["marvin"],
+    package_data={"marvin": ["team.json"]},
     install_requires=["aiohttp", "gidgethub"],
+    extras_require={"uvloop": ["uvloop"]},
     entry_points={"console_scripts": ["marvin=marvin.__main__:main"]},
 )
@@ -0,0 +1,14 @@
+from typing import Iterator
+
+import pytest
+
+from marvin import status
+
+
+@pytest.fixture(autouse=True)
+def no_status_coalescing() -> Iterator[None]:
+    """Apply status changes immediately unless a test asks otherwise."""
+    window_seconds = status.coalescer.window_seconds
+    status.coalescer.window_seconds = 0
+    yield
+    status.coalescer.window_seconds = window_seconds
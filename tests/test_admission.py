@@ -0,0 +1,36 @@
+import asyncio
+
+from marvin import admission
+
+
+async def test_sheds_plain_deliveries_before_commands() -> None:
+    control = admission.AdmissionControl(max_in_flight=3, reserved=1, max_waiting=1)
+    assert await control.admit(priority=False)
+    assert await control.admit(priority=False)
+    # The last slot is reserved for commands.
+    assert not await control.admit(priority=False)
+    assert await control.admit(priority=True)
+
+    # Commands wait for a free slot, but only one of them at a time.
+    waiting = asyncio.create_task(control.admit(priority=True))
+    await asyncio.sleep(0)
+    assert control.waiting() == 1
+    assert not await control.admit(priority=True)
+    control.release()
+    assert await waiting
+    assert control.in_flight == 3
+    control.release()
+    control.release()
+    assert await control.admit(priority=False)
+
+
+async def test_cancelled_waiter_gives_up_its_place() -> None:
+    control = admission.AdmissionControl(max_in_flight=1, reserved=0, max_waiting=2)
+    assert await control.admit(priority=True)
+    waiting = asyncio.create_task(control.admit(priority=True))
+    await asyncio.sleep(0)
+    waiting.cancel()
+    await asyncio.sleep(0)
+    assert control.waiting() == 0
+    control.release()
+    assert control.in_flight == 0
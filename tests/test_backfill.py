@@ -0,0 +1,112 @@
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+
+from gidgethub import sansio
+
+from benchmarks import github
+from marvin import backfill
+
+
+def payload(number: int, action: str = "created") -> Dict[str, Any]:
+    return {
+        "action": action,
+        "installation": {"id": 1},
+        "repository": {"full_name": github.REPOSITORY},
+        "issue": {"number": number},
+    }
+
+
+async def get_jwt() -> str:
+    return "jwt"
+
+
+class Handler:
+    def __init__(self) -> None:
+        self.handled: List[str] = []
+        self.failing: List[str] = []
+
+    async def __call__(self, event: sansio.Event) -> None:
+        if event.delivery_id in self.failing:
+            raise Exception("Failed to handle")
+        self.handled.append(event.delivery_id)
+
+
+async def test_replays_missed_deliveries_in_order(monkeypatch: Any) -> None:
+    fake = github.FakeGitHub()
+    gh = github.InProcessGitHubAPI(fake)
+    start = time.time() - 60 * 60
+    # Handled the first time.
+    fake.add_delivery("issue_comment", payload(1), 200, delivered_at=start)
+    # Failed, then redelivered successfully.
+    failed = fake.add_delivery("issue_comment", payload(1), 500, delivered_at=start)
+    fake.add_delivery("issue_comment", payload(1), 200, failed["guid"], start + 1)
+    # Missed while marvin was down.
+    for _ in range(150):
+        fake.add_delivery("issue_comment", payload(2), 502, delivered_at=start + 60)
+    fake.add_delivery("ping", {}, 502, delivered_at=start + 60)
+    # Failed, but GitHub only gave up waiting after it was handled.
+    timed_out = fake.add_delivery("issue_comment", payload(3), 0, delivered_at=start)
+    # Still in flight.
+    fake.add_delivery("issue_comment", payload(4), 500)
+
+    delivery_log = backfill.DeliveryLog(":memory:")
+    delivery_log.record(timed_out["guid"])
+    handler = Handler()
+    replayed = await backfill.backfill(gh, get_jwt, delivery_log, handler, 2 * 60 * 60)
+    assert replayed == 150
+    assert handler.handled == [f"guid-{id}" for id in range(4, 154)]
+
+    # The next pass only lists the deliveries since the last one.
+    checked_until = delivery_log.checked_until()
+    assert checked_until is not None
+    fake.add_delivery("issue_comment", payload(5), 500, delivered_at=checked_until + 1)
+    monkeypatch.setattr(backfill, "SETTLE_SECONDS", 0)
+    requests = fake.requests
+    replayed = await backfill.backfill(gh, get_jwt, delivery_log, handler, 2 * 60 * 60)
+    assert replayed == 2
+    assert handler.handled[-2:] == ["guid-157", "guid-156"]
+    # One page of deliveries and the two replayed ones.
+    assert fake.requests - requests == 3
+
+
+async def test_later_deliveries_of_a_pull_request_wait_for_failed_ones() -> None:
+    fake = github.FakeGitHub()
+    gh = github.InProcessGitHubAPI(fake)
+    start = time.time() - 60 * 60
+    for number in [1, 2, 1]:
+        fake.add_delivery("issue_comment", payload(number), 500, delivered_at=start)
+    delivery_log = backfill.DeliveryLog(":memory:")
+    handler = Handler()
+    handler.failing = ["guid-1"]
+    replayed = await backfill.backfill(gh, get_jwt, delivery_log, handler, 2 * 60 * 60)
+    assert replayed == 1
+    assert handler.handled == ["guid-2"]
+
+    handler.failing = []
+    replayed = await backfill.backfill(gh, get_jwt, delivery_log, handler, 2 * 60 * 60)
+    assert replayed == 2
+    assert handler.handled == ["guid-2", "guid-1", "guid-3"]
+
+
+async def test_skips_missed_deliveries_of_pull_requests_that_moved_on() -> None:
+    fake = github.FakeGitHub()
+    gh = github.InProcessGitHubAPI(fake)
+    start = time.time() - 60 * 60
+    # A comment was missed, but a later push to the same pull request was
+    # handled, so the comment would act on an outdated status.
+    comment = fake.add_delivery("issue_comment", payload(1), 502, delivered_at=start)
+    push = payload(1, "synchronize")
+    push["pull_request"] = push.pop("issue")
+    fake.add_delivery("pull_request", push, 200, delivered_at=start + 60)
+    # Later deliveries of other pull requests do not matter.
+    other = fake.add_delivery("issue_comment", payload(2), 502, delivered_at=start)
+    fake.add_delivery("issue_comment", payload(3), 200, delivered_at=start + 60)
+
+    delivery_log = backfill.DeliveryLog(":memory:")
+    handler = Handler()
+    replayed = await backfill.backfill(gh, get_jwt, delivery_log, handler, 2 * 60 * 60)
+    assert replayed == 1
+    assert handler.handled == [other["guid"]]
+    assert delivery_log.handled(comment["guid"])
@@ -0,0 +1,44 @@
+from benchmarks import corpus
+from benchmarks import event_loops
+from benchmarks import replay
+from benchmarks import startup
+from benchmarks import team
+
+# Generous, to not fail on slow machines. A warm start takes about half a
+# second.
+STARTUP_BUDGET_SECONDS = 5
+
+
+async def test_replays_synthetic_corpus() -> None:
+    report = await replay.replay(corpus.generate(200), concurrency=4)
+    assert report["events"] == 200
+    assert report["errors"] == 0
+    assert report["latency_p50_seconds"] <= report["latency_p99_seconds"]
+    # The corpus is deterministic, so this only changes with the handlers. Its
+    # labels do not match the state of the fake, so some status changes also
+    # remove leftover status labels.
+    assert report["api_calls_per_event"] <= 1.25
+
+
+def test_selects_reviewers_from_large_team() -> None:
+    report = team.measure(members=300, selections=50, available=0.1)
+    assert report["found"] == 50
+
+
+async def test_answers_first_delivery_within_startup_budget() -> None:
+    report = await startup.measure(runs=1)
+    assert report["listening_seconds"] <= report["first_response_seconds"]
+    assert report["first_response_seconds"] < STARTUP_BUDGET_SECONDS
+
+
+def test_defers_on_demand_imports_until_needed() -> None:
+    assert startup.eager_imports() == []
+
+
+def test_compares_event_loops() -> None:
+    report = event_loops.measure(
+        "asyncio", deliveries=20, concurrency=4, pulls=50, latency_seconds=0
+    )
+    assert report["event_loop"] == "asyncio"
+    assert report["webhooks"]["statuses"] == {200: 20}
+    assert report["triage_error"] is None
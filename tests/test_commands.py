@@ -1,6 +1,7 @@
 from typing import Any
 from typing import Dict
 from typing import List
+from typing import Sequence
 from typing import Tuple
 
 from gidgethub import sansio
@@ -9,15 +10,28 @@ from marvin import __main__ as main
 
 
 class GitHubAPIMock:
-    def __init__(self) -> None:
+    """Records the changes to the labels of a pull request."""
+
+    def __init__(self, labels: Sequence[Dict[str, str]] = ()) -> None:
         self.post_data: List[Tuple[str, Dict[str, Any]]] = []
         self.delete_urls: List[str] = []
+        self.labels = [label["name"] for label in labels]
+
+    async def getitem(self, url: str, oauth_token: str) -> List[Dict[str, str]]:
+        return [{"name": name} for name in self.labels]
 
     async def post(self, url: str, oauth_token: str, data: Dict[str, Any]) -> None:
         self.post_data.append((url, data))
+        self.labels += data.get("labels", [])
 
     async def delete(self, url: str, oauth_token: str) -> None:
         self.delete_urls.append(url)
+        self.labels.remove(url.rsplit("/", 1)[1])
+
+
+def labels_of(data: Dict[str, Any]) -> List[Dict[str, str]]:
+    issue = data["issue"] if "issue" in data else data["pull_request"]
+    return issue["labels"]
 
 
 async def test_responds_to_pull_request_summary_commands() -> None:
@@ -35,7 +49,7 @@ async def test_responds_to_pull_request_summary_commands() -> None:
         },
     }
     event = sansio.Event(data, event="pull_request_review", delivery_id="1")
-    gh = GitHubAPIMock()
+    gh = GitHubAPIMock(labels_of(data))
     await main.router.dispatch(event, gh, token="fake-token")
     assert gh.post_data == [
         ("pr-url/labels", {"labels": ["awaiting_reviewer"]}),
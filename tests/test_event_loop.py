@@ -0,0 +1,32 @@
+import asyncio
+import sys
+from typing import Any
+from typing import Iterator
+
+import pytest
+
+from marvin import event_loop
+
+
+@pytest.fixture(autouse=True)
+def restore_policy() -> Iterator[None]:
+    yield
+    asyncio.set_event_loop_policy(None)
+
+
+def test_falls_back_without_uvloop(monkeypatch: Any) -> None:
+    # Makes importing uvloop fail, as if it was not installed.
+    monkeypatch.setitem(sys.modules, "uvloop", None)
+    assert event_loop.install("uvloop") == "asyncio"
+    assert type(asyncio.get_event_loop_policy()) is asyncio.DefaultEventLoopPolicy
+
+
+def test_uses_uvloop_when_installed() -> None:
+    uvloop = pytest.importorskip("uvloop")
+    assert event_loop.install("uvloop") == "uvloop"
+    assert isinstance(asyncio.get_event_loop_policy(), uvloop.EventLoopPolicy)
+
+
+def test_rejects_unknown_event_loops() -> None:
+    with pytest.raises(ValueError):
+        event_loop.install("tokio")
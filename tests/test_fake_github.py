@@ -0,0 +1,115 @@
+import asyncio
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from typing import Any
+from typing import List
+
+import gidgethub
+import pytest
+
+from benchmarks import github
+from benchmarks import server
+from marvin import constants
+from marvin import gh_util
+from marvin import triage
+
+
+async def serve(aiohttp_client: Any, fake: github.FakeGitHub) -> Any:
+    client = await aiohttp_client(server.make_app(fake))
+    fake.api_url = str(client.make_url("")).rstrip("/")
+    return gh_util.InstrumentedGitHubAPI(
+        client.session, constants.BOT_NAME, base_url=fake.api_url
+    )
+
+
+async def search(gh: Any, query: gh_util.SearchQuery) -> List[int]:
+    async with gh_util.search_issues(gh, "token", query) as results:
+        return [issue["number"] async for issue in results]
+
+
+async def test_searches_by_label_with_pagination(aiohttp_client: Any) -> None:
+    fake = github.FakeGitHub()
+    fake.seed(1000)
+    gh = await serve(aiohttp_client, fake)
+    query = gh_util.SearchQuery(
+        github.REPOSITORY, labels=["needs_reviewer"], sort="created"
+    )
+    numbers = await search(gh, query)
+    expected = [
+        pull
+        for pull in fake.pulls.values()
+        if "needs_reviewer" in pull.labels and pull.state == "open"
+    ]
+    expected.sort(key=lambda pull: pull.created_at)
+    assert numbers == [pull.number for pull in expected]
+    assert len(numbers) > 100  # more than one page
+
+
+async def test_filters_by_time(aiohttp_client: Any) -> None:
+    fake = github.FakeGitHub()
+    fake.seed(100)
+    gh = await serve(aiohttp_client, fake)
+    cutoff = datetime.now(timezone.utc) - timedelta(days=30)
+    query = gh_util.SearchQuery(github.REPOSITORY, updated_before=cutoff)
+    numbers = await search(gh, query)
+    assert 0 < len(numbers) < 100
+    for number in numbers:
+        assert fake.pulls[number].updated_at < cutoff.timestamp()
+
+
+async def test_search_index_lags_behind(aiohttp_client: Any) -> None:
+    fake = github.FakeGitHub(index_lag_seconds=60)
+    gh = await serve(aiohttp_client, fake)
+    await gh.post(fake.issue_url(1) + "/labels", data={"labels": ["x"]})
+    assert fake.pulls[1].labels == {"x"}
+    query = gh_util.SearchQuery(github.REPOSITORY, labels=["x"])
+    assert await search(gh, query) == []
+    fake.index_lag_seconds = 0
+    assert await search(gh, query) == [1]
+
+
+async def test_enforces_search_rate_limit(aiohttp_client: Any) -> None:
+    fake = github.FakeGitHub(search_limit=1)
+    gh = await serve(aiohttp_client, fake)
+    query = gh_util.SearchQuery(github.REPOSITORY)
+    await search(gh, query)
+    with pytest.raises(gidgethub.RateLimitExceeded):
+        await search(gh, query)
+
+
+async def test_triage_assigns_reviewers(aiohttp_client: Any, monkeypatch: Any) -> None:
+    monkeypatch.setattr(constants, "SEARCH_INDEX_SETTLE_SECONDS", 0)
+    monkeypatch.setattr(constants, "REVIEWER_SEARCH_PACING_SECONDS", 0)
+    fake = github.FakeGitHub(search_limit=1000)
+    fake.seed(20)
+    gh = await serve(aiohttp_client, fake)
+    result = await triage.run_triage(gh, "token")
+    for mutation in result.mutations:
+        if isinstance(mutation, triage.mutations.RequestReview):
+            pull = fake.pulls[mutation.issue["number"]]
+            assert pull.requested_reviewers == [mutation.reviewer]
+            assert "needs_reviewer" not in pull.labels
+
+
+async def test_stopping_search_early_cancels_prefetch(aiohttp_client: Any) -> None:
+    fake = github.FakeGitHub(latency_seconds=0.01)
+    fake.seed(1000)
+    gh = await serve(aiohttp_client, fake)
+    query = gh_util.SearchQuery(github.REPOSITORY)
+    async with gh_util.search_issues(gh, "token", query) as results:
+        async for _ in results:
+            break
+    requests = fake.requests
+    await asyncio.sleep(0.05)
+    # The first page and at most one prefetched page.
+    assert requests == fake.requests <= 2
+
+
+async def test_search_results_require_async_with() -> None:
+    gh = github.InProcessGitHubAPI(github.FakeGitHub())
+    query = gh_util.SearchQuery(github.REPOSITORY)
+    results = gh_util.search_issues(gh, "token", query)
+    with pytest.raises(AssertionError):
+        async for _ in results:
+            pass
@@ -0,0 +1,69 @@
+import asyncio
+from typing import Any
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+import jwt
+import pytest
+
+from benchmarks import github
+from marvin import constants
+from marvin import gh_util
+
+
+async def test_mentions_known_non_collaborators_right_away(monkeypatch: Any) -> None:
+    monkeypatch.setattr(gh_util, "collaborators", gh_util.CollaboratorCache(60))
+    fake = github.FakeGitHub(collaborators={"timokau"})
+    gh = github.InProcessGitHubAPI(fake)
+    pull_url = f"{fake.api_url}/repos/{fake.repository}/pulls/1"
+    comments_url = fake.issue_url(1) + "/comments"
+
+    await gh_util.request_review_fallback(gh, "token", pull_url, comments_url, "fgaz")
+    assert fake.requests == 2  # failed review request and comment
+    await gh_util.request_review_fallback(gh, "token", pull_url, comments_url, "fgaz")
+    assert fake.requests == 3
+    assert [body for _, body in fake.pulls[1].comments] == ["@fgaz please review."] * 2
+
+    await gh_util.request_review_fallback(
+        gh, "token", pull_url, comments_url, "timokau"
+    )
+    assert fake.pulls[1].requested_reviewers == ["timokau"]
+
+
+async def test_circuit_breaker_opens_on_timeouts(monkeypatch: Any) -> None:
+    breaker = gh_util.CircuitBreaker(failure_threshold=2, open_seconds=60)
+    monkeypatch.setattr(gh_util, "breaker", breaker)
+    monkeypatch.setattr(constants, "API_TIMEOUTS", {"rate_limit": 0.01})
+    fake = github.FakeGitHub(latency_seconds=1)
+    gh = github.InProcessGitHubAPI(fake)
+    for _ in range(2):
+        with pytest.raises(asyncio.TimeoutError):
+            await gh_util.get_rate_limits(gh, "token")
+    assert breaker.is_open()
+    with pytest.raises(gh_util.CircuitOpenError):
+        await gh_util.get_rate_limits(gh, "token")
+    assert fake.requests == 0
+
+    # Calls are let through again after a while, the first success closes it.
+    breaker.open_until = 0
+    fake.latency_seconds = 0
+    await gh_util.get_rate_limits(gh, "token")
+    assert breaker.failures == 0
+
+
+async def test_signs_app_jwt_off_the_event_loop() -> None:
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_key = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+    app_jwt = gh_util.AppJWT(executor="thread")
+    token = await app_jwt.get("42", private_key)
+    assert jwt.decode(token, key.public_key(), algorithms=["RS256"])["iss"] == "42"
+    # Reused instead of signed again.
+    assert await app_jwt.get("42", private_key) == token
+
+    gh = github.InProcessGitHubAPI(github.FakeGitHub())
+    result = await gh_util.get_installation_access_token(gh, "1", "42", private_key)
+    assert result["token"] == "token-1"
@@ -0,0 +1,96 @@
+import asyncio
+import time
+from typing import Any
+from typing import List
+from typing import Tuple
+
+from marvin import leader
+from marvin import triage_runner
+
+
+def test_lease_is_exclusive_until_expired(tmp_path: Any) -> None:
+    path = str(tmp_path / "marvin.sqlite")
+    first = leader.Lease(path, "triage", ttl_seconds=30)
+    second = leader.Lease(path, "triage", ttl_seconds=30)
+    assert first.acquire(now=1000)
+    assert not second.acquire(now=1001)
+    assert first.acquire(now=1020)  # renewed
+    assert not second.acquire(now=1040)
+    # The first holder died.
+    assert second.acquire(now=1051)
+    assert not first.acquire(now=1052)
+
+
+def test_released_lease_fails_over_immediately(tmp_path: Any) -> None:
+    path = str(tmp_path / "marvin.sqlite")
+    first = leader.Lease(path, "triage", ttl_seconds=30)
+    second = leader.Lease(path, "triage", ttl_seconds=30)
+    assert first.acquire()
+    assert not second.acquire()
+    first.release()
+    assert second.acquire()
+
+
+async def test_campaign_steps_down_when_lease_is_lost(tmp_path: Any) -> None:
+    path = str(tmp_path / "marvin.sqlite")
+    lease = leader.Lease(path, "triage", ttl_seconds=0.03)
+    events: List[str] = []
+    task = asyncio.create_task(
+        leader.campaign(
+            lease, lambda: events.append("elected"), lambda: events.append("deposed")
+        )
+    )
+    await asyncio.sleep(0.05)
+    assert events == ["elected"]
+    # Another worker takes over, as if this one had stalled for a minute.
+    usurper = leader.Lease(path, "triage", ttl_seconds=30)
+    assert usurper.acquire(now=time.time() + 60)
+    await asyncio.wait_for(task, 1)
+    assert events == ["elected", "deposed"]
+
+
+class RecordingScheduler:
+    def __init__(self) -> None:
+        self.installations: List[Tuple[str, int, int]] = []
+        self.requested: List[str] = []
+        self.shed: List[Tuple[str, int]] = []
+
+    def add_installation(
+        self,
+        installation_id: str,
+        gh_app_id: str,
+        gh_private_key: str,
+        min_delay_seconds: int,
+        max_delay_seconds: int,
+    ) -> None:
+        self.installations.append(
+            (installation_id, min_delay_seconds, max_delay_seconds)
+        )
+
+    def run_soon(self, installation_id: str) -> None:
+        self.requested.append(installation_id)
+
+    def record_shed(self, installation_id: str, count: int = 1) -> None:
+        self.shed.append((installation_id, count))
+
+
+def test_shared_queue_forwards_to_leader(tmp_path: Any) -> None:
+    path = str(tmp_path / "marvin.sqlite")
+    worker = triage_runner.SharedTriageQueue(path)
+    leading = triage_runner.SharedTriageQueue(path)
+    scheduler = RecordingScheduler()
+    leading.leader = scheduler  # type: ignore
+
+    worker.add_installation(42, "app", "key", 60, 3600)  # type: ignore
+    worker.add_installation(42, "app", "key", 60, 3600)  # type: ignore
+    worker.run_soon(42)  # type: ignore
+    worker.record_shed(42)  # type: ignore
+    worker.record_shed(42)  # type: ignore
+    leading.forward("app", "key")
+    assert scheduler.installations == [("42", 60, 3600)]
+    assert scheduler.requested == ["42"]
+    assert scheduler.shed == [("42", 2)]
+
+    leading.forward("app", "key")
+    assert scheduler.requested == ["42"]  # only requested once
+    assert scheduler.shed == [("42", 2)]
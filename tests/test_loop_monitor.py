@@ -0,0 +1,26 @@
+import asyncio
+import time
+from typing import Any
+
+from marvin import loop_monitor
+
+
+async def blocking_handler() -> None:
+    time.sleep(0.2)
+
+
+async def test_reports_task_blocking_the_event_loop(capsys: Any) -> None:
+    blocked = loop_monitor.LOOP_BLOCKED.values.get(("blocking_handler",), 0)
+    monitor = loop_monitor.LoopMonitor(interval_seconds=0.01, slow_seconds=0.05)
+    monitor.start()
+    try:
+        await asyncio.sleep(0.05)
+        await asyncio.ensure_future(blocking_handler())
+        await asyncio.sleep(0.05)
+    finally:
+        monitor.stop()
+    assert loop_monitor.LOOP_BLOCKED.values[("blocking_handler",)] == blocked + 1
+    output = capsys.readouterr().out
+    assert "by task blocking_handler in test_loop_monitor:blocking_handler" in output
+    lag_counts, _ = loop_monitor.LOOP_LAG.values[()]
+    assert sum(lag_counts[loop_monitor.LOOP_LAG.buckets.index(0.1) + 1 :]) >= 1
@@ -0,0 +1,44 @@
+from typing import Any
+
+from aiohttp import web
+
+from marvin import __main__ as main
+from marvin import gh_util
+from marvin import metrics
+
+
+def test_renders_histogram_buckets_cumulatively() -> None:
+    histogram = metrics.Histogram("test_latency_seconds", "Test.", ["endpoint"])
+    metrics.REGISTRY.remove(histogram)
+    histogram.observe(0.02, "search")
+    histogram.observe(3, "search")
+    samples = {
+        (name, tuple(labels)): value for name, labels, value in histogram.samples()
+    }
+    bucket = "test_latency_seconds_bucket"
+    assert samples[(bucket, (("endpoint", "search"), ("le", "0.025")))] == 1
+    assert samples[(bucket, (("endpoint", "search"), ("le", "5.0")))] == 2
+    assert samples[(bucket, (("endpoint", "search"), ("le", "+Inf")))] == 2
+    assert samples[("test_latency_seconds_count", (("endpoint", "search"),))] == 2
+
+
+def test_classifies_endpoints() -> None:
+    search = "https://api.github.com/search/issues?q=label%3Aneeds_reviewer"
+    assert gh_util.endpoint_class(search) == "search"
+    labels = "https://api.github.com/repos/NixOS/nixpkgs/issues/1/labels/marvin"
+    assert gh_util.endpoint_class(labels) == "labels"
+    reviewers = "https://api.github.com/repos/NixOS/nixpkgs/pulls/1/requested_reviewers"
+    assert gh_util.endpoint_class(reviewers) == "reviewers"
+
+
+async def test_serves_metrics(aiohttp_client: Any) -> None:
+    app = web.Application()
+    app.add_routes(main.routes)
+    client = await aiohttp_client(app)
+    response = await client.get("/metrics")
+    assert response.status == 200
+    assert response.headers["Content-Type"].startswith("text/plain")
+    text = await response.text()
+    assert "# TYPE marvin_webhook_latency_seconds histogram" in text
+    assert "marvin_outbox_pending 0.0" in text
+    assert "# TYPE marvin_webhooks_shed_total counter" in text
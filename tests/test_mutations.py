@@ -0,0 +1,52 @@
+import asyncio
+from typing import Any
+from typing import Dict
+from typing import List
+
+from marvin import mutations
+
+
+class RecordingMutation(mutations.Mutation):
+    def __init__(self, issue: Dict[str, Any], name: str, log: List[str]) -> None:
+        super().__init__(issue)
+        self.name = name
+        self.log = log
+
+    async def apply(self, gh: Any, token: str) -> None:
+        self.log.append(f"start {self.name}")
+        await asyncio.sleep(0.01)
+        if self.name == "fail":
+            raise RuntimeError("GitHub is down")
+        self.log.append(f"end {self.name}")
+
+    def describe(self) -> str:
+        return self.name
+
+
+async def test_execute_keeps_order_per_pull_request() -> None:
+    log: List[str] = []
+    first = {"url": "first-url", "number": 1}
+    second = {"url": "second-url", "number": 2}
+    planned = [
+        RecordingMutation(first, "a1", log),
+        RecordingMutation(second, "b1", log),
+        RecordingMutation(first, "a2", log),
+    ]
+    await mutations.execute(None, "fake-token", planned, max_concurrency=2)  # type: ignore
+    # Both pull requests are handled concurrently, but a2 waits for a1.
+    assert log[:2] == ["start a1", "start b1"]
+    assert log.index("end a1") < log.index("start a2")
+
+
+async def test_execute_skips_rest_of_pull_request_after_failure() -> None:
+    log: List[str] = []
+    first = {"url": "first-url", "number": 1}
+    second = {"url": "second-url", "number": 2}
+    planned = [
+        RecordingMutation(first, "fail", log),
+        RecordingMutation(first, "a2", log),
+        RecordingMutation(second, "b1", log),
+    ]
+    await mutations.execute(None, "fake-token", planned, max_concurrency=1)  # type: ignore
+    assert "start a2" not in log
+    assert "end b1" in log
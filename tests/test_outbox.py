@@ -0,0 +1,129 @@
+import asyncio
+import http
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+import gidgethub
+
+from benchmarks import github
+from marvin import mutations
+from marvin import outbox
+
+ISSUE = {
+    "url": "issue-url",
+    "number": 1,
+    "labels": [{"name": "marvin"}, {"name": "awaiting_reviewer"}],
+}
+
+
+class FlakyGitHubAPIMock:
+    def __init__(self, failures: int) -> None:
+        self.failures = failures
+        self.post_data: List[Tuple[str, Dict[str, Any]]] = []
+        self.delete_urls: List[str] = []
+        self.label_reads = 0
+
+    async def getitem(self, url: str, oauth_token: str) -> Any:
+        self.label_reads += 1
+        return ISSUE["labels"]
+
+    async def post(self, url: str, oauth_token: str, data: Dict[str, Any]) -> None:
+        if self.failures > 0:
+            self.failures -= 1
+            raise gidgethub.GitHubBroken(http.HTTPStatus.BAD_GATEWAY)
+        self.post_data.append((url, data))
+
+    async def delete(self, url: str, oauth_token: str) -> None:
+        self.delete_urls.append(url)
+
+
+def test_mutations_round_trip() -> None:
+    mutation = mutations.SetStatus(dict(ISSUE, title="irrelevant"), "needs_reviewer")
+    restored = mutations.from_dict(mutation.to_dict())
+    assert isinstance(restored, mutations.SetStatus)
+    assert restored.status == "needs_reviewer"
+    assert restored.issue == ISSUE
+
+
+def test_later_entries_wait_for_earlier_entries_of_same_pull_request() -> None:
+    box = outbox.Outbox(":memory:")
+    (first,) = box.record("1", [mutations.SetStatus(ISSUE, "needs_reviewer")])
+    box.record("1", [mutations.PostComment(dict(ISSUE, comments_url="c"), "Hi")])
+    box.retry_later(first)
+    assert box.due(time.time()) == []
+    assert len(box.due(time.time() + 60)) == 2
+
+
+def test_giving_up_drops_later_entries_of_same_pull_request() -> None:
+    box = outbox.Outbox(":memory:", max_attempts=1)
+    (first,) = box.record("1", [mutations.SetStatus(ISSUE, "needs_reviewer")])
+    box.record("1", [mutations.PostComment(dict(ISSUE, comments_url="c"), "Hi")])
+    other = dict(ISSUE, url="other-url")
+    box.record("1", [mutations.SetStatus(other, "needs_reviewer")])
+    box.retry_later(first)
+    assert box.pending_for("issue-url") == 0
+    assert box.pending_for("other-url") == 1
+
+
+async def test_failed_mutations_are_retried() -> None:
+    box = outbox.Outbox(":memory:", retry_delay_seconds=0)
+    outbox.outbox = box
+    try:
+        gh = FlakyGitHubAPIMock(failures=1)
+        planned: List[mutations.Mutation] = [
+            mutations.SetStatus(ISSUE, "needs_reviewer")
+        ]
+        await outbox.execute(gh, "fake-token", "1", planned, 1)  # type: ignore
+        # The old label was removed, but setting the new one failed.
+        assert gh.delete_urls == ["issue-url/labels/awaiting_reviewer"]
+        assert gh.post_data == []
+        assert box.pending() == 1
+        # The first attempt uses the labels of the recorded issue.
+        assert gh.label_reads == 0
+
+        entries = [
+            (entry_id, mutation) for entry_id, _, mutation in box.due(time.time())
+        ]
+        await outbox.execute_recorded(gh, "fake-token", entries, 1)  # type: ignore
+        assert gh.post_data == [("issue-url/labels", {"labels": ["needs_reviewer"]})]
+        assert box.pending() == 0
+        # The retry reads them again, since the first attempt changed them.
+        assert gh.label_reads == 1
+    finally:
+        outbox.outbox = None
+
+
+async def test_queued_status_changes_leave_one_status_label() -> None:
+    fake = github.FakeGitHub()
+    pull = fake.pull(1)
+    pull.labels = {"marvin", "needs_reviewer"}
+    gh = github.InProcessGitHubAPI(fake)
+    # Both changes were recorded from the same snapshot of the labels.
+    issue = fake.issue(pull, pull.labels)
+    box = outbox.Outbox(":memory:")
+    outbox.outbox = box
+    try:
+        box.record("1", [mutations.SetStatus(issue, "awaiting_reviewer")])
+        box.record("1", [mutations.SetStatus(issue, "awaiting_changes")])
+        entries = [
+            (entry_id, mutation) for entry_id, _, mutation in box.due(time.time())
+        ]
+        await outbox.execute_recorded(gh, "fake-token", entries, 1)
+    finally:
+        outbox.outbox = None
+    assert pull.labels == {"marvin", "awaiting_changes"}
+
+
+async def test_waits_until_mutations_of_a_pull_request_are_applied() -> None:
+    box = outbox.Outbox(":memory:")
+    outbox.outbox = box
+    try:
+        (entry_id,) = box.record("1", [mutations.SetStatus(ISSUE, "needs_reviewer")])
+        assert not await outbox.applied("issue-url", timeout_seconds=0.05)
+        asyncio.get_event_loop().call_later(0.05, box.complete, entry_id)
+        assert await outbox.applied("issue-url", timeout_seconds=1)
+    finally:
+        outbox.outbox = None
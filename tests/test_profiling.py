@@ -0,0 +1,79 @@
+import asyncio
+import time
+from typing import Any
+
+from aiohttp import web
+
+from marvin import __main__ as main
+from marvin import profiling
+
+
+def spin(seconds: float) -> None:
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+async def blocking_handler() -> None:
+    for _ in range(10):
+        spin(0.02)
+        await asyncio.sleep(0)
+
+
+async def test_samples_blocking_code_on_the_event_loop() -> None:
+    handler = asyncio.ensure_future(blocking_handler())
+    collapsed = await profiling.sample_event_loop(0.2, interval_seconds=0.001)
+    await handler
+    stacks = dict(line.rsplit(" ", 1) for line in collapsed.splitlines())
+    spinning = [
+        stack
+        for stack in stacks
+        if stack.endswith("test_profiling:blocking_handler;test_profiling:spin")
+    ]
+    assert len(spinning) > 0
+
+
+async def inner(done: asyncio.Event) -> None:
+    await done.wait()
+
+
+async def outer(done: asyncio.Event) -> None:
+    await inner(done)
+
+
+async def test_snapshots_what_tasks_wait_on() -> None:
+    done = asyncio.Event()
+    task = asyncio.ensure_future(outer(done))
+    await asyncio.sleep(0)
+    [awaiting] = [
+        snapshot["awaiting"]
+        for snapshot in profiling.task_snapshots()
+        if snapshot["coroutine"] == "outer"
+    ]
+    done.set()
+    await task
+    assert [frame.split(" ")[0] for frame in awaiting] == [
+        "test_profiling:outer",
+        "test_profiling:inner",
+        "asyncio.locks:wait",
+    ]
+
+
+async def test_profile_endpoint(aiohttp_client: Any) -> None:
+    app = web.Application()
+    app.add_routes(main.routes)
+    app["debug_token"] = "secret"
+    client = await aiohttp_client(app)
+    assert (await client.get("/debug/profile")).status == 401
+    headers = {"Authorization": "Bearer secret"}
+    url = "/debug/profile?seconds=0.1&format=pstats"
+    profiles = await asyncio.gather(
+        client.get(url, headers=headers), client.get(url, headers=headers)
+    )
+    assert sorted(response.status for response in profiles) == [200, 409]
+    [response] = [response for response in profiles if response.status == 200]
+    result = await response.json()
+    assert "cumulative" in result["profile"]
+    assert len(result["tasks"]) > 0
+    url = "/debug/profile?seconds=0.1&format=svg"
+    assert (await client.get(url, headers=headers)).status == 400
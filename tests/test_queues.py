@@ -0,0 +1,62 @@
+import time
+from typing import Any
+
+from aiohttp import web
+
+from benchmarks import github
+from marvin import __main__ as main
+from marvin import constants
+from marvin import gh_util
+from marvin import queues
+from marvin import team
+from marvin import triage
+
+
+async def test_triage_snapshots_queues(
+    aiohttp_client: Any, monkeypatch: Any, tmp_path: Any
+) -> None:
+    monkeypatch.setattr(constants, "SEARCH_INDEX_SETTLE_SECONDS", 0)
+    monkeypatch.setattr(queues, "snapshots", queues.QueueSnapshots(":memory:"))
+    # Nothing to change, so that the queues stay as they are.
+    roster_path = tmp_path / "team.json"
+    roster_path.write_text("[]")
+    monkeypatch.setattr(team, "roster", team.Roster(str(roster_path)))
+    fake = github.FakeGitHub(search_limit=1000)
+    fake.seed(200)
+    for pull in fake.pulls.values():
+        pull.updated_at = time.time()
+    gh = github.InProcessGitHubAPI(fake)
+    # A dry run records nothing.
+    await triage.run_triage(gh, "token", dry_run=True)
+    assert queues.snapshots.render()[0] == b"{}"
+    requests = fake.requests
+    await triage.run_triage(gh, "token")
+    full_count_requests = fake.requests - requests
+
+    app = web.Application()
+    app.add_routes(main.routes)
+    client = await aiohttp_client(app)
+    response = await client.get("/queues")
+    assert response.status == 200
+    assert "max-age" in response.headers["Cache-Control"]
+    snapshot = (await response.json())[github.REPOSITORY]["queues"]
+    assert set(snapshot) == gh_util.ISSUE_STATUS_LABELS
+    for status in gh_util.ISSUE_STATUS_LABELS:
+        pulls = [pull for pull in fake.pulls.values() if status in pull.labels]
+        assert snapshot[status]["count"] == len(pulls)
+        oldest = min(pull.created_at for pull in pulls)
+        assert snapshot[status]["oldest_created_at"] == github.format_time(oldest)
+
+    # Nothing changed since.
+    etag = response.headers["ETag"]
+    response = await client.get("/queues", headers={"If-None-Match": etag})
+    assert response.status == 304
+
+    # The next run only counts the queues it searches anyway.
+    requests = fake.requests
+    await triage.run_triage(gh, "token")
+    unsearched = len(gh_util.ISSUE_STATUS_LABELS) - 2
+    assert fake.requests - requests == full_count_requests - unsearched
+    response = await client.get("/queues")
+    snapshot = (await response.json())[github.REPOSITORY]["queues"]
+    assert set(snapshot) == gh_util.ISSUE_STATUS_LABELS
@@ -0,0 +1,53 @@
+import time
+
+from benchmarks import github
+from marvin import mutations
+from marvin import triage
+
+DAY = 24 * 60 * 60
+
+
+async def plan_reminders(gh: github.InProcessGitHubAPI) -> triage.TriageResult:
+    result = triage.TriageResult()
+    await triage.timeout_awaiting_reviewer(gh, "token", github.REPOSITORY, result)
+    await mutations.execute(gh, "token", result.mutations, max_concurrency=1)
+    return result
+
+
+async def test_reminds_once_and_then_times_out() -> None:
+    fake = github.FakeGitHub()
+    pull = fake.pull(1)
+    pull.set_labels({"marvin", "awaiting_reviewer"}, time.time() - 4 * DAY)
+    pull.updated_at = time.time() - 4 * DAY
+    gh = github.InProcessGitHubAPI(fake)
+
+    result = await plan_reminders(gh)
+    assert result.reminders == 1
+    assert len(pull.comments) == 1
+    assert pull.labels == {"marvin", "awaiting_reviewer", "timeout_pending"}
+
+    # The reminder is not repeated while nothing happens. It is kept on GitHub,
+    # so this holds for a restarted marvin or a dry run as well.
+    result = await plan_reminders(gh)
+    assert result.mutations == []
+
+    # Once the reminder is old enough, the PR is timed out.
+    pull.updated_at = time.time() - 2 * DAY
+    result = await plan_reminders(gh)
+    assert result.status_changes == 1
+    assert pull.labels == {"marvin", "needs_reviewer"}
+    assert len(pull.comments) == 1
+
+
+async def test_activity_after_reminder_delays_timeout() -> None:
+    fake = github.FakeGitHub()
+    pull = fake.pull(1)
+    pull.set_labels(
+        {"marvin", "awaiting_reviewer", "timeout_pending"}, time.time() - 4 * DAY
+    )
+    pull.updated_at = time.time() - DAY / 2
+    gh = github.InProcessGitHubAPI(fake)
+
+    result = await plan_reminders(gh)
+    assert result.mutations == []
+    assert "awaiting_reviewer" in pull.labels
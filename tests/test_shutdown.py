@@ -0,0 +1,92 @@
+import asyncio
+import signal
+import sqlite3
+import time
+from typing import Any
+from typing import Dict
+
+import aiohttp
+
+from benchmarks import corpus
+from benchmarks import github
+from benchmarks import server
+from benchmarks import startup
+from marvin import commands
+
+
+def requests_changes(delivery: Dict[str, Any]) -> bool:
+    """Whether a delivery is a review requesting changes, without commands."""
+    review = delivery["payload"].get("review")
+    return (
+        review is not None
+        and review["state"] == "changes_requested"
+        and len(commands.command_router.find_commands(review["body"] or "")) == 0
+    )
+
+
+async def test_drains_in_flight_work_on_sigterm(
+    aiohttp_server: Any, tmp_path: Any
+) -> None:
+    fake = github.FakeGitHub(latency_seconds=0.05)
+    api = await aiohttp_server(server.make_app(fake))
+    fake.api_url = str(api.make_url("")).rstrip("/")
+    # Only deliveries that change a status, which is then held back by the
+    # coalescing window.
+    deliveries = [
+        startup.localize(delivery, fake.api_url)
+        for delivery in corpus.generate(300)
+        if requests_changes(delivery)
+    ]
+    for delivery in deliveries:
+        issue = delivery["payload"].get(
+            "issue", delivery["payload"].get("pull_request")
+        )
+        # Every pull request starts out with a status, which it must not lose.
+        issue["labels"] = [{"name": "marvin"}, {"name": "needs_reviewer"}]
+        fake.pulls[issue["number"]] = github.PullRequest(
+            issue["number"],
+            issue["user"]["login"],
+            time.time(),
+            ["marvin", "needs_reviewer"],
+        )
+
+    port = startup.free_port()
+    with open(tmp_path / "marvin.log", "wb") as log:
+        process = await startup.start_marvin(
+            fake.api_url,
+            startup.private_key(),
+            port,
+            str(tmp_path),
+            log,
+            # Keep the status changes in flight until the shutdown.
+            STATUS_COALESCE_SECONDS="30",
+            WEBHOOK_MAX_IN_FLIGHT="100",
+            SHUTDOWN_TIMEOUT_SECONDS="10",
+        )
+    try:
+        await startup.wait_until_listening(port, timeout_seconds=10)
+        async with aiohttp.ClientSession() as session:
+            url = f"http://localhost:{port}/webhook"
+            # The deliveries do not wait for the coalescing window.
+            delivering = [
+                startup.deliver(session, url, delivery) for delivery in deliveries
+            ]
+            statuses = await asyncio.wait_for(asyncio.gather(*delivering), 10)
+        assert all("needs_reviewer" in pull.labels for pull in fake.pulls.values())
+        started = time.monotonic()
+        process.send_signal(signal.SIGTERM)
+        await asyncio.wait_for(process.wait(), 15)
+    finally:
+        if process.returncode is None:
+            process.kill()
+    output = (tmp_path / "marvin.log").read_text()
+
+    assert process.returncode == 0, output
+    assert time.monotonic() - started < 10
+    assert "Drained in-flight work" in output
+    assert statuses == [200] * len(deliveries)
+    database = sqlite3.connect(str(tmp_path / "marvin.sqlite"))
+    pending = {key for (key,) in database.execute("SELECT key FROM outbox")}
+    for number, pull in fake.pulls.items():
+        # The status changes in open windows were recorded on shutdown.
+        assert "awaiting_changes" in pull.labels or fake.issue_url(number) in pending
@@ -1,23 +1,40 @@
+import asyncio
 from typing import Any
 from typing import Dict
 from typing import List
+from typing import Sequence
 from typing import Tuple
 
 from gidgethub import sansio
 
 from marvin import __main__ as main
+from marvin import outbox
+from marvin import status
 
 
 class GitHubAPIMock:
-    def __init__(self) -> None:
+    """Records the changes to the labels of a pull request."""
+
+    def __init__(self, labels: Sequence[Dict[str, str]] = ()) -> None:
         self.post_data: List[Tuple[str, Dict[str, Any]]] = []
         self.delete_urls: List[str] = []
+        self.labels = [label["name"] for label in labels]
+
+    async def getitem(self, url: str, oauth_token: str) -> List[Dict[str, str]]:
+        return [{"name": name} for name in self.labels]
 
     async def post(self, url: str, oauth_token: str, data: Dict[str, Any]) -> None:
         self.post_data.append((url, data))
+        self.labels += data.get("labels", [])
 
     async def delete(self, url: str, oauth_token: str) -> None:
         self.delete_urls.append(url)
+        self.labels.remove(url.rsplit("/", 1)[1])
+
+
+def labels_of(data: Dict[str, Any]) -> List[Dict[str, str]]:
+    issue = data["issue"] if "issue" in data else data["pull_request"]
+    return issue["labels"]
 
 
 async def test_adds_awaiting_reviewer_label() -> None:
@@ -35,7 +52,7 @@ async def test_adds_awaiting_reviewer_label() -> None:
         },
     }
     event = sansio.Event(data, event="issue_comment", delivery_id="1")
-    gh = GitHubAPIMock()
+    gh = GitHubAPIMock(labels_of(data))
     await main.router.dispatch(event, gh, token="fake-token")
     assert gh.post_data == [("issue-url/labels", {"labels": ["awaiting_reviewer"]})]
 
@@ -59,7 +76,7 @@ async def test_removes_old_status_labels_on_new_status() -> None:
         },
     }
     event = sansio.Event(data, event="issue_comment", delivery_id="1")
-    gh = GitHubAPIMock()
+    gh = GitHubAPIMock(labels_of(data))
     await main.router.dispatch(event, gh, token="fake-token")
     assert gh.post_data == [("issue-url/labels", {"labels": ["awaiting_reviewer"]})]
     assert set(gh.delete_urls) == {
@@ -83,7 +100,7 @@ async def test_sets_awaiting_changes_to_awaiting_review_on_author_comment() -> N
         },
     }
     event = sansio.Event(data, event="issue_comment", delivery_id="1")
-    gh = GitHubAPIMock()
+    gh = GitHubAPIMock(labels_of(data))
     await main.router.dispatch(event, gh, token="fake-token")
     assert gh.post_data == [("issue-url/labels", {"labels": ["awaiting_reviewer"]})]
     assert set(gh.delete_urls) == {
@@ -106,7 +123,7 @@ async def test_does_not_modify_needs_merge_on_author_comment() -> None:
         },
     }
     event = sansio.Event(data, event="issue_comment", delivery_id="1")
-    gh = GitHubAPIMock()
+    gh = GitHubAPIMock(labels_of(data))
     await main.router.dispatch(event, gh, token="fake-token")
     assert gh.post_data == []
     assert gh.delete_urls == []
@@ -127,7 +144,7 @@ async def test_does_not_crash_on_empty_pull_request_summary() -> None:
         },
     }
     event = sansio.Event(data, event="pull_request_review", delivery_id="1")
-    gh = GitHubAPIMock()
+    gh = GitHubAPIMock(labels_of(data))
     await main.router.dispatch(event, gh, token="fake-token")
     assert gh.post_data == [("pr-url/labels", {"labels": ["awaiting_changes"]})]
     assert set(gh.delete_urls) == {
@@ -150,7 +167,7 @@ async def test_sets_to_awaiting_reviewer_on_comment() -> None:
         },
     }
     event = sansio.Event(data, event="issue_comment", delivery_id="1")
-    gh = GitHubAPIMock()
+    gh = GitHubAPIMock(labels_of(data))
     await main.router.dispatch(event, gh, token="fake-token")
     assert gh.post_data == [("issue-url/labels", {"labels": ["awaiting_reviewer"]})]
     assert set(gh.delete_urls) == {
@@ -168,7 +185,7 @@ async def test_sets_to_awaiting_reviewer_on_assigned() -> None:
         },
     }
     event = sansio.Event(data, event="pull_request", delivery_id="1")
-    gh = GitHubAPIMock()
+    gh = GitHubAPIMock(labels_of(data))
     await main.router.dispatch(event, gh, token="fake-token")
     assert gh.post_data == [("pr-url/labels", {"labels": ["awaiting_reviewer"]})]
     assert set(gh.delete_urls) == {
@@ -186,7 +203,7 @@ async def test_sets_to_awaiting_reviewer_on_review_requested() -> None:
         },
     }
     event = sansio.Event(data, event="pull_request", delivery_id="1")
-    gh = GitHubAPIMock()
+    gh = GitHubAPIMock(labels_of(data))
     await main.router.dispatch(event, gh, token="fake-token")
     assert gh.post_data == [("pr-url/labels", {"labels": ["awaiting_reviewer"]})]
     assert set(gh.delete_urls) == {
@@ -209,7 +226,7 @@ async def test_sets_to_awaiting_reviewer_on_review_submitted() -> None:
         },
     }
     event = sansio.Event(data, event="pull_request_review", delivery_id="1")
-    gh = GitHubAPIMock()
+    gh = GitHubAPIMock(labels_of(data))
     await main.router.dispatch(event, gh, token="fake-token")
     assert gh.post_data == [("pr-url/labels", {"labels": ["awaiting_reviewer"]})]
     assert set(gh.delete_urls) == {
@@ -232,7 +249,7 @@ async def test_no_changes_on_self_review_submitted() -> None:
         },
     }
     event = sansio.Event(data, event="pull_request_review", delivery_id="1")
-    gh = GitHubAPIMock()
+    gh = GitHubAPIMock(labels_of(data))
     await main.router.dispatch(event, gh, token="fake-token")
     assert len(gh.post_data) == 0
     assert len(gh.delete_urls) == 0
@@ -253,9 +270,126 @@ async def test_sets_to_needs_reviewer_when_marked_as_ready() -> None:
         },
     }
     event = sansio.Event(data, event="pull_request", delivery_id="1")
-    gh = GitHubAPIMock()
+    gh = GitHubAPIMock(labels_of(data))
     await main.router.dispatch(event, gh, token="fake-token")
     assert gh.post_data == [("pr-url/labels", {"labels": ["needs_reviewer"]})]
     assert set(gh.delete_urls) == {
         "pr-url/labels/awaiting_changes",
     }
+
+
+async def test_coalesces_status_changes_within_window() -> None:
+    issue = {
+        "url": "pr-url",
+        "user": {"id": 42, "login": "author"},
+        "labels": [{"name": "marvin"}, {"name": "needs_reviewer"}],
+    }
+    comment_event = sansio.Event(
+        {
+            "action": "created",
+            "pull_request": issue,
+            "comment": {
+                "body": "The body is irrelevant.",
+                "user": {"id": 43, "login": "non-author"},
+            },
+        },
+        event="pull_request_review_comment",
+        delivery_id="1",
+    )
+    review_event = sansio.Event(
+        {
+            "action": "submitted",
+            "pull_request": issue,
+            "review": {
+                "body": None,
+                "state": "changes_requested",
+                "user": {"id": 43, "login": "non-author"},
+            },
+        },
+        event="pull_request_review",
+        delivery_id="2",
+    )
+    gh = GitHubAPIMock(labels_of({"pull_request": issue}))
+    status.coalescer.window_seconds = 0.05
+    await asyncio.gather(
+        main.router.dispatch(comment_event, gh, token="fake-token"),
+        main.router.dispatch(review_event, gh, token="fake-token"),
+    )
+    # The intermediate awaiting_reviewer status is never set.
+    assert gh.post_data == [("pr-url/labels", {"labels": ["awaiting_changes"]})]
+    assert gh.delete_urls == ["pr-url/labels/needs_reviewer"]
+
+
+async def test_returns_before_window_closes_with_outbox() -> None:
+    issue = {
+        "url": "pr-url",
+        "user": {"id": 42, "login": "author"},
+        "labels": [{"name": "marvin"}, {"name": "needs_reviewer"}],
+    }
+    review_event = sansio.Event(
+        {
+            "action": "submitted",
+            "installation": {"id": 1},
+            "pull_request": issue,
+            "review": {
+                "body": None,
+                "state": "changes_requested",
+                "user": {"id": 43, "login": "non-author"},
+            },
+        },
+        event="pull_request_review",
+        delivery_id="1",
+    )
+    gh = GitHubAPIMock(labels_of({"pull_request": issue}))
+    box = outbox.Outbox(":memory:")
+    outbox.outbox = box
+    status.coalescer.window_seconds = 60
+    try:
+        await asyncio.wait_for(
+            main.router.dispatch(review_event, gh, token="fake-token"), 1
+        )
+        # The status is only recorded once the window closes.
+        assert box.pending_for("pr-url") == 0
+        await status.coalescer.flush_all()
+        assert box.pending_for("pr-url") == 1
+    finally:
+        outbox.outbox = None
+    assert gh.post_data == []
+
+
+class SlowGitHubAPIMock(GitHubAPIMock):
+    """Takes a while for each request and tracks overlapping requests."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def post(self, url: str, oauth_token: str, data: Dict[str, Any]) -> None:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.02)
+        self.in_flight -= 1
+        await super().post(url, oauth_token, data)
+
+
+async def test_flush_waits_for_status_write_in_flight() -> None:
+    issue = {"url": "pr-url", "labels": [{"name": "marvin"}]}
+    gh = SlowGitHubAPIMock()
+    status.coalescer.window_seconds = 0.01
+    window = asyncio.ensure_future(
+        status.coalescer.set_issue_status(
+            issue, "awaiting_reviewer", gh, "token"  # type: ignore
+        )
+    )
+    # The window closed and its status is being written.
+    await asyncio.sleep(0.02)
+    await status.coalescer.set_issue_status(
+        issue, "awaiting_changes", gh, "token", flush=True  # type: ignore
+    )
+    await window
+    assert gh.max_in_flight == 1
+    assert [data["labels"] for _, data in gh.post_data] == [
+        ["awaiting_reviewer"],
+        ["awaiting_changes"],
+    ]
@@ -0,0 +1,20 @@
+import asyncio
+from typing import List
+
+from marvin import supervision
+
+
+async def test_restarts_failed_task_with_backoff() -> None:
+    runs: List[float] = []
+
+    async def flaky() -> None:
+        runs.append(asyncio.get_event_loop().time())
+        if len(runs) < 3:
+            raise Exception("Boom")
+
+    await asyncio.wait_for(
+        supervision.supervise("flaky", flaky, initial_backoff_seconds=0.01), 1
+    )
+    assert len(runs) == 3
+    assert runs[1] - runs[0] >= 0.01
+    assert runs[2] - runs[1] >= 0.02
@@ -0,0 +1,144 @@
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+import json
+import os
+from typing import Any
+from typing import Dict
+from typing import List
+
+from benchmarks import github
+from marvin import team
+
+ENTRIES: List[Dict[str, Any]] = [
+    {"gh_name": "timokau", "days": 1, "limit": 100, "can_merge": True},
+    {"gh_name": "timokau", "days": 1, "limit": 1},
+    {"gh_name": "fgaz", "days": 7, "limit": 2},
+    {"gh_name": "kevincox"},
+]
+
+
+def write_roster(path: Any, entries: List[Dict[str, Any]], mtime: float) -> None:
+    path.write_text(json.dumps(entries))
+    os.utime(path, (mtime, mtime))
+
+
+def test_roster_indexes_members(tmp_path: Any) -> None:
+    path = tmp_path / "team.json"
+    write_roster(path, ENTRIES, 1000)
+    roster = team.Roster(str(path))
+    assert len(roster.members) == 4
+    assert [member.gh_name for member in roster.by_role[True]] == ["timokau"]
+    assert {member.gh_name for member in roster.by_role[False]} == {
+        "timokau",
+        "fgaz",
+        "kevincox",
+    }
+    assert len(roster.by_login["timokau"]) == 2
+    assert isinstance(roster.by_login["fgaz"][0], team.ActivityLimitedReviewer)
+    assert not isinstance(roster.by_login["kevincox"][0], team.ActivityLimitedReviewer)
+
+
+def test_reload_keeps_unchanged_members(tmp_path: Any) -> None:
+    path = tmp_path / "team.json"
+    write_roster(path, ENTRIES, 1000)
+    roster = team.Roster(str(path))
+    fgaz = roster.by_login["fgaz"][0]
+    assert isinstance(fgaz, team.ActivityLimitedReviewer)
+    fgaz.cached_no_until = datetime.now(timezone.utc) + timedelta(days=1)
+
+    roster.reload_if_changed()  # unchanged
+    write_roster(
+        path, ENTRIES[1:] + [{"gh_name": "turion", "days": 7, "limit": 3}], 2000
+    )
+    roster.reload_if_changed()
+    assert len(roster.members) == 4
+    assert roster.by_role[True] == []
+    assert roster.by_login["fgaz"] == [fgaz]
+    assert "turion" in roster.by_login
+
+
+def test_invalid_reload_keeps_roster(tmp_path: Any) -> None:
+    path = tmp_path / "team.json"
+    write_roster(path, ENTRIES, 1000)
+    roster = team.Roster(str(path))
+    members = roster.members
+    write_roster(path, [{"gh_name": "fgaz", "dayz": 7}] + ENTRIES, 2000)
+    roster.reload_if_changed()
+    assert roster.members is members
+    path.unlink()
+    roster.reload_if_changed()
+    assert roster.members is members
+
+    # The members (and their cached limits) are still reused afterwards.
+    write_roster(path, ENTRIES, 3000)
+    roster.reload_if_changed()
+    assert roster.members == members
+
+
+def test_shipped_roster_loads() -> None:
+    assert len(team.roster.by_role[True]) > 0
+    assert len(team.roster.by_role[False]) > 0
+
+
+async def test_get_reviewer_skips_author(monkeypatch: Any) -> None:
+    roster = team.Roster()
+    roster.load([{"gh_name": "timokau"}, {"gh_name": "fgaz"}])
+    monkeypatch.setattr(team, "roster", roster)
+    issue = {"user": {"login": "timokau"}}
+    for _ in range(10):
+        reviewer = await team.get_reviewer(
+            None, "token", issue, merge_permission_needed=False  # type: ignore
+        )
+        assert reviewer == "fgaz"
+    assert (
+        await team.get_reviewer(
+            None, "token", issue, merge_permission_needed=True  # type: ignore
+        )
+        is None
+    )
+
+
+async def test_gist_cache() -> None:
+    fake = github.FakeGitHub()
+    fake.gists = {"a": "enable\n", "b": "disable"}
+    gh = github.InProcessGitHubAPI(fake)
+    gists = team.GistCache(ttl_seconds=60)
+
+    await gists.refresh(gh, ["a", "b", "a"])
+    assert fake.requests == 2
+    assert gists.content("a") == "enable\n"
+    assert gists.content("b") == "disable"
+    await gists.refresh(gh, ["a", "b"])
+    assert fake.requests == 2  # cached
+
+    gists.ttl_seconds = 0
+    remaining = fake.rate_limits["core"][2]
+    fake.gists["b"] = "enable"
+    await gists.refresh(gh, ["a", "b"])
+    assert fake.requests == 4
+    assert fake.rate_limits["core"][2] == remaining - 1  # "a" was not modified
+    assert gists.content("b") == "enable"
+
+    del fake.gists["a"]
+    await gists.refresh(gh, ["a"])
+    assert gists.content("a") == "enable\n"  # last known content
+
+
+async def test_gist_controlled_reviewer(monkeypatch: Any) -> None:
+    fake = github.FakeGitHub()
+    fake.gists = {"a": "disable"}
+    gh = github.InProcessGitHubAPI(fake)
+    monkeypatch.setattr(team, "gists", team.GistCache(ttl_seconds=60))
+    roster = team.Roster()
+    roster.load([{"gh_name": "fgaz", "gist": "a"}, {"gh_name": "turion", "gist": "b"}])
+    assert roster.gist_ids() == {"a", "b"}
+    monkeypatch.setattr(team, "roster", roster)
+
+    await team.gists.refresh(gh, roster.gist_ids())
+    issue = {"user": {"login": "somebody"}}
+    assert (
+        await team.get_reviewer(gh, "token", issue, merge_permission_needed=False)
+        is None
+    )
+    assert fake.requests == 2  # decided from the cache
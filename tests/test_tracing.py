@@ -0,0 +1,37 @@
+from typing import Any
+
+from aiohttp import web
+
+from marvin import __main__ as main
+from marvin import tracing
+
+
+def test_attributes_calls_to_innermost_cause() -> None:
+    tracing.calls.clear()
+    with tracing.cause("triage", "1@0"):
+        with tracing.cause("triage.assign_reviewers"):
+            tracing.record(
+                tracing.ApiCall("GET", "/search/issues?q=x", 200, 0.5, 10, "search", 9)
+            )
+        tracing.record(tracing.ApiCall("GET", "/rate_limit", 200, 0.1, 10, "core", 99))
+    assert [(call.cause, call.cause_id) for call in tracing.calls] == [
+        ("triage.assign_reviewers", "1@0"),
+        ("triage", "1@0"),
+    ]
+    assert tracing.summary()["triage.assign_reviewers"]["calls_per_cause"] == 1
+
+
+async def test_debug_endpoint_requires_token(aiohttp_client: Any) -> None:
+    app = web.Application()
+    app.add_routes(main.routes)
+    app["debug_token"] = "secret"
+    client = await aiohttp_client(app)
+    assert (await client.get("/debug/api-calls")).status == 401
+    headers = {"Authorization": "Bearer wrong"}
+    assert (await client.get("/debug/api-calls", headers=headers)).status == 403
+    headers = {"Authorization": "Bearer secret"}
+    response = await client.get("/debug/api-calls", headers=headers)
+    assert response.status == 200
+    assert "summary" in await response.json()
+    response = await client.get("/debug/api-calls?limit=all", headers=headers)
+    assert response.status == 400
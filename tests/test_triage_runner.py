@@ -0,0 +1,110 @@
+import asyncio
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from typing import List
+
+from gidgethub import sansio
+
+from marvin import triage
+from marvin import triage_runner
+
+NOW = datetime(2020, 6, 1, tzinfo=timezone.utc)
+
+
+def rate_limit(remaining: int, reset_in_seconds: int) -> sansio.RateLimit:
+    return sansio.RateLimit(
+        limit=5000,
+        remaining=remaining,
+        reset_epoch=(NOW + timedelta(seconds=reset_in_seconds)).timestamp(),
+    )
+
+
+def test_shortens_delay_when_queues_move() -> None:
+    schedule = triage_runner.AdaptiveSchedule(60, 60 * 60)
+    schedule.delay_seconds = 600
+    result = triage.TriageResult()
+    result.status_changes = 2
+    assert schedule.update(result, {}, now=NOW) == 300
+    assert "queues moving" in schedule.reason
+
+
+def test_lengthens_delay_without_changes() -> None:
+    schedule = triage_runner.AdaptiveSchedule(60, 60 * 60)
+    schedule.delay_seconds = 2400
+    assert schedule.update(triage.TriageResult(), {}, now=NOW) == 60 * 60
+    assert schedule.reason == "no changes in last run"
+
+
+def test_wakes_up_when_reviewer_capacity_frees_up() -> None:
+    schedule = triage_runner.AdaptiveSchedule(60, 60 * 60)
+    schedule.delay_seconds = 60 * 60
+    result = triage.TriageResult()
+    result.unassigned = 3
+    result.capacity_frees_at = NOW + timedelta(seconds=900)
+    assert schedule.update(result, {}, now=NOW) == 900
+    assert "reviewer capacity" in schedule.reason
+
+
+def test_waits_for_rate_limit_reset() -> None:
+    schedule = triage_runner.AdaptiveSchedule(60, 60 * 60)
+    result = triage.TriageResult()
+    result.review_requests = 1
+    rate_limits = {
+        "core": rate_limit(remaining=100, reset_in_seconds=1200),
+        "search": rate_limit(remaining=4000, reset_in_seconds=30),
+    }
+    assert schedule.update(result, rate_limits, now=NOW) == 1200
+    assert "low core rate limit" in schedule.reason
+
+
+class RecordingRunner(triage_runner.TriageRunner):
+    def __init__(self, installation_id: str, log: List[str]) -> None:
+        super().__init__(installation_id, "app-id", "key", 0, 60)
+        self.log = log
+
+    async def run_once(self) -> float:
+        self.log.append(self.installation_id)
+        await asyncio.sleep(0.01)
+        return 60
+
+
+async def test_scheduler_limits_concurrency_and_prefers_requests() -> None:
+    log: List[str] = []
+    scheduler = triage_runner.TriageScheduler(max_concurrent=1, stagger_seconds=0)
+    for installation_id in ["a", "b", "c"]:
+        scheduler.runners[installation_id] = RecordingRunner(installation_id, log)
+    scheduler._start()
+    for installation_id in ["a", "b", "c"]:
+        scheduler._enqueue(installation_id, triage_runner.PRIORITY_PERIODIC)
+    await asyncio.sleep(0.001)
+    # Requested while "a" is running, so "c" overtakes "b".
+    scheduler.run_soon("c")
+    await asyncio.sleep(0.1)
+    assert log == ["a", "c", "b"]
+
+
+def test_schedule_shortens_delay_after_shedding() -> None:
+    schedule = triage_runner.AdaptiveSchedule(60, 60 * 60)
+    schedule.delay_seconds = 1200
+    result = triage.TriageResult()
+    assert schedule.update(result, {}, now=NOW, shed_deliveries=3) == 600
+    assert "3 webhook deliveries shed" in schedule.reason
+
+
+class FailingRunner(triage_runner.TriageRunner):
+    async def run_once(self) -> float:
+        raise Exception("Boom")
+
+
+async def test_scheduler_backs_off_after_failures() -> None:
+    scheduler = triage_runner.TriageScheduler(max_concurrent=1, stagger_seconds=0)
+    runner = FailingRunner("a", "app-id", "key", 10, 1000)
+    scheduler.runners["a"] = runner
+    for failures in range(1, 4):
+        await scheduler._run("a", asyncio.Semaphore(0))
+        assert runner.failures == failures
+        timer = scheduler._timers["a"]
+        delay = timer.when() - asyncio.get_event_loop().time()
+        assert abs(delay - 10 * 2 ** failures) < 1
+    timer.cancel()